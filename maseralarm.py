@@ -0,0 +1,289 @@
+import json
+import logging
+import math
+import os
+import queue
+import shlex
+import socket
+import subprocess
+import threading
+import time
+from maserwriter import lp_time
+import masermetrics
+
+# Alarms on the acquired samples, checked in the acquisition loop as each
+# sample is written, so e.g. a lost EFOS-B Lock is reported within one
+# sample period instead of by whoever next looks at the database. Rules are
+# compiled once, each keeps a small state per instrument and measurement
+# and checks a sample in O(1). A rule is a dict, from an [[alarm]] entry
+# of the site configuration, with field, optionally name, instrument (name
+# or type) and measurement, and one kind of check:
+#   below, above  the value is below or above the limit, and clears only
+#                 hysteresis past it
+#   rate          the value changes faster than rate per second, clears
+#                 below rate - hysteresis
+#   stuck         the value has not changed by more than tolerance for
+#                 stuck seconds, while samples arrive
+#   stale         no sample with the field has arrived for stale seconds,
+#                 e.g. from a hung instrument, checked every second, once
+#                 the field has been seen
+#   expect        the value differs from expect, e.g. a status string
+# A rule raises and clears its alarm at most once per holdoff seconds
+# (default 60). A state change held back meanwhile is reported with the
+# first sample after the holdoff, if it still holds, together with the
+# number of changes.
+class AlarmRule:
+    kinds = ('below', 'above', 'rate', 'stuck', 'stale', 'expect')
+
+    def __init__(self, RULE, HOLDOFF=60):
+        if 'field' not in RULE:
+            raise ValueError("Alarm rule without field: %s" % RULE)
+        kinds = [k for k in self.kinds if k in RULE]
+        if not kinds or (len(kinds) > 1 and set(kinds) != {'below', 'above'}):
+            raise ValueError("Alarm rule %s needs one of below/above, rate, stuck, stale or expect" % RULE)
+        self.field = RULE['field']
+        self.name = RULE.get('name', "%s %s" % (self.field, ' '.join(kinds)))
+        self.instrument = RULE.get('instrument')
+        self.measurement = RULE.get('measurement')
+        self.below = RULE.get('below')
+        self.above = RULE.get('above')
+        self.rate = RULE.get('rate')
+        self.stuck = RULE.get('stuck')
+        self.stale = RULE.get('stale')
+        self.expect = RULE.get('expect')
+        self.hysteresis = RULE.get('hysteresis', 0)
+        self.tolerance = RULE.get('tolerance', 0)
+        self.holdoff = RULE.get('holdoff', HOLDOFF)
+        self.exec = RULE.get('exec')
+        self.socket = RULE.get('socket')
+        self.check = {
+            'below': self.check_limits,
+            'above': self.check_limits,
+            'rate': self.check_rate,
+            'stuck': self.check_stuck,
+            'stale': self.check_arrival,
+            'expect': self.check_expect,
+        }[kinds[0]]
+        self.numeric = 'expect' not in kinds and 'stale' not in kinds
+        # (instrument name, measurement, tags) -> AlarmState
+        self.states = {}
+
+    def matches(self, NAME, TYPE, measurement):
+        return ((self.instrument is None or self.instrument in (NAME, TYPE)) and
+                (self.measurement is None or self.measurement == measurement))
+
+    def check_limits(self, s, v, t):
+        h = self.hysteresis if s.active else 0
+        return ((self.below is not None and v < self.below + h) or
+                (self.above is not None and v > self.above - h))
+
+    def check_rate(self, s, v, t):
+        if s.time is None or t <= s.time:
+            return s.active
+        rate = abs(v - s.value) * 1e9 / (t - s.time)
+        return rate > self.rate - (self.hysteresis if s.active else 0)
+
+    def check_stuck(self, s, v, t):
+        if s.value is None or abs(v - s.value) > self.tolerance:
+            s.since = t
+        return (t - s.since) / 1e9 >= self.stuck
+
+    def check_arrival(self, s, v, t):
+        s.arrived = time.monotonic()
+        return False
+
+    def check_expect(self, s, v, t):
+        return v != self.expect
+
+# State of one rule for one source
+class AlarmState:
+    def __init__(self):
+        self.active = False
+        self.value = None
+        self.time = None
+        self.since = None
+        self.arrived = None
+        self.changes = 0
+        # Last reported state and when, monotonic
+        self.reported = False
+        self.reported_at = -math.inf
+
+# Alarm events, as dicts, are handed to the hooks of their rule, or the
+# default ones, in a thread of their own, so acquisition never waits for
+# them. Hooks are
+#   exec    a command, run with the event as JSON on stdin and in the
+#           environment as MASERMON_ALARM, MASERMON_STATE ("raised" or
+#           "cleared"), MASERMON_INSTRUMENT, MASERMON_FIELD and
+#           MASERMON_VALUE, killed after TIMEOUT seconds
+#   socket  a Unix datagram socket the event is sent to as JSON
+# and every event is logged.
+class AlarmEngine:
+    def __init__(self, RULES, EXEC=None, SOCKET=None, HOLDOFF=60, TIMEOUT=30, MAXQUEUE=1000):
+        self.rules = [AlarmRule(r, HOLDOFF) for r in RULES]
+        self.exec = EXEC
+        self.socket = SOCKET
+        self.timeout = TIMEOUT
+        self.events = queue.Queue(MAXQUEUE)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.hook_loop, name="alarms", daemon=True)
+        self.thread.start()
+        self.stale = [r for r in self.rules if r.stale is not None]
+        if self.stale:
+            threading.Thread(target=self.stale_loop, name="alarmstale", daemon=True).start()
+
+    def rules_of(self, NAME, TYPE, measurement):
+        # The rules checking the samples of one source, looked up once per
+        # instrument and measurement
+        return [r for r in self.rules if r.matches(NAME, TYPE, measurement)]
+
+    def check(self, NAME, rules, point):
+        fields = point['fields']
+        t = None
+        for rule in rules:
+            v = fields.get(rule.field)
+            if v is None:
+                continue
+            if rule.numeric:
+                if isinstance(v, bool) or not isinstance(v, (int, float)) or math.isnan(v):
+                    continue
+            if t is None:
+                t = lp_time(point.get('time'))
+                tags = point.get('tags')
+                key = (NAME, point['measurement'], tuple(sorted(tags.items())) if tags else ())
+            with self.lock:
+                s = rule.states.get(key)
+                if s is None:
+                    s = rule.states[key] = AlarmState()
+                active = rule.check(s, v, t)
+                s.value = v
+                s.time = t
+                changes = self.transition(rule, s, active)
+            if changes is not None:
+                self.raise_event(rule, self.event(rule, key, active, v, t, changes))
+
+    def transition(self, rule, s, active):
+        # The number of changes to report with the state active, or None
+        # while there is nothing to report, or the holdoff holds it back
+        if active != s.active:
+            s.active = active
+            s.changes += 1
+        if s.active == s.reported:
+            return None
+        now = time.monotonic()
+        if now - s.reported_at < rule.holdoff:
+            return None
+        s.reported = s.active
+        s.reported_at = now
+        changes = s.changes
+        s.changes = 0
+        return changes
+
+    def event(self, rule, key, active, v, t, changes):
+        name, measurement, tags = key
+        return {
+            "alarm": rule.name,
+            "state": "raised" if active else "cleared",
+            "instrument": name,
+            "measurement": measurement,
+            "tags": dict(tags),
+            "field": rule.field,
+            "value": v,
+            "time": t,
+            "changes": changes
+        }
+
+    def stale_loop(self, INTERVAL=1.0):
+        while True:
+            time.sleep(INTERVAL)
+            now = time.monotonic()
+            events = []
+            with self.lock:
+                for rule in self.stale:
+                    for key, s in rule.states.items():
+                        active = now - s.arrived >= rule.stale
+                        changes = self.transition(rule, s, active)
+                        if changes is not None:
+                            events.append((rule, self.event(rule, key, active, s.value, s.time, changes)))
+            for rule, event in events:
+                self.raise_event(rule, event)
+
+    def raise_event(self, rule, event):
+        logging.warning("Alarm %s %s: %s %s = %s" % (event['alarm'], event['state'], event['instrument'], event['field'], event['value']))
+        if event['state'] == 'raised':
+            masermetrics.alarms.labels(rule.name).inc()
+        try:
+            self.events.put_nowait((rule, event))
+        except queue.Full:
+            logging.error("Alarm hooks behind, %s not run" % event['alarm'])
+
+    def hook_loop(self):
+        while True:
+            rule, event = self.events.get()
+            body = json.dumps(event)
+            command = rule.exec or self.exec
+            path = rule.socket or self.socket
+            if path:
+                try:
+                    self.sock.sendto(body.encode('utf-8'), path)
+                except OSError as e:
+                    logging.error("Alarm socket %s: %s" % (path, e))
+            if command:
+                self.run(command, event, body)
+
+    def run(self, command, event, body):
+        env = dict(os.environ,
+                   MASERMON_ALARM=event['alarm'],
+                   MASERMON_STATE=event['state'],
+                   MASERMON_INSTRUMENT=event['instrument'],
+                   MASERMON_FIELD=event['field'],
+                   MASERMON_VALUE=str(event['value']))
+        args = shlex.split(command) if isinstance(command, str) else list(command)
+        try:
+            subprocess.run(args, input=body.encode('utf-8'), env=env, timeout=self.timeout, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error("Alarm hook %s: %s" % (command, e))
+
+    def active(self):
+        # The active alarms as (name, instrument, measurement, tags)
+        with self.lock:
+            return [(r.name,) + key for r in self.rules for key, s in r.states.items() if s.active]
+
+# Alarm engine, None while no alarms are set
+engine = None
+
+def start(RULES, EXEC=None, SOCKET=None, HOLDOFF=60):
+    global engine
+    engine = AlarmEngine(RULES, EXEC, SOCKET, HOLDOFF)
+
+# Writer stage of one instrument, checking its points before passing them
+# on to WRITER
+class AlarmStage:
+    def __init__(self, WRITER, NAME, TYPE):
+        self.writer = WRITER
+        self.name = NAME
+        self.type = TYPE
+        # measurement -> rules
+        self.rules = {}
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def write_points(self, points):
+        for p in points:
+            rules = self.rules.get(p['measurement'])
+            if rules is None:
+                rules = self.rules[p['measurement']] = engine.rules_of(self.name, self.type, p['measurement'])
+            if rules:
+                try:
+                    engine.check(self.name, rules, p)
+                except Exception:
+                    logging.exception("%s: alarm check failed" % self.name)
+        return self.writer.write_points(points)
+
+def stage(NAME, TYPE, WRITER):
+    # WRITER, checking the alarm rules when there are any
+    if engine is None:
+        return WRITER
+    return AlarmStage(WRITER, NAME, TYPE)
@@ -0,0 +1,303 @@
+import logging
+import os
+import re
+import threading
+import time
+from maserwriter import lp_time, TeeWriter
+
+# Local columnar archive of the acquired points, alongside or instead of
+# InfluxDB, for analysis of long series without the database. Points are
+# batched in memory per measurement and instrument type, and every flush
+# writes them as complete files DIR/<measurement>/<type>/<period>/part-<n>
+# .parquet, a period being an hour YYYYmmddTHH (ROLL "hour") or day
+# YYYYmmdd (ROLL "day"), or .arrow for Arrow IPC files (FORMAT "arrow"),
+# which can be memory-mapped. Files are written under a temporary name and
+# renamed when complete, so a process killed or restarted at any time
+# leaves only readable files, losing at most the points not yet flushed.
+#
+# The columns of a type in a measurement are fixed, so all its files have
+# the same schema and a type directory reads as one dataset, e.g. with
+# pyarrow.dataset: time (ns, UTC), the tags as strings and the fields, as
+# given by the driver (see instrument()), e.g. from the EFOS-B channel map.
+# Fields not in it are left out with a warning. For a type without a
+# schema the columns are taken from its first points. Once a period is over, and on
+# close(), its part files are merged into one, part-<first>-<last>, and
+# parts left by a merge interrupted before removing them are removed when
+# the directory is next written.
+class ColumnarWriter:
+    rolls = {
+        'hour': (3600, "%Y%m%dT%H"),
+        'day': (86400, "%Y%m%d"),
+    }
+    part = re.compile(r'part-(\d+)(?:-(\d+))?\.(parquet|arrow)$')
+
+    def __init__(self, DIR, FORMAT='parquet', ROLL='hour', BATCHROWS=10000, FLUSHINTERVAL=60.0):
+        import pyarrow
+        self.pa = pyarrow
+        if FORMAT == 'parquet':
+            import pyarrow.parquet
+        elif FORMAT == 'arrow':
+            import pyarrow.ipc
+        else:
+            raise ValueError("Unknown columnar format %s" % FORMAT)
+        if ROLL not in self.rolls:
+            raise ValueError("Unknown columnar roll %s" % ROLL)
+        self.dir = DIR
+        self.format = FORMAT
+        self.period = self.rolls[ROLL][0] * 1000000000
+        self.pattern = self.rolls[ROLL][1]
+        self.batchrows = BATCHROWS
+        self.flushinterval = FLUSHINTERVAL
+        self.types = {
+            'float': pyarrow.float64(),
+            'int': pyarrow.int64(),
+            'bool': pyarrow.bool_(),
+            'string': pyarrow.string(),
+        }
+        # (measurement, type) -> (tags, [(field, type)])
+        self.schemas = {}
+        # (measurement, type) -> [(time ns, tags, fields)]
+        self.rows = {}
+        self.pending = 0
+        # Next part number per period directory
+        self.parts = {}
+        # Period directories with parts to merge -> end of the period (ns)
+        self.unmerged = {}
+        self.warned = set()
+        self.rows_written = 0
+        self.files_written = 0
+        self.lock = threading.Lock()
+        # Held while writing files, by the flush thread or close()
+        self.writing = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.running = True
+        self.thread = threading.Thread(target=self.flush_loop, name="columnar", daemon=True)
+        self.thread.start()
+
+    def add_retention_policy(self, name, duration):
+        pass
+
+    def instrument(self, TYPE, MEASUREMENT, SCHEMA=None):
+        # The writer of the points of a TYPE instrument, with the columns of
+        # SCHEMA in MEASUREMENT, (tags, [(field, type)]), type float, int,
+        # bool or string
+        if SCHEMA is not None:
+            tags, fields = SCHEMA
+            for name, kind in fields:
+                if kind not in self.types:
+                    raise ValueError("Unknown columnar type %s of %s" % (kind, name))
+            with self.lock:
+                self.schemas[(MEASUREMENT, TYPE)] = (list(tags), list(fields))
+        return ColumnarInstrument(self, TYPE)
+
+    def write_points(self, points, TYPE='other'):
+        with self.lock:
+            for p in points:
+                self.rows.setdefault((p['measurement'], TYPE), []).append((lp_time(p.get('time')), p.get('tags') or {}, p['fields']))
+            self.pending += len(points)
+            if self.pending >= self.batchrows:
+                self.cond.notify()
+        return True
+
+    def take_rows(self):
+        with self.lock:
+            rows = self.rows
+            self.rows = {}
+            self.pending = 0
+        return rows
+
+    def flush_loop(self):
+        # The files are only written from here, and by close(), so
+        # acquisition only waits for the buffering
+        while self.running:
+            with self.lock:
+                self.cond.wait(self.flushinterval)
+            try:
+                with self.writing:
+                    written = self.flush(self.take_rows())
+                    now = time.time_ns()
+                    self.merge([d for d, end in self.unmerged.items() if end <= now and d not in written])
+            except Exception:
+                logging.exception("Columnar archive write failed")
+
+    def infer(self, rows):
+        # Schema of a type without one, from its first rows
+        tags = []
+        kinds = {}
+        for t, ptags, fields in rows:
+            for k in ptags:
+                if k not in tags:
+                    tags.append(k)
+            for k, v in fields.items():
+                if v is None:
+                    continue
+                kind = ('bool' if isinstance(v, bool) else 'int' if isinstance(v, int) else
+                        'float' if isinstance(v, float) else 'string')
+                if k not in kinds or kinds[k] == 'int' and kind == 'float':
+                    kinds[k] = kind
+        return (tags, list(kinds.items()))
+
+    def column(self, kind, values):
+        # Values not of the column type are left out
+        if kind == 'float':
+            values = [float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else None for v in values]
+        elif kind == 'int':
+            values = [v if isinstance(v, int) and not isinstance(v, bool) else None for v in values]
+        elif kind == 'bool':
+            values = [v if isinstance(v, bool) else None for v in values]
+        else:
+            values = [None if v is None else str(v) for v in values]
+        return self.pa.array(values, type=self.types[kind])
+
+    def table(self, key, rows):
+        pa = self.pa
+        tagnames, fields = self.schemas[key]
+        known = set(tagnames) | set(name for name, kind in fields)
+        extra = set(k for t, tags, f in rows for k in list(tags) + list(f)) - known
+        if extra - self.warned:
+            logging.warning("Columnar archive: %s %s columns %s not written" % (key + (sorted(extra - self.warned),)))
+            self.warned |= extra
+        columns = [pa.array([t for t, tags, f in rows], type=pa.timestamp('ns', tz='UTC'))]
+        names = ['time']
+        for k in tagnames:
+            columns.append(pa.array([None if tags.get(k) is None else str(tags[k]) for t, tags, f in rows], type=pa.string()))
+            names.append(k)
+        for k, kind in fields:
+            columns.append(self.column(kind, [f.get(k) for t, tags, f in rows]))
+            # A field named as a tag is <name>_1, as InfluxDB returns it
+            names.append(k + "_1" if k in tagnames else k)
+        return pa.Table.from_arrays(columns, names=names)
+
+    def period_dir(self, measurement, type, period):
+        d = os.path.join(self.dir, measurement, type, time.strftime(self.pattern, time.gmtime(period // 1000000000)))
+        if d not in self.parts:
+            # Continue after the parts of an earlier run
+            os.makedirs(d, exist_ok=True)
+            self.parts[d] = max((last for path, first, last in self.part_files(d)), default=-1) + 1
+        return d
+
+    def part_files(self, d):
+        # The (path, first, last) of the parts in d, removing those left by
+        # an interrupted merge, which are in the range of a merged one
+        parts = []
+        for f in os.listdir(d):
+            m = self.part.match(f)
+            if m:
+                first = int(m.group(1))
+                parts.append((os.path.join(d, f), first, int(m.group(2) or first)))
+        kept = []
+        for p in parts:
+            if any(q is not p and q[1] <= p[1] and p[2] <= q[2] and q[2] - q[1] > p[2] - p[1] for q in parts):
+                os.unlink(p[0])
+            else:
+                kept.append(p)
+        return sorted(kept, key=lambda p: p[1])
+
+    def write_file(self, path, table):
+        tmp = os.path.join(os.path.dirname(path), ".%s.tmp" % os.path.basename(path))
+        if self.format == 'parquet':
+            self.pa.parquet.write_table(table, tmp)
+        else:
+            with self.pa.OSFile(tmp, 'wb') as sink:
+                with self.pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        os.replace(tmp, path)
+        self.files_written += 1
+
+    def read_file(self, path):
+        if self.format == 'parquet':
+            return self.pa.parquet.read_table(path)
+        with self.pa.memory_map(path) as source:
+            return self.pa.ipc.open_file(source).read_all()
+
+    def flush(self, rows):
+        # Returns the period directories written
+        written = set()
+        for (measurement, type), mrows in rows.items():
+            if (measurement, type) not in self.schemas:
+                logging.warning("Columnar archive: no schema for %s %s, columns from its first points" % (measurement, type))
+                self.schemas[(measurement, type)] = self.infer(mrows)
+            mrows.sort(key=lambda r: r[0])
+            i = 0
+            while i < len(mrows):
+                # Runs of rows in one period
+                period = mrows[i][0] - mrows[i][0] % self.period
+                j = i + 1
+                while j < len(mrows) and mrows[j][0] - mrows[j][0] % self.period == period:
+                    j += 1
+                d = self.period_dir(measurement, type, period)
+                n = self.parts[d]
+                self.parts[d] += 1
+                self.write_file(os.path.join(d, "part-%i.%s" % (n, self.format)), self.table((measurement, type), mrows[i:j]))
+                self.unmerged[d] = period + self.period
+                written.add(d)
+                self.rows_written += j - i
+                i = j
+        return written
+
+    def merge(self, dirs):
+        # Merges the parts of each of dirs into one file
+        for d in dirs:
+            del self.unmerged[d]
+            parts = self.part_files(d)
+            if len(parts) < 2:
+                continue
+            try:
+                table = self.pa.concat_tables([self.read_file(p[0]) for p in parts]).sort_by('time')
+            except self.pa.ArrowInvalid as e:
+                # Such as parts of an earlier run with other columns
+                logging.warning("Columnar archive: %s not merged: %s" % (d, e))
+                continue
+            self.write_file(os.path.join(d, "part-%i-%i.%s" % (parts[0][1], parts[-1][2], self.format)), table)
+            for p in parts:
+                os.unlink(p[0])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rows_pending": self.pending,
+                "rows_written": self.rows_written,
+                "files_written": self.files_written
+            }
+
+    def close(self, TIMEOUT=10):
+        with self.lock:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(TIMEOUT)
+        with self.writing:
+            self.flush(self.take_rows())
+            self.merge(list(self.unmerged))
+
+# Writer of the points of one instrument type to a ColumnarWriter
+class ColumnarInstrument:
+    def __init__(self, ARCHIVE, TYPE):
+        self.archive = ARCHIVE
+        self.type = TYPE
+
+    def add_retention_policy(self, name, duration):
+        pass
+
+    def write_points(self, points):
+        return self.archive.write_points(points, self.type)
+
+    def stats(self):
+        return self.archive.stats()
+
+    def close(self, TIMEOUT=10):
+        # The archive is closed by its owner
+        pass
+
+# Archive of the instruments, None while it is disabled
+archive = None
+
+def start(DIR, FORMAT='parquet', ROLL='hour'):
+    global archive
+    archive = ColumnarWriter(DIR, FORMAT, ROLL)
+
+def stage(TYPE, MEASUREMENT, SCHEMA, WRITER):
+    # WRITER, also archiving the points of a TYPE instrument when the
+    # archive is enabled
+    if archive is None:
+        return WRITER
+    return TeeWriter(WRITER, archive.instrument(TYPE, MEASUREMENT, SCHEMA))
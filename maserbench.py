@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark. Each instrument loop of masermon is run in a process
+# of its own against its masersim simulator, writing to a local stand-in
+# for the InfluxDB HTTP API, and samples/s, cycle time percentiles, CPU use
+# and resident memory are reported per instrument.
+#
+#   python3 maserbench.py --duration 30 efosb hp5071a ticcts
+#
+# With --startup the cold start of each instrument is measured instead, see
+# startup().
+#
+#   python3 maserbench.py --startup --budgetms 1500 --budgetrss 60
+
+import http.server
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import click
+import masersim
+
+# Stand-in InfluxDB, accepts every query and counts written lines
+class InfluxSink(http.server.BaseHTTPRequestHandler):
+    lines = 0
+    requests = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.startswith('/write'):
+            InfluxSink.lines += body.count(b'\n')
+            InfluxSink.requests += 1
+            self.send_response(204)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"results":[{"statement_id":0}]}')
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+def sink_start():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), InfluxSink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Writer wrapper recording when each sample is handed over
+class BenchWriter:
+    def __init__(self, WRITER):
+        self.writer = WRITER
+        self.times = []
+        self.samples = 0
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def write_points(self, points):
+        self.times.append(time.monotonic())
+        self.samples += len(points)
+        return self.writer.write_points(points)
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def child(instrument, device, baudrate, port, lograte, duration, results):
+    # Runs in its own process so CPU and memory are per instrument
+    import masermon
+    from maserwriter import InfluxWriter
+    writer = BenchWriter(InfluxWriter('127.0.0.1', port, 'bench', SSL=False))
+    process, argnames = masermon.driver(instrument)['process']
+    settings = dict(masermon.instrument_defaults, maserid='bench_' + instrument,
+                    device=device, baudrate=baudrate, lograte=lograte)
+    args = [settings.get(a) for a in argnames]
+    threading.Thread(target=process, args=[writer] + args, daemon=True).start()
+    # Leave the start up, syncing and identification, out of the figures
+    time.sleep(min(2.0, duration / 4))
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.monotonic()
+    n0 = writer.samples
+    i0 = len(writer.times)
+    time.sleep(duration)
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    elapsed = time.monotonic() - t0
+    times = writer.times[i0:]
+    cycles = [(b - a) * 1000 for a, b in zip(times, times[1:])]
+    writer.close(2)
+    results.put({
+        'instrument': instrument,
+        'samples': writer.samples - n0,
+        'rate': (writer.samples - n0) / elapsed,
+        'p50': percentile(cycles, 50),
+        'p90': percentile(cycles, 90),
+        'p99': percentile(cycles, 99),
+        'cpu': 100.0 * (end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime) / elapsed,
+        'rss': rss_mb(),
+    })
+
+# Start-up cost of an instrument process, as after a systemd restart: a new
+# interpreter imports masermon and the instrument driver. The median wall
+# time to there of REPEAT runs, and the largest resident memory.
+startup_code = "import resource, masermon; masermon.driver(%r); print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+def startup(instrument, repeat):
+    times = []
+    rss = []
+    for i in range(repeat):
+        t0 = time.monotonic()
+        out = subprocess.run([sys.executable, '-c', startup_code % instrument], capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append((time.monotonic() - t0) * 1000)
+        rss.append(int(out.stdout.split()[-1]) / 1024.0)
+    return {
+        'instrument': instrument,
+        'startup': statistics.median(times),
+        'rss': max(rss),
+    }
+
+def startup_report(instruments, repeat, budgetms, budgetrss, as_json):
+    report = [startup(i, repeat) for i in instruments]
+    over = [r['instrument'] for r in report if r['startup'] > budgetms or r['rss'] > budgetrss]
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("%-10s %10s %8s" % ("instrument", "start ms", "RSS MB"))
+        for r in report:
+            print("%-10s %10.1f %8.1f" % (r['instrument'], r['startup'], r['rss']))
+        print("Budget %.0f ms, %.0f MB: %s" % (budgetms, budgetrss, "exceeded by " + ' '.join(over) if over else "met"))
+    sys.exit(1 if over else 0)
+
+@click.command()
+@click.argument('instruments', nargs=-1)
+@click.option('--duration', default=20.0, help="Measured run time per instrument in seconds (default 20 s)")
+@click.option('--lograte', default=1.0, help="Log-rate of the polled instruments in seconds (default 1 s)")
+@click.option('--realtime/--fast', default=True, help="Pace the simulators to the instrument baud rate (default realtime)")
+@click.option('--latency', default=0.0, help="Simulator reply latency in seconds (default 0)")
+@click.option('--noise', default=0.0, help="Simulator fraction of corrupted replies (default 0)")
+@click.option('--dropout', default=0.0, help="Simulator fraction of dropped replies (default 0)")
+@click.option('--ticcrate', default=1000.0, help="TICC events per second (default 1000)")
+@click.option('--json', 'as_json', is_flag=True, help="Print results as JSON")
+@click.option('--startup', 'startup_only', is_flag=True, help="Measure the instrument start-up time and memory instead, exit status 1 if over budget")
+@click.option('--repeat', default=5, help="Start-up runs per instrument (default 5)")
+@click.option('--budgetms', default=1500.0, help="Start-up time budget in ms (default 1500)")
+@click.option('--budgetrss', default=60.0, help="Start-up resident memory budget in MB (default 60)")
+def main(instruments, duration, lograte, realtime, latency, noise, dropout, ticcrate, as_json, startup_only, repeat, budgetms, budgetrss):
+    "Benchmark masermon instrument loops against simulators"
+    if startup_only:
+        import masermon
+        unknown = [i for i in instruments if not masermon.driver_known(i)]
+        if unknown:
+            raise click.UsageError("Unknown instrument type %s" % ' '.join(unknown))
+        startup_report(instruments or sorted(masermon.builtin_drivers), repeat, budgetms, budgetrss, as_json)
+    # Only instruments with a simulator, not e.g. the I2C bme280
+    unknown = [i for i in instruments if i not in masersim.simulators]
+    if unknown:
+        raise click.UsageError("No simulator for %s, choose from %s" % (' '.join(unknown), ' '.join(sorted(masersim.simulators))))
+    if not instruments:
+        instruments = sorted(masersim.simulators)
+    server = sink_start()
+    port = server.server_address[1]
+    results = multiprocessing.Queue()
+    report = []
+    for instrument in instruments:
+        baudrate = masersim.baudrates[instrument]
+        kwargs = {'RATE': ticcrate} if instrument == 'ticcts' else {}
+        sim = masersim.simulators[instrument](None, baudrate if realtime else 10 ** 9,
+                                               latency, noise, dropout, SEED=1, **kwargs)
+        device = sim.start()
+        p = multiprocessing.Process(target=child, args=(instrument, device, baudrate, port, lograte, duration, results))
+        p.start()
+        report.append(results.get(timeout=duration + 60))
+        p.join(10)
+        if p.is_alive():
+            p.terminate()
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    print("%-10s %8s %10s %9s %9s %9s %6s %8s" % ("instrument", "samples", "samples/s", "p50 ms", "p90 ms", "p99 ms", "CPU %", "RSS MB"))
+    for r in report:
+        print("%-10s %8i %10.1f %9.2f %9.2f %9.2f %6.1f %8.1f" % (r['instrument'], r['samples'], r['rate'], r['p50'], r['p90'], r['p99'], r['cpu'], r['rss']))
+    print("InfluxDB sink: %i lines in %i requests" % (InfluxSink.lines, InfluxSink.requests))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import logging
+import struct
+import time
+from masersched import Ticker, midpoint_ns
+import masermetrics
+import masercapture
+try:
+    from smbus2 import SMBus
+except ImportError:
+    from smbus import SMBus
+
+# masermon driver for Environ+ BME280 environment sensors
+
+# BME280 (and BMP280, without humidity) register level driver. The
+# calibration is read once, each sample is one burst read of the pressure,
+# temperature and humidity registers 0xF7..0xFE, compensated in one pass
+# with the floating point formulas of the datasheet. In forced mode every
+# sample is triggered and the result read after the maximum measurement
+# time, in normal mode the sensor measures continuously every STANDBY ms
+# and the latest result is read. OVERSAMPLING is (temperature, pressure,
+# humidity), 0 skips that measurement, FILTER the IIR filter coefficient.
+bme280_oversampling = {0: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+bme280_filter = {0: 0, 2: 1, 4: 2, 8: 3, 16: 4}
+bme280_standby = {0.5: 0, 62.5: 1, 125: 2, 250: 3, 500: 4, 1000: 5, 10: 6, 20: 7}
+bme280_modes = {'sleep': 0, 'forced': 1, 'normal': 3}
+bme280_chipids = {0x60: 'bme280', 0x58: 'bmp280'}
+
+class Bme280:
+    def __init__(self, bus, ADDRESS=0x76, MODE='forced', OVERSAMPLING=(1, 1, 1), FILTER=0, STANDBY=62.5):
+        if MODE not in ('forced', 'normal'):
+            raise ValueError("Unknown BME280 mode %s" % MODE)
+        osrs_t, osrs_p, osrs_h = [bme280_oversampling[int(o)] for o in OVERSAMPLING]
+        self.bus = bus
+        self.address = ADDRESS
+        self.mode = MODE
+        chipid = bus.read_i2c_block_data(ADDRESS, 0xD0, 1)[0]
+        if chipid not in bme280_chipids:
+            raise IOError("No BME280 at 0x%02x, chip id 0x%02x" % (ADDRESS, chipid))
+        self.humidity = chipid == 0x60 and osrs_h > 0
+        # Soft reset, then the settings while in sleep mode
+        bus.write_i2c_block_data(ADDRESS, 0xE0, [0xB6])
+        time.sleep(0.005)
+        c = bytes(bus.read_i2c_block_data(ADDRESS, 0x88, 26))
+        (self.t1, self.t2, self.t3, self.p1, self.p2, self.p3, self.p4, self.p5,
+         self.p6, self.p7, self.p8, self.p9) = struct.unpack('<HhhHhhhhhhhh', c[:24])
+        self.h1 = c[25]
+        if chipid == 0x60:
+            h = bytes(bus.read_i2c_block_data(ADDRESS, 0xE1, 7))
+            self.h2, self.h3 = struct.unpack('<hB', h[:3])
+            self.h4 = (struct.unpack('b', h[3:4])[0] << 4) | (h[4] & 0x0F)
+            self.h5 = (struct.unpack('b', h[5:6])[0] << 4) | (h[4] >> 4)
+            self.h6 = struct.unpack('b', h[6:7])[0]
+            bus.write_i2c_block_data(ADDRESS, 0xF2, [osrs_h])
+        bus.write_i2c_block_data(ADDRESS, 0xF5, [(bme280_standby[STANDBY] << 5) | (bme280_filter[int(FILTER)] << 2)])
+        self.ctrl_meas = (osrs_t << 5) | (osrs_p << 2)
+        self.measure_t = osrs_t > 0
+        self.measure_p = osrs_p > 0
+        # Maximum measurement time, datasheet 9.1
+        self.delay = (1.25 + 2.3 * OVERSAMPLING[0]
+                      + (2.3 * OVERSAMPLING[1] + 0.575 if osrs_p else 0)
+                      + (2.3 * OVERSAMPLING[2] + 0.575 if self.humidity else 0)) / 1000
+        if MODE == 'normal':
+            bus.write_i2c_block_data(ADDRESS, 0xF4, [self.ctrl_meas | bme280_modes['normal']])
+        else:
+            bus.write_i2c_block_data(ADDRESS, 0xF4, [self.ctrl_meas])
+
+    def trigger(self):
+        # Start a forced mode measurement, which takes up to self.delay
+        if self.mode == 'forced':
+            self.bus.write_i2c_block_data(self.address, 0xF4, [self.ctrl_meas | bme280_modes['forced']])
+
+    def read(self):
+        return self.compensate(self.bus.read_i2c_block_data(self.address, 0xF7, 8))
+
+    def compensate(self, d):
+        # Fields of a 0xF7..0xFE burst: Pressure in Pa, Temp in C and
+        # Humidity in %. Temperature is needed for the other two.
+        fields = {}
+        if not self.measure_t:
+            return fields
+        adc_t = (d[3] << 12) | (d[4] << 4) | (d[5] >> 4)
+        var1 = (adc_t / 16384.0 - self.t1 / 1024.0) * self.t2
+        var2 = adc_t / 131072.0 - self.t1 / 8192.0
+        t_fine = var1 + var2 * var2 * self.t3
+        fields["Temp"] = t_fine / 5120.0
+        if self.measure_p:
+            adc_p = (d[0] << 12) | (d[1] << 4) | (d[2] >> 4)
+            var1 = t_fine / 2.0 - 64000.0
+            var2 = var1 * var1 * self.p6 / 32768.0 + var1 * self.p5 * 2.0
+            var2 = var2 / 4.0 + self.p4 * 65536.0
+            var1 = (self.p3 * var1 * var1 / 524288.0 + self.p2 * var1) / 524288.0
+            var1 = (1.0 + var1 / 32768.0) * self.p1
+            if var1 != 0:
+                p = (1048576.0 - adc_p - var2 / 4096.0) * 6250.0 / var1
+                fields["Pressure"] = p + (self.p9 * p * p / 2147483648.0 + p * self.p8 / 32768.0 + self.p7) / 16.0
+        if self.humidity:
+            adc_h = (d[6] << 8) | d[7]
+            var1 = t_fine - 76800.0
+            h = (adc_h - (self.h4 * 64.0 + self.h5 / 16384.0 * var1)) * (
+                self.h2 / 65536.0 * (1.0 + self.h6 / 67108864.0 * var1 * (1.0 + self.h3 / 67108864.0 * var1)))
+            h = h * (1.0 - self.h1 * h / 524288.0)
+            fields["Humidity"] = max(0.0, min(100.0, h))
+        return fields
+
+# The BME280 sensors at ADDRESSES on one SMBus
+def bme280_sensors(bus, ADDRESSES=None, MODE='forced', OVERSAMPLING=None, FILTER=0, STANDBY=62.5):
+    # Settings from a site configuration may be a single address and
+    # oversampling as "T,P,H"
+    if isinstance(ADDRESSES, int):
+        ADDRESSES = [ADDRESSES]
+    if isinstance(OVERSAMPLING, str):
+        OVERSAMPLING = [int(o) for o in OVERSAMPLING.split(',')]
+    return [Bme280(bus, a, MODE or 'forced', OVERSAMPLING or (1, 1, 1), FILTER or 0, STANDBY or 62.5)
+            for a in (ADDRESSES or [0x76])]
+
+def bme280_points(MASERID, sensors, timestamp, samples):
+    # With several sensors the points are tagged with the sensor address
+    points = []
+    for s, fields in zip(sensors, samples):
+        if not fields:
+            continue
+        tags = {
+            "masertype": "bme280"
+        }
+        if len(sensors) > 1:
+            tags["sensor"] = "0x%02x" % s.address
+        points.append({"measurement": MASERID, "tags": tags, "time": timestamp, "fields": fields})
+    return points
+
+# All sensors on the bus are sampled from one schedule: in forced mode all
+# are triggered, then all read after the longest measurement time, so a
+# sample costs one write and one burst read per sensor and one wait.
+def environplus_process(WRITER, MASERID, LOGRATE, BUS=1, ADDRESSES=None, MODE='forced', OVERSAMPLING=None, FILTER=0, STANDBY=62.5):
+        bus = masercapture.i2c_bus('bme280', MASERID, SMBus(BUS or 1), BUS or 1,
+                                   addresses=ADDRESSES, mode=MODE, oversampling=OVERSAMPLING, filter=FILTER, standby=STANDBY)
+        sensors = bme280_sensors(bus, ADDRESSES, MODE, OVERSAMPLING, FILTER, STANDBY)
+        delay = max(s.delay for s in sensors) if MODE != 'normal' else 0
+        name = "BME280 %s" % MASERID
+        ticker = Ticker(LOGRATE, name)
+        while True:
+            ticker.wait()
+            started = time.time_ns()
+            with masermetrics.sweep_seconds.labels(name).time():
+                failed = set()
+                for s in sensors:
+                    try:
+                        s.trigger()
+                    except OSError as e:
+                        logging.error("%s: sensor 0x%02x: %s" % (name, s.address, e))
+                        failed.add(s)
+                if delay:
+                    time.sleep(delay)
+                samples = []
+                for s in sensors:
+                    try:
+                        samples.append(None if s in failed else s.read())
+                    except OSError as e:
+                        logging.error("%s: sensor 0x%02x: %s" % (name, s.address, e))
+                        failed.add(s)
+                        samples.append(None)
+            masermetrics.errors.labels(name).inc(len(failed))
+            timestamp = midpoint_ns(started)
+            json_body = bme280_points(MASERID, sensors, timestamp, samples)
+            if json_body:
+                masermetrics.samples.labels(name).inc(len(json_body))
+                WRITER.write_points(json_body)
+
+def environplus_replay(MASERID, RECORDS, ADDRESSES=None, MODE='forced', OVERSAMPLING=None, FILTER=0, STANDBY=62.5):
+    bus = masercapture.ReplayBus(RECORDS)
+    try:
+        sensors = bme280_sensors(bus, ADDRESSES, MODE, OVERSAMPLING, FILTER, STANDBY)
+    except EOFError:
+        return
+    while True:
+        bus.reset()
+        try:
+            for s in sensors:
+                s.trigger()
+            samples = [s.read() for s in sensors]
+        except EOFError:
+            return
+        yield from bme280_points(MASERID, sensors, (bus.first + bus.last) // 2, samples)
+
+def bme280_schema():
+    return ["masertype", "sensor"], [("Temp", 'float'), ("Pressure", 'float'), ("Humidity", 'float')]
+
+driver = {
+    'process': (environplus_process, ('maserid', 'lograte', 'bus', 'addresses', 'mode', 'oversampling', 'filter', 'standby')),
+    'replay': (environplus_replay, ('addresses', 'mode', 'oversampling', 'filter', 'standby')),
+    'schema': (bme280_schema, ()),
+}
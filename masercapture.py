@@ -0,0 +1,226 @@
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Raw capture of the instrument byte streams, for decoding again later with
+# corrected constants, and as realistic load for testing. Each instrument
+# link started while capture is enabled writes one log file
+# DIR/<maserid>-<type>-<UTC start>.mcap: a header, MAGIC, the length and
+# JSON of the metadata (type, maserid, device, ...), followed by records
+# of a fixed head, the wall clock and monotonic time in ns, the data length
+# and the kind of record, and the data. Logs are read through mmap, records
+# are handed out as memoryviews into it.
+MAGIC = b'MASERCAP1\n'
+head = struct.Struct('<qqIB3x')
+
+READ = 0
+WRITE = 1
+I2C_READ = 2
+I2C_WRITE = 3
+MARK = 4
+
+FLUSHINTERVAL = 1.0
+
+# Capture directory, None while capture is disabled
+directory = None
+
+def start(DIR):
+    global directory
+    os.makedirs(DIR, exist_ok=True)
+    directory = DIR
+
+class CaptureLog:
+    def __init__(self, PATH, META):
+        self.path = PATH
+        self.file = open(PATH, 'wb')
+        meta = json.dumps(META).encode('utf-8')
+        self.file.write(MAGIC + struct.pack('<I', len(meta)) + meta)
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+
+    def record(self, kind, data):
+        if not data:
+            return
+        wall = time.time_ns()
+        mono = time.monotonic_ns()
+        with self.lock:
+            self.file.write(head.pack(wall, mono, len(data), kind))
+            self.file.write(data)
+            if mono / 1e9 - self.flushed > FLUSHINTERVAL:
+                self.file.flush()
+                self.flushed = mono / 1e9
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def open_log(TYPE, MASERID, **META):
+    name = "%s-%s-%s.mcap" % (MASERID, TYPE, time.strftime("%Y%m%dT%H%M%S", time.gmtime()))
+    return CaptureLog(os.path.join(directory, name), dict(META, type=TYPE, maserid=MASERID, start=time.time_ns()))
+
+# Serial port wrapper recording what is read and written
+class CaptureSerial:
+    def __init__(self, ser, log):
+        self.ser = ser
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        # Settings such as timeout go to the port
+        if name in ('ser', 'log'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.ser, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self.log.record(READ, data)
+        return data
+
+    def readline(self, *args):
+        data = self.ser.readline(*args)
+        self.log.record(READ, data)
+        return data
+
+    def write(self, data):
+        self.log.record(WRITE, data)
+        return self.ser.write(data)
+
+    def close(self):
+        self.ser.close()
+        self.log.close()
+
+# Mark a sample boundary in the capture of ser, when it is captured, for
+# replays that cannot tell the samples apart from the traffic alone
+def mark(ser, data):
+    if isinstance(ser, CaptureSerial):
+        ser.log.record(MARK, data)
+
+def serial_port(TYPE, MASERID, ser, **META):
+    # ser, recorded when capture is enabled, with META in the log header
+    if directory is None:
+        return ser
+    return CaptureSerial(ser, open_log(TYPE, MASERID, device=ser.port, baudrate=ser.baudrate, **META))
+
+# SMBus wrapper recording block reads and writes, as the address and
+# register followed by the data
+class CaptureBus:
+    def __init__(self, bus, log):
+        self.bus = bus
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def read_i2c_block_data(self, addr, register, length, *args):
+        data = self.bus.read_i2c_block_data(addr, register, length, *args)
+        self.log.record(I2C_READ, bytes([addr, register]) + bytes(data))
+        return data
+
+    def write_i2c_block_data(self, addr, register, data, *args):
+        self.log.record(I2C_WRITE, bytes([addr, register]) + bytes(data))
+        return self.bus.write_i2c_block_data(addr, register, data, *args)
+
+def i2c_bus(TYPE, MASERID, bus, BUSNR, **META):
+    # bus, recorded when capture is enabled, META such as the sensor
+    # settings goes into the log header
+    if directory is None:
+        return bus
+    return CaptureBus(bus, open_log(TYPE, MASERID, bus=BUSNR, **META))
+
+# A capture log opened for reading, meta is the header metadata, and
+# records() yields (kind, wall ns, monotonic ns, data memoryview)
+class Capture:
+    def __init__(self, PATH):
+        self.path = PATH
+        with open(PATH, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a masermon capture" % PATH)
+        n = struct.unpack_from('<I', self.map, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        self.meta = json.loads(self.map[start:start + n].decode('utf-8'))
+        self.start = start + n
+
+    def records(self):
+        view = memoryview(self.map)
+        pos = self.start
+        end = len(self.map)
+        while pos + head.size <= end:
+            wall, mono, n, kind = head.unpack_from(self.map, pos)
+            pos += head.size
+            if pos + n > end:
+                # Cut short while written
+                break
+            yield kind, wall, mono, view[pos:pos + n]
+            pos += n
+
+# Request/response exchanges of a capture, as (request, wall ns of the
+# request, wall ns of the last response data, response) per write, with
+# all data read until the following write as the response
+def exchanges(records):
+    request = None
+    for kind, wall, mono, data in records:
+        if kind == WRITE:
+            if request is not None:
+                yield request
+            request = [bytes(data), wall, wall, b'']
+        elif kind == READ and request is not None:
+            request[2] = wall
+            request[3] += data
+    if request is not None:
+        yield request
+
+# SMBus stand-in answering block reads from the I2C_READ records of a
+# capture, and taking writes from the I2C_WRITE records, in order per
+# address and register, so the sensors of a bus may be read in any order.
+# EOFError at the end of the capture. first and last are the wall clock
+# times of the reads and writes since reset().
+class ReplayBus:
+    def __init__(self, records):
+        self.records = iter(records)
+        self.pending = collections.defaultdict(collections.deque)
+        self.reset()
+
+    def reset(self):
+        self.first = None
+        self.last = None
+
+    def take(self, kind, addr, register):
+        key = (kind, addr, register)
+        if self.pending[key]:
+            wall, data = self.pending[key].popleft()
+        else:
+            for k, wall, mono, data in self.records:
+                if k != I2C_READ and k != I2C_WRITE:
+                    continue
+                if (k, data[0], data[1]) == key:
+                    break
+                self.pending[(k, data[0], data[1])].append((wall, data))
+            else:
+                raise EOFError
+        if self.first is None:
+            self.first = wall
+        self.last = wall
+        return data
+
+    def read_i2c_block_data(self, addr, register, length, *args):
+        return list(self.take(I2C_READ, addr, register)[2:2 + length])
+
+    def write_i2c_block_data(self, addr, register, data, *args):
+        try:
+            self.take(I2C_WRITE, addr, register)
+        except EOFError:
+            pass
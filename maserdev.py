@@ -0,0 +1,185 @@
+import glob
+import logging
+import os
+import threading
+import time
+
+# Serial device discovery, instead of fixed /dev/ttyUSBx names kept by udev
+# rules. An instrument device is given as
+#   /dev/ttyUSB0         a device path, waited for while it is missing
+#   usb:VID:PID[:SERIAL] a USB serial adapter by vendor and product id, in
+#                        hex, and optionally its serial number
+#   usb@LOCATION         a USB serial adapter by the USB port it is plugged
+#                        into, e.g. 1.2.1.2 or 1-1.2.1.2
+#   probe[:GLOB]         the first free serial port, or port matching GLOB,
+#                        on which the instrument answers its probe
+# Devices in use are claimed, so they are not matched or probed for other
+# instruments, and a device released by an instrument that lost it stays
+# held for that instrument for HOLD seconds, so it is not probed by others
+# while it is being reattached.
+
+claimed = set()
+# path -> (owner, monotonic time the hold ends)
+held = {}
+lock = threading.Lock()
+probing = threading.Lock()
+
+def usb_match(spec, port):
+    if port.vid is None:
+        return False
+    if spec.startswith('usb@'):
+        location = (port.location or '').split(':')[0]
+        want = spec[4:]
+        return location == want or location.endswith('-' + want)
+    ids = spec[4:].split(':')
+    if len(ids) < 2 or int(ids[0], 16) != port.vid or int(ids[1], 16) != port.pid:
+        return False
+    return len(ids) < 3 or ids[2] == port.serial_number
+
+def candidates(SPEC, OWNER=None):
+    # Device paths that may be the SPEC device, not claimed, nor held for
+    # another instrument than OWNER, those held for OWNER first
+    if SPEC.startswith('usb') or SPEC == 'probe':
+        # Imported here, instruments without a serial port do not need
+        # pyserial
+        from serial.tools import list_ports
+        paths = [p.device for p in list_ports.comports() if SPEC == 'probe' or usb_match(SPEC, p)]
+    elif SPEC.startswith('probe:'):
+        paths = sorted(glob.glob(SPEC[6:]))
+    else:
+        paths = [SPEC] if os.path.exists(SPEC) else []
+    now = time.monotonic()
+    with lock:
+        for path, (owner, until) in list(held.items()):
+            if until < now:
+                del held[path]
+        paths = [p for p in paths if p not in claimed and held.get(p, (OWNER,))[0] == OWNER]
+        return sorted(paths, key=lambda p: p not in held)
+
+def resolve(SPEC, PROBE=None, OWNER=None):
+    # The device path of SPEC, claimed, or None if not present. PROBE(path)
+    # tells whether path is the instrument, for probe specs. Probes run one
+    # at a time, on ports claimed meanwhile, so they do not disturb each
+    # other or a port taken into use.
+    if not SPEC.startswith('probe'):
+        for path in candidates(SPEC, OWNER):
+            if claim(path):
+                return path
+        return None
+    with probing:
+        for path in candidates(SPEC, OWNER):
+            if not claim(path):
+                continue
+            try:
+                if PROBE(path):
+                    return path
+            except Exception as e:
+                logging.debug("Probe of %s failed: %s" % (path, e))
+            release(path)
+    return None
+
+def claim(path):
+    with lock:
+        if path in claimed:
+            return False
+        claimed.add(path)
+        held.pop(path, None)
+        return True
+
+def release(path, OWNER=None, HOLD=0):
+    # With OWNER, path is held for it for HOLD seconds
+    with lock:
+        claimed.discard(path)
+        if OWNER is not None and HOLD > 0:
+            held[path] = (OWNER, time.monotonic() + HOLD)
+
+def present(path):
+    return os.path.exists(path)
+
+# Counts tty hot-plug events, from one pyudev monitor thread per process,
+# when pyudev is installed, so any number of instruments can wait for
+# them. pyudev is only imported once a device is waited for.
+class HotplugMonitor:
+    def __init__(self):
+        self.events = 0
+        self.cond = threading.Condition()
+        self.monitor = None
+        try:
+            import pyudev
+        except ImportError:
+            pyudev = None
+        if pyudev is not None:
+            try:
+                context = pyudev.Context()
+                self.monitor = pyudev.Monitor.from_netlink(context)
+                self.monitor.filter_by('tty')
+                self.monitor.start()
+            except Exception as e:
+                logging.warning("No udev hot-plug events, polling: %s" % e)
+                self.monitor = None
+        if self.monitor is not None:
+            threading.Thread(target=self.run, name="hotplug", daemon=True).start()
+
+    def run(self):
+        while True:
+            if self.monitor.poll() is not None:
+                with self.cond:
+                    self.events += 1
+                    self.cond.notify_all()
+
+    def wait(self, events, timeout):
+        # The event count, after waiting up to timeout for it to pass events
+        with self.cond:
+            self.cond.wait_for(lambda: self.events != events, timeout)
+            return self.events
+
+hotplug = None
+hotplug_lock = threading.Lock()
+
+def hotplug_monitor():
+    global hotplug
+    with hotplug_lock:
+        if hotplug is None:
+            hotplug = HotplugMonitor()
+        return hotplug
+
+# Wait until the SPEC device is present and return its path, claimed.
+# Devices are looked for again on every hot-plug event, or otherwise at
+# intervals from MINPOLL doubling up to MAXPOLL, so a device coming back
+# after a glitch is found within milliseconds. Probing opens and talks to
+# every free port, so probe specs are only resolved for SETTLE seconds
+# after a hot-plug event, while the new device may still be settling, and
+# otherwise every PROBEPOLL seconds.
+def wait_device(SPEC, PROBE=None, NAME='', MINPOLL=0.01, MAXPOLL=0.25, PROBEPOLL=30, SETTLE=2):
+    path = resolve(SPEC, PROBE, NAME)
+    if path is not None:
+        return path
+    logging.warning("%s: waiting for device %s" % (NAME, SPEC))
+    monitor = hotplug_monitor()
+    events = monitor.events
+    probe = SPEC.startswith('probe')
+    interval = MINPOLL
+    settling = time.monotonic() + SETTLE
+    waited = time.monotonic()
+    while path is None:
+        if probe and time.monotonic() > settling:
+            n = monitor.wait(events, PROBEPOLL)
+            if n != events:
+                settling = time.monotonic() + SETTLE
+                interval = MINPOLL
+        else:
+            n = monitor.wait(events, interval)
+            interval = min(2 * interval, MAXPOLL)
+        events = n
+        path = resolve(SPEC, PROBE, NAME)
+    logging.warning("%s: device %s found as %s after %.3f s" % (NAME, SPEC, path, time.monotonic() - waited))
+    return path
+
+def describe(port):
+    # The usb: spec matching the port, or its path
+    if port.vid is None:
+        return port.device
+    spec = "usb:%04x:%04x" % (port.vid, port.pid)
+    if port.serial_number:
+        spec += ":%s" % port.serial_number
+    return spec
@@ -0,0 +1,259 @@
+import itertools
+import logging
+import re
+import time
+import serial
+from masersched import Ticker, midpoint_ns
+import masermetrics
+import masercapture
+
+# masermon driver for the DPM7885 absolute pressure sensor
+
+def is_number(s):
+    if s is None:
+        return False
+    if s.isnumeric():
+        return True
+    r = re.fullmatch('[+-]?([0-9]+)?[.]?[0-9]+([eE]([0-9]+))?',s)
+    if r:
+        return True
+    return False
+
+# Buffered line link to the DPM7885. Received data is read as it arrives
+# and cut into lines at the line ends, and a reply is only taken if it
+# matches the pattern expected, so a corrupted or partial line costs only
+# itself and framing is regained at the next line end, instead of waiting
+# for the serial timeout to clear the line. ser may be None to only cut
+# lines, as in replay.
+dpm7885_number = re.compile(rb'\s*[+-]?\d*\.?\d+([eE][+-]?\d+)?\s*')
+
+class Dpm7885Link:
+    MAXLINE = 80
+
+    def __init__(self, ser, BAUDRATE=9600, LATENCY=0.2, NAME='DPM7885'):
+        self.ser = ser
+        self.name = NAME
+        self.latency = LATENCY
+        self.chartime = 10.0 / BAUDRATE
+        self.buf = bytearray()
+
+    def feed(self):
+        # Read what has arrived, waiting up to the port timeout for a byte
+        data = self.ser.read(max(1, self.ser.in_waiting))
+        self.buf += data
+        return len(data)
+
+    def next_line(self):
+        # The next complete line received, without the line end, or None
+        end = self.buf.find(b'\n')
+        if end < 0:
+            if len(self.buf) > self.MAXLINE:
+                # No line end in sight, noise
+                masermetrics.errors.labels(self.name).inc()
+                self.buf.clear()
+            return None
+        line = bytes(self.buf[:end]).strip()
+        del self.buf[:end + 1]
+        return line
+
+    def query(self, CMD, PATTERN=None):
+        # The reply line to CMD, or None if it does not match PATTERN or is
+        # not received within the time to send it and a reply plus the
+        # latency. Stale input is dropped first.
+        self.ser.reset_input_buffer()
+        self.buf.clear()
+        self.ser.write(CMD + b'\r\n')
+        deadline = time.monotonic() + (len(CMD) + 2 + self.MAXLINE) * self.chartime + self.latency
+        while True:
+            line = self.next_line()
+            if line is None:
+                if time.monotonic() >= deadline:
+                    masermetrics.timeouts.labels(self.name).inc()
+                    return None
+                self.feed()
+            elif PATTERN is None or PATTERN.fullmatch(line):
+                return line.decode('utf-8', errors='replace')
+            elif line:
+                masermetrics.errors.labels(self.name).inc()
+                return None
+
+    def drain(self):
+        # Discard input until the line has been quiet for the latency
+        quiet = time.monotonic() + self.latency
+        while time.monotonic() < quiet:
+            if self.feed():
+                quiet = time.monotonic() + self.latency
+        self.buf.clear()
+
+    def init(self):
+        self.query(b'')
+        self.query(b'$MS')
+        self.drain()
+        self.query(b'$SU3')
+
+# Tags from the $TS response, serial, cylinder and calibration numbers,
+# or None if it is not one
+dpm7885_serials = re.compile(rb'\s*\+?(\d+)\s+\+?(\d+)\s+\+?(\d+)\s*')
+dpm7885_type = re.compile(rb'.*7885.*')
+
+def dpm7885_tags(TS):
+    m = dpm7885_serials.fullmatch(TS.encode() if isinstance(TS, str) else TS)
+    if m is None:
+        return None
+    return {
+        "masertype": "dpm7885",
+        "snr": int(m.group(1)),
+        "cylinernr" : int(m.group(2)),
+        "calnr": int(m.group(3))
+    }
+
+# Fields from the $MR (pressure in hPa) and $MT (temperature) responses
+def dpm7885_fields(MR, MT):
+    assert is_number(MR)
+    assert is_number(MT)
+    temp = float(MT)
+    assert temp < 200
+    return {
+        "Pressure": 100*float(MR),
+        "Temp": temp
+    }
+
+# Continuous output, a line per sample of the pressure, optionally
+# followed by the temperature, and a unit
+dpm7885_stream_line = re.compile(rb'\s*([+-]?\d*\.?\d+(?:[eE][+-]?\d+)?)(?:[\s,;]+([+-]?\d*\.?\d+))?\s*[A-Za-z%]*\s*')
+
+def dpm7885_stream_points(MASERID, tags, link, now):
+    # Points of the complete lines in link, the data of which was read at
+    # now, each timestamped when its first byte was sent
+    points = []
+    line = link.next_line()
+    while line is not None:
+        m = dpm7885_stream_line.fullmatch(line)
+        temp = float(m.group(2)) if m and m.group(2) is not None else None
+        if m and (temp is None or temp < 200):
+            fields = {"Pressure": 100 * float(m.group(1))}
+            if temp is not None:
+                fields["Temp"] = temp
+            sent = now - int((len(link.buf) + len(line) + 2) * link.chartime * 1e9)
+            points.append({"measurement": MASERID, "tags": tags, "time": sent, "fields": fields})
+        elif line:
+            masermetrics.errors.labels(link.name).inc()
+        line = link.next_line()
+    return points
+
+# Continuous output, started with the STREAM command on units that support
+# it. When no valid line arrives for STALL seconds, the link is initialised
+# and the output started again.
+def dpm7885_stream(WRITER, MASERID, link, tags, STREAM, STALL=2.0):
+    link.ser.write(STREAM.encode() + b'\r\n')
+    last = time.monotonic()
+    while True:
+        link.feed()
+        points = dpm7885_stream_points(MASERID, tags, link, time.time_ns())
+        if points:
+            WRITER.write_points(points)
+            masermetrics.samples.labels(link.name).inc(len(points))
+            last = time.monotonic()
+        elif time.monotonic() - last > STALL:
+            logging.error("%s: no output for %.1f s, restarting it" % (link.name, STALL))
+            masermetrics.resyncs.labels(link.name).inc()
+            link.init()
+            link.ser.write(STREAM.encode() + b'\r\n')
+            last = time.monotonic()
+
+# Polled, $MR and $MT every LOGRATE seconds, or with STREAM the continuous
+# output. A reply lost or garbled only costs its sample, the link is
+# initialised again after RESYNC failed samples in a row.
+def dpm7885_process(WRITER, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE, STREAM=None, RESYNC=3):
+    port = serial.Serial(SERIALDEVICE, BAUDRATE, bytesize=8, parity='N', stopbits=1, xonxoff=1, timeout=0.05)
+    with masercapture.serial_port('dpm7885', MASERID, port, stream=STREAM) as ser:
+        name = "DPM7885 %s" % MASERID
+        link = Dpm7885Link(ser, BAUDRATE, NAME=name)
+        # Start up and get Identity
+        link.init()
+        # Get ID and Serial numbers
+        while not link.query(b'$TT', dpm7885_type):
+            pass
+        tags = None
+        while tags is None:
+            s = link.query(b'$TS', dpm7885_serials)
+            tags = s and dpm7885_tags(s)
+        if STREAM:
+            dpm7885_stream(WRITER, MASERID, link, tags, STREAM)
+        ticker = Ticker(LOGRATE, name)
+        failed = 0
+        while True:
+            ticker.wait()
+            started = time.time_ns()
+            with masermetrics.serial_seconds.labels(name).time():
+                mr = link.query(b'$MR', dpm7885_number)
+            timestamp = midpoint_ns(started)
+            with masermetrics.serial_seconds.labels(name).time():
+                mt = link.query(b'$MT', dpm7885_number) if mr else None
+            try:
+                assert mr and mt, "%s: no reply" % name
+                json_body = [
+                    {
+                        "measurement": MASERID,
+                        "tags": tags,
+                        "time": timestamp,
+                        "fields": dpm7885_fields(mr, mt)
+                    }
+                ]
+                WRITER.write_points(json_body)
+                masermetrics.samples.labels(name).inc()
+                failed = 0
+            except AssertionError as e:
+                logging.error(e)
+                failed += 1
+                if failed >= RESYNC:
+                    masermetrics.resyncs.labels(name).inc()
+                    link.init()
+                    failed = 0
+
+def dpm7885_probe(ser):
+    ser.write(b'\r\n$TT\r\n')
+    return b'7885' in ser.read(64)
+
+def dpm7885_replay(MASERID, RECORDS, STREAM=None, BAUDRATE=9600):
+    tags = None
+    mr = None
+    stream = STREAM.encode() if STREAM else None
+    link = Dpm7885Link(None, BAUDRATE or 9600)
+    # Request, its time, the time of the last reply data and the replies
+    request = None
+    for kind, wall, mono, data in itertools.chain(RECORDS, [(masercapture.WRITE, None, None, b'')]):
+        if kind == masercapture.READ and request:
+            if request[0] == stream:
+                link.buf += data
+                yield from dpm7885_stream_points(MASERID, tags, link, wall)
+            else:
+                request[2] = wall
+                request[3] += data
+        elif kind == masercapture.WRITE:
+            if request:
+                cmd, started, ended, response = request
+                lines = [l.strip() for l in response.split(b'\n')]
+                number = next((l.decode() for l in lines if dpm7885_number.fullmatch(l)), None)
+                try:
+                    if cmd == b'$TS':
+                        tags = dpm7885_tags(lines[0]) or tags
+                    elif cmd == b'$MR':
+                        mr = (number, (started + ended) // 2)
+                    elif cmd == b'$MT' and mr and tags:
+                        yield {"measurement": MASERID, "tags": tags, "time": mr[1], "fields": dpm7885_fields(mr[0], number)}
+                        mr = None
+                except (AssertionError, ValueError, IndexError):
+                    mr = None
+            request = [bytes(data).strip(), wall, wall, b'']
+            link.buf.clear()
+
+def dpm7885_schema():
+    return ["masertype", "snr", "cylinernr", "calnr"], [("Pressure", 'float'), ("Temp", 'float')]
+
+driver = {
+    'process': (dpm7885_process, ('maserid', 'device', 'baudrate', 'lograte', 'stream')),
+    'replay': (dpm7885_replay, ('stream', 'baudrate')),
+    'probe': (dpm7885_probe, None, 0.5),
+    'schema': (dpm7885_schema, ()),
+}
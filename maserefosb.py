@@ -0,0 +1,347 @@
+import datetime
+import json
+import re
+import struct
+import time
+import numpy
+import serial
+from masersched import Ticker, midpoint_ns
+import masermetrics
+import masercapture
+
+# masermon driver for the EFOS-B active hydrogen maser
+
+efosb_channels = [
+    { "chan": 0,    "name": "InputA_U",       "signed": -128,   "scale": 0.230,   "offset": 0    },
+    { "chan": 1,    "name": "InputA_I",       "signed": -128,   "scale": 0.096,   "offset": 0    },
+    { "chan": 2,    "name": "InputB_U",       "signed": -128,   "scale": 0.230,   "offset": 0    },
+    { "chan": 3,    "name": "InputB_I",       "signed": -128,   "scale": 0.096,   "offset": 0    },
+    { "chan": 4,    "name": "Temp",           "signed": -128,   "scale": 0.960,   "offset": -1.1 },
+    { "chan": 5,    "name": "Hpress_set",     "signed": -128,   "scale": 0.096,   "offset": 0    },
+    { "chan": 6,    "name": "Hpress_read",    "signed": -128,   "scale": 0.096,   "offset": 0    },
+    { "chan": 7,    "name": "Palladium_heat", "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 8,    "name": "LO_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 9,    "name": "UO_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 10,   "name": "Dalle_heat",     "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 11,   "name": "LI_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 12,   "name": "UI_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 13,   "name": "Cavity_heat",    "signed": -128,   "scale": 0.192,   "offset": 0    },
+    { "chan": 14,   "name": "Temp_cavity",    "signed": -128,   "scale": 0.010,   "offset": 0    },
+    { "chan": 15,   "name": "Temp_ambient",   "signed": -128,   "scale": 0.096,   "offset": 26   },
+    { "chan": 16,   "name": "Cavity_var",     "signed": -128,   "scale": 0.096,   "offset": 0    },
+    { "chan": 17,   "name": "C_field",        "signed": -128,   "scale": 1.920e-6,"offset": 0    },
+    { "chan": 18,   "name": "int_N2_HT_U",    "signed": -128,   "scale": 0.048e+3,"offset": 0    },
+    { "chan": 19,   "name": "int_N2_HT_I",    "signed": -128,   "scale": 19.00e-6,"offset": 0    },
+    { "chan": 20,   "name": "int_N1_HT_U",    "signed": -128,   "scale": 0.048e+3,"offset": 0    },
+    { "chan": 21,   "name": "int_N1_HT_I",    "signed": -128,   "scale": 19.00e-6,"offset": 0    },
+    { "chan": 22,   "name": "ext_HT_U",       "signed": -128,   "scale": 0.048e+3,"offset": 0    },
+    { "chan": 23,   "name": "ext_HT_I",       "signed": -128,   "scale": 19.00e-6,"offset": 0    },
+    { "chan": 24,   "name": "RF_U",           "signed": -128,   "scale": 0.298,   "offset": 0    },
+    { "chan": 25,   "name": "RF_I",           "signed": -128,   "scale": 0.010,   "offset": 0    },
+    { "chan": 26,   "name": "p24V",           "signed": -128,   "scale": 0.240,   "offset": 0    },
+    { "chan": 27,   "name": "p15V1",          "signed": -128,   "scale": 0.148,   "offset": 0    },
+    { "chan": 28,   "name": "n15V1",          "signed": -128,   "scale": 0.148,   "offset": 0    },
+    { "chan": 29,   "name": "p5V",            "signed": -128,   "scale": 0.148,   "offset": 0    },
+    { "chan": 30,   "name": "p15V2",          "signed": -128,   "scale": 0.148,   "offset": 0    },
+    { "chan": 31,   "name": "n15V2",          "signed": -128,   "scale": 0.148,   "offset": 0    },
+    { "chan": 32,   "name": "OCXO",           "signed": 0,      "scale": 0.078,   "offset": 0    },
+    { "chan": 33,   "name": "Ampl5.7k",       "signed": 0,      "scale": 0.078,   "offset": 0    },
+    { "chan": 34,   "name": "Lock",           "signed": 0,      "scale": 1.000,   "offset": 0    },
+]
+
+# EFOS-B channel map compiled to arrays, so that a sweep, or a whole
+# history of sweeps, is decoded with one vectorized expression. Channel maps
+# for individual masers are kept as JSON files such as EFOS14.json, in the
+# same format as efosb_channels. Raw values that could not be read are
+# negative and decode to NaN.
+class EfosbChannels:
+    def __init__(self, channels):
+        self.chan = numpy.array([c['chan'] for c in channels], dtype=numpy.int32)
+        self.names = [c['name'] for c in channels]
+        self.signed = numpy.array([c['signed'] for c in channels], dtype=numpy.float64)
+        self.scale = numpy.array([c['scale'] for c in channels], dtype=numpy.float64)
+        self.offset = numpy.array([c['offset'] for c in channels], dtype=numpy.float64)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def decode(self, raw):
+        # raw is one sweep, shape (channels,), or a history (sweeps, channels)
+        raw = numpy.asarray(raw, dtype=numpy.float64)
+        val = (raw + self.signed) * self.scale + self.offset
+        val[raw < 0] = numpy.nan
+        return val
+
+    def decode_hex(self, sweeps):
+        # Each sweep is the two hex digit replies of all channels in order,
+        # as bytes or str, e.g. "7f80..". Missing replies are "--".
+        if isinstance(sweeps, (str, bytes)):
+            sweeps = [sweeps]
+        buf = b''.join(s.encode('ascii') if isinstance(s, str) else s for s in sweeps)
+        d = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(-1, len(self.names), 2).astype(numpy.int32)
+        d = numpy.where(d >= ord('a'), d - (ord('a') - 10),
+            numpy.where(d >= ord('A'), d - (ord('A') - 10), d - ord('0')))
+        raw = d[:, :, 0] * 16 + d[:, :, 1]
+        raw[(d < 0).any(axis=2) | (d > 15).any(axis=2)] = -1
+        return self.decode(raw)
+
+    def fields(self, values):
+        return {n: float(v) for n, v in zip(self.names, values) if not numpy.isnan(v)}
+
+# Pipelined EFOS-B channel polling. A channel is read by sending "Dnn",
+# which the maser echoes, followed by the hex value and line end. Up to
+# DEPTH commands are written in one call and the echoes and replies are
+# picked out of the received stream by pattern, keyed by the echoed channel
+# number, so line noise only costs the affected channels and framing is
+# regained at the next "D". Unanswered channels are re-polled up to RETRIES
+# times after a timeout derived from the link speed plus LATENCY, instead
+# of waiting out the full serial timeout.
+efosb_reply = re.compile(rb'D(\d\d)([0-9A-Fa-f]{2}[\r\n]|[0-9A-Fa-f]{3})[\r\n]')
+
+class EfosbPoller:
+    def __init__(self, ser, DEPTH=1, RETRIES=2, LATENCY=0.2, NAME='EFOS-B'):
+        self.ser = ser
+        self.name = NAME
+        self.depth = DEPTH
+        self.retries = RETRIES
+        self.latency = LATENCY
+        # Seconds on the wire per command, 3 echo and 4 reply characters
+        self.chartime = 7 * 10.0 / ser.baudrate
+        self.buf = b''
+        self.duration = 0.0
+        self.missing = []
+
+    def transaction(self, chans, raw, index):
+        started = time.monotonic()
+        self.ser.write(b''.join(b'D%02d' % c for c in chans))
+        want = set(chans)
+        deadline = time.monotonic() + len(chans) * self.chartime + self.latency
+        while want and time.monotonic() < deadline:
+            self.buf += self.ser.read(max(1, self.ser.in_waiting))
+            end = 0
+            for m in efosb_reply.finditer(self.buf):
+                chan = int(m.group(1))
+                if chan in want:
+                    raw[index[chan]] = int(m.group(2), 16)
+                    want.discard(chan)
+                end = m.end()
+            # Keep at most one partial reply, anything before it is noise
+            self.buf = self.buf[end:][-6:]
+        masermetrics.serial_seconds.labels(self.name).observe(time.monotonic() - started)
+        if want:
+            masermetrics.timeouts.labels(self.name).inc(len(want))
+        return [c for c in chans if c in want]
+
+    def sweep(self, chans, raw):
+        # Poll all chans into raw, channels not answered are set to -1
+        started = time.monotonic()
+        index = {int(c): i for i, c in enumerate(chans)}
+        raw[:] = -1
+        todo = [int(c) for c in chans]
+        for attempt in range(self.retries + 1):
+            missed = []
+            for i in range(0, len(todo), self.depth):
+                missed += self.transaction(todo[i:i + self.depth], raw, index)
+            if not missed:
+                break
+            if attempt < self.retries:
+                masermetrics.retries.labels(self.name).inc(len(missed))
+            self.ser.reset_input_buffer()
+            self.buf = b''
+            todo = missed
+        self.missing = missed
+        self.duration = time.monotonic() - started
+        masermetrics.sweep_seconds.labels(self.name).observe(self.duration)
+        return raw
+
+# Per-channel poll rates. Each channel is polled every INTERVALS[name]
+# seconds, LOGRATE if not given, rounded to whole ticks of the loop, which
+# ticks at the shortest interval. A tick polls the channels that are due,
+# most overdue first, as many as fit in BUSY of the tick at the measured
+# time per channel, so a sweep never runs over the link budget; the rest
+# stay due for the next tick. With ADAPTIVE a channel is polled twice as
+# often, down to every FASTEST seconds, when its raw value moves by more
+# than DEADBAND counts, and half as often again, back to its interval,
+# after STABLE unchanged polls.
+class EfosbSchedule:
+    def __init__(self, table, LOGRATE, INTERVALS=None, ADAPTIVE=False, FASTEST=None, BUSY=0.8, DEADBAND=1, STABLE=4, COST=0.01):
+        intervals = INTERVALS or {}
+        unknown = set(intervals) - set(table.names)
+        if unknown:
+            raise ValueError("Unknown EFOS-B channels %s" % ', '.join(sorted(unknown)))
+        slowest = numpy.array([float(intervals.get(n, LOGRATE)) for n in table.names])
+        fastest = numpy.minimum(slowest, FASTEST or slowest.min()) if ADAPTIVE else slowest
+        self.tick = float(fastest.min())
+        self.slowest = numpy.maximum(1, numpy.rint(slowest / self.tick)).astype(numpy.int64)
+        self.fastest = numpy.maximum(1, numpy.rint(fastest / self.tick)).astype(numpy.int64)
+        # Poll period and next tick due of each channel, in ticks
+        self.period = self.slowest.copy()
+        self.next = numpy.zeros(len(table.names), dtype=numpy.int64)
+        self.adaptive = ADAPTIVE
+        self.busy = BUSY
+        self.deadband = DEADBAND
+        self.stable = STABLE
+        self.unchanged = numpy.zeros(len(table.names), dtype=numpy.int64)
+        self.last = numpy.full(len(table.names), -1, dtype=numpy.int32)
+        # Seconds per channel polled, from the sweeps made
+        self.cost = COST
+
+    def due(self, tick):
+        # Indices of the channels to poll at tick number tick
+        late = tick - self.next
+        sel = numpy.flatnonzero(late >= 0)
+        if len(sel) == 0:
+            return sel
+        fit = max(1, int(self.busy * self.tick / self.cost))
+        if len(sel) > fit:
+            sel = sel[numpy.argsort(-late[sel] / self.period[sel], kind='stable')[:fit]]
+            sel.sort()
+        return sel
+
+    def update(self, tick, sel, raw, duration):
+        # Account for the values raw of the channels sel polled at tick
+        if len(sel):
+            self.cost = 0.8 * self.cost + 0.2 * duration / len(sel)
+        self.next[sel] = tick + self.period[sel]
+        if not self.adaptive:
+            return
+        answered = raw >= 0
+        sel = sel[answered]
+        raw = raw[answered]
+        last = self.last[sel]
+        moved = (last >= 0) & (numpy.abs(raw - last) > self.deadband)
+        self.last[sel] = raw
+        self.unchanged[sel] = numpy.where(moved, 0, self.unchanged[sel] + 1)
+        faster = sel[moved]
+        self.period[faster] = numpy.maximum(self.fastest[faster], self.period[faster] // 2)
+        slower = sel[self.unchanged[sel] >= self.stable]
+        self.period[slower] = numpy.minimum(self.slowest[slower], self.period[slower] * 2)
+        self.unchanged[slower] = 0
+        self.next[sel] = tick + self.period[sel]
+
+def efosb_process(WRITER, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE, CHANNELS=None, PIPELINE=1, INTERVALS=None, ADAPTIVE=False, FASTEST=None):
+    if CHANNELS:
+        table = EfosbChannels.load(CHANNELS)
+    else:
+        table = EfosbChannels(efosb_channels)
+    raw = numpy.empty(len(table.chan), dtype=numpy.int32)
+    polled = numpy.empty(len(table.chan), dtype=numpy.int32)
+    with masercapture.serial_port('efosb', MASERID, serial.Serial(SERIALDEVICE, BAUDRATE, timeout=2)) as ser:
+        s = ''
+        print("Syncing ...")
+        while len(s) < 10:
+            ser.write('F'.encode())
+            s = ser.read(size=10)
+            if len(s) < 10:
+                print(s)
+        print("Synthesizer f:", s.decode('ascii', errors='replace').strip())
+        ser.timeout = 0.05
+        name = "EFOS-B %s" % MASERID
+        poller = EfosbPoller(ser, DEPTH=PIPELINE, NAME=name)
+        schedule = EfosbSchedule(table, LOGRATE, INTERVALS, ADAPTIVE, FASTEST, COST=poller.chartime + 0.002)
+        ticker = Ticker(schedule.tick, name)
+        while True:
+            tick = ticker.wait() // ticker.period
+            sel = schedule.due(tick)
+            if len(sel) == 0:
+                continue
+            masercapture.mark(ser, struct.pack('<q', tick))
+            started = time.time_ns()
+            poller.sweep(table.chan[sel], polled[:len(sel)])
+            timestamp = midpoint_ns(started)
+            schedule.update(tick, sel, polled[:len(sel)], poller.duration)
+            raw[:] = -1
+            raw[sel] = polled[:len(sel)]
+            if poller.missing:
+                print("%s EFOS-B channels not answered: %s" % (datetime.datetime.utcnow().isoformat(), poller.missing))
+            fields = table.fields(table.decode(raw))
+            fields['Sweep_time'] = poller.duration
+            masermetrics.samples.labels(name).inc()
+            json_body = [
+                {
+                    "measurement": MASERID,
+                    "tags": {
+                        "masetype": "EFOS-B",
+                        "maser": MASERID
+                     },
+                    "time": timestamp,
+                    "fields": fields
+                }
+            ]
+            WRITER.write_points(json_body)
+
+# The synthesizer frequency, one line NNNN.NNNN, and nothing else, unlike
+# e.g. the TICC time stamps
+efosb_synthesizer = re.compile(rb'\s*\d{4}\.\d{4}\s*')
+
+def efosb_probe(ser):
+    ser.write(b'F')
+    return efosb_synthesizer.fullmatch(ser.read(32)) is not None
+
+def efosb_replay(MASERID, RECORDS, CHANNELS=None):
+    if CHANNELS:
+        table = EfosbChannels.load(CHANNELS)
+    else:
+        table = EfosbChannels(efosb_channels)
+    index = {int(c): i for i, c in enumerate(table.chan)}
+    first = b'D%02d' % table.chan[0]
+    raw = numpy.full(len(table.chan), -1, dtype=numpy.int32)
+    tags = {
+        "masetype": "EFOS-B",
+        "maser": MASERID
+    }
+    buf = b''
+    started = ended = None
+    # Sweeps are marked in captures with per-channel rates, otherwise a
+    # sweep starts with the first channel, unless that is a re-poll
+    marked = False
+    for kind, wall, mono, data in RECORDS:
+        if kind == masercapture.MARK:
+            marked = True
+            if started is not None:
+                fields = table.fields(table.decode(raw))
+                fields['Sweep_time'] = (ended_mono - started_mono) / 1e9
+                yield {"measurement": MASERID, "tags": tags, "time": (started + ended) // 2, "fields": fields}
+                raw[:] = -1
+                started = None
+        elif kind == masercapture.WRITE and data[:1] == b'D':
+            if not marked and started is not None and data[:3] == first and (raw[0] >= 0 or wall - ended > 1000000000):
+                fields = table.fields(table.decode(raw))
+                fields['Sweep_time'] = (ended_mono - started_mono) / 1e9
+                yield {"measurement": MASERID, "tags": tags, "time": (started + ended) // 2, "fields": fields}
+                raw[:] = -1
+                started = None
+            if started is None:
+                started = ended = wall
+                started_mono = ended_mono = mono
+        elif kind == masercapture.READ and started is not None:
+            buf += data
+            end = 0
+            for m in efosb_reply.finditer(buf):
+                chan = int(m.group(1))
+                if chan in index:
+                    raw[index[chan]] = int(m.group(2), 16)
+                end = m.end()
+            buf = buf[end:][-6:]
+            ended = wall
+            ended_mono = mono
+    if started is not None:
+        fields = table.fields(table.decode(raw))
+        fields['Sweep_time'] = (ended_mono - started_mono) / 1e9
+        yield {"measurement": MASERID, "tags": tags, "time": (started + ended) // 2, "fields": fields}
+
+def efosb_schema(CHANNELS=None):
+    if CHANNELS:
+        table = EfosbChannels.load(CHANNELS)
+    else:
+        table = EfosbChannels(efosb_channels)
+    return ["masetype", "maser"], [(n, 'float') for n in table.names] + [("Sweep_time", 'float')]
+
+driver = {
+    'process': (efosb_process, ('maserid', 'device', 'baudrate', 'lograte', 'channels', 'pipeline', 'intervals', 'adaptive', 'fastest')),
+    'replay': (efosb_replay, ('channels',)),
+    'probe': (efosb_probe, None, 0.5),
+    'schema': (efosb_schema, ('channels',)),
+}
@@ -0,0 +1,218 @@
+import json
+import logging
+import time
+import serial
+from masersched import Ticker, midpoint_ns
+import masermetrics
+import masercapture
+
+# masermon driver for the HP5071A cesium clock
+
+# HP5071A query set. Static queries are made once per session and become
+# tags, the others are made every cycle and become fields. Responses with
+# several comma separated values map to several fields, item picks one
+# value out of such a response. A query set can be given as a JSON file of
+# the same form, such as HP5071A.json.
+hp5071a_queries = {
+    "static": [
+        { "query": "*IDN?",                "type": "int",    "item": 3, "tag": "maser" },
+        { "query": "DIAG:CBTSerial?",      "type": "string",            "tag": "tube" }
+    ],
+    "queries": [
+        { "query": "DIAG:STAT:SUPPly?",    "type": "string", "fields": ["Supply"] },
+        { "query": "DIAG:VOLT:SUPPly?",    "type": "float",  "fields": ["+5V", "+12V", "-12V"] },
+        { "query": "DIAG:TEMP?",           "type": "float",  "fields": ["Temp"] },
+        { "query": "PTIM:MJD?",            "type": "int",    "fields": ["MJD"] },
+        { "query": "DIAG:STAT?",           "type": "string", "fields": ["Cont OpStatus"] },
+        { "query": "DIAG:CURR:BEAM?",      "type": "float",  "fields": ["Beam Current"] },
+        { "query": "DIAG:CURR:CField?",    "type": "float",  "fields": ["C-field Current"] },
+        { "query": "DIAG:CURR:PUMP?",      "type": "float",  "fields": ["Ionpump Current"] },
+        { "query": "DIAG:GAIN?",           "type": "float",  "fields": ["Gain"] },
+        { "query": "DIAG:RFAMplitude?",    "type": "float",  "fields": ["RF Amplitude 1", "RF Amplitude 2"] },
+        { "query": "DIAG:VOLT:COVen?",     "type": "float",  "fields": ["Cesium Oven Voltage"] },
+        { "query": "DIAG:VOLT:EMUL?",      "type": "float",  "fields": ["Electron Multiplier Voltage"] },
+        { "query": "DIAG:VOLT:HWIonizer?", "type": "float",  "fields": ["Hot Wire Ionizer Voltage"] },
+        { "query": "DIAG:VOLT:MSPec?",     "type": "float",  "fields": ["Mass Spectrometer Voltage"] },
+        { "query": "DIAG:VOLT:PLLoop?",    "type": "float",  "fields": ["DRO Tuning Voltage", "SAW Tuning Voltage", "87 MHz Tuning Voltage", "uC clock Tuning Voltage"] }
+    ]
+}
+
+scpi_types = {
+    'int': int,
+    'float': float,
+    'string': lambda s: s.replace('"', ''),
+}
+
+def scpi_split(s, sep):
+    # Split a response at sep, but not inside quoted strings
+    parts = []
+    cur = ''
+    quoted = False
+    for c in s:
+        if c == '"':
+            quoted = not quoted
+        if c == sep and not quoted:
+            parts.append(cur)
+            cur = ''
+        else:
+            cur += c
+    parts.append(cur)
+    return parts
+
+def scpi_values(q, s):
+    conv = scpi_types[q['type']]
+    if 'item' in q:
+        return [conv(scpi_split(s, ',')[q['item']])]
+    if len(q.get('fields', [])) > 1:
+        return [conv(x) for x in scpi_split(s, ',')]
+    return [conv(s)]
+
+# SCPI session over a serial line. Queries are joined into compound
+# messages of up to BATCH queries, sent in one transaction, and the
+# semicolon separated response is split back per query. With ECHO the
+# instrument echoes each message line, which is skipped.
+class ScpiSession:
+    def __init__(self, ser, ECHO=True, BATCH=8, NAME='SCPI'):
+        self.ser = ser
+        self.name = NAME
+        self.echo = ECHO
+        self.batch = BATCH
+
+    def write(self, s):
+        self.ser.write(str.encode(s + "\r\n"))
+        if self.echo:
+            self.ser.readline()
+
+    def readline(self):
+        return self.ser.readline().decode("utf-8").rstrip()
+
+    def query(self, queries):
+        responses = []
+        for i in range(0, len(queries), self.batch):
+            chunk = queries[i:i + self.batch]
+            # Following queries start from the root, common commands as is
+            msg = ';'.join([chunk[0]] + [q if q.startswith('*') else ':' + q.lstrip(':') for q in chunk[1:]])
+            with masermetrics.serial_seconds.labels(self.name).time():
+                self.write(msg)
+                s = self.readline()
+            parts = scpi_split(s, ';')
+            if len(parts) != len(chunk):
+                if s == '':
+                    masermetrics.timeouts.labels(self.name).inc()
+                else:
+                    masermetrics.errors.labels(self.name).inc()
+                raise ValueError("SCPI response %r to %r" % (s, msg))
+            responses += parts
+        return responses
+
+    def resync(self):
+        # Drop anything left from a broken transaction
+        masermetrics.resyncs.labels(self.name).inc()
+        time.sleep(0.1)
+        self.ser.reset_input_buffer()
+        self.write("")
+
+def hp5071a_process(WRITER, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE, QUERIES=None, BATCH=8):
+    if QUERIES:
+        with open(QUERIES) as f:
+            table = json.load(f)
+    else:
+        table = hp5071a_queries
+    queries = [q['query'] for q in table['queries']]
+    with masercapture.serial_port('hp5071a', MASERID, serial.Serial(SERIALDEVICE, BAUDRATE, bytesize=8, parity='N', stopbits=1, xonxoff=1, timeout=2)) as ser:
+        name = "HP5071A %s" % MASERID
+        session = ScpiSession(ser, BATCH=BATCH, NAME=name)
+        # Start up and get Identity, static values are only read once
+        session.write("")
+        tags = {"masertype": "HP5071A"}
+        for q, s in zip(table['static'], session.query([q['query'] for q in table['static']])):
+            tags[q['tag']] = scpi_values(q, s)[0]
+        print("HP5071A %s" % tags)
+        ticker = Ticker(LOGRATE, name)
+        while True:
+            ticker.wait()
+            try:
+                started = time.time_ns()
+                with masermetrics.sweep_seconds.labels(name).time():
+                    responses = session.query(queries)
+                timestamp = midpoint_ns(started)
+                fields = {}
+                for q, s in zip(table['queries'], responses):
+                    fields.update(zip(q['fields'], scpi_values(q, s)))
+                masermetrics.samples.labels(name).inc()
+                json_body = [
+                    {
+                    "measurement": MASERID,
+                    "tags": tags,
+                    "time": timestamp,
+                    "fields": fields
+                    }
+                ]
+                WRITER.write_points(json_body)
+            except (ValueError, IndexError) as e:
+                logging.error(e)
+                session.resync()
+
+def hp5071a_probe(ser):
+    ser.write(b'\r\n*IDN?\r\n')
+    return b'5071A' in ser.read(256)
+
+def hp5071a_replay(MASERID, RECORDS, QUERIES=None):
+    if QUERIES:
+        with open(QUERIES) as f:
+            table = json.load(f)
+    else:
+        table = hp5071a_queries
+    key = lambda q: q.strip().lstrip(':').upper()
+    static = {key(q['query']): q for q in table['static']}
+    queries = {key(q['query']): q for q in table['queries']}
+    first = key(table['queries'][0]['query'])
+    tags = {"masertype": "HP5071A"}
+    fields = None
+    started = ended = None
+    for request, t0, t1, response in masercapture.exchanges(RECORDS):
+        msg = request.decode('utf-8', errors='replace').strip()
+        if msg == '':
+            continue
+        lines = response.decode('utf-8', errors='replace').splitlines()
+        # Skip the echo
+        if lines and lines[0].strip() == msg:
+            lines = lines[1:]
+        qs = [key(q) for q in scpi_split(msg, ';')]
+        parts = scpi_split(lines[0].rstrip() if lines else '', ';')
+        if qs[0] == first:
+            if fields:
+                yield {"measurement": MASERID, "tags": dict(tags), "time": (started + ended) // 2, "fields": fields}
+            fields = {}
+            started = t0
+        if len(parts) != len(qs):
+            # The loop drops the whole sample
+            fields = None
+            continue
+        try:
+            for q, s in zip(qs, parts):
+                if q in static:
+                    tags[static[q]['tag']] = scpi_values(static[q], s)[0]
+                elif q in queries and fields is not None:
+                    fields.update(zip(queries[q]['fields'], scpi_values(queries[q], s)))
+        except (ValueError, IndexError):
+            fields = None
+        ended = t1
+    if fields:
+        yield {"measurement": MASERID, "tags": dict(tags), "time": (started + ended) // 2, "fields": fields}
+
+def hp5071a_schema(QUERIES=None):
+    if QUERIES:
+        with open(QUERIES) as f:
+            table = json.load(f)
+    else:
+        table = hp5071a_queries
+    return (["masertype"] + [q['tag'] for q in table['static']],
+            [(f, q['type']) for q in table['queries'] for f in q['fields']])
+
+driver = {
+    'process': (hp5071a_process, ('maserid', 'device', 'baudrate', 'lograte', 'queries', 'batch')),
+    'replay': (hp5071a_replay, ('queries',)),
+    'probe': (hp5071a_probe, None, 0.5),
+    'schema': (hp5071a_schema, ('queries',)),
+}
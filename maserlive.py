@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+from maserwriter import lp_time
+
+# Local live data bus. Every sample an acquisition loop writes is also
+# published, as it is written, on a Unix domain socket, so control scripts
+# and displays on the same host get the latest values within milliseconds
+# instead of polling InfluxDB. The socket is SOCK_SEQPACKET, one message
+# per sample, so messages keep their boundaries and are sent whole or not
+# at all. Sends never block: while a subscriber does not keep up and its
+# socket buffer is full, its samples are dropped and counted.
+#
+# A subscriber connects and sends its filter as one JSON message,
+# {"instruments": [...], "fields": [...]}, instruments by name or type,
+# empty or left out for all, and may send a new filter at any time. It then
+# gets the latest sample of each matching instrument, and every sample as
+# it is acquired, with only the fields asked for. A sample message is
+#   head   <qBBBB, time ns UTC, lengths of the instrument name and the
+#          measurement, number of tags and of fields
+#   the instrument name and the measurement, UTF-8
+#   tags   key and value, each a length byte and UTF-8
+#   fields name, as a length byte and UTF-8, type and value, 'd' float64,
+#          'q' int64, '?' bool, or 's' string, as <H length and UTF-8
+head = struct.Struct('<qBBBB')
+MAXMESSAGE = 65536
+
+def short(s):
+    b = str(s).encode('utf-8')[:255]
+    return bytes([len(b)]) + b
+
+def encode_value(v):
+    if isinstance(v, bool):
+        return b'?' + struct.pack('<?', v)
+    if isinstance(v, int) and -1 << 63 <= v < 1 << 63:
+        return b'q' + struct.pack('<q', v)
+    if isinstance(v, float):
+        return b'd' + struct.pack('<d', v)
+    s = str(v).encode('utf-8')[:65535]
+    return b's' + struct.pack('<H', len(s)) + s
+
+def encode(NAME, point, TIME, FIELDS=None):
+    # The message of point, with only the FIELDS given, None if it has none
+    fields = [short(k) + encode_value(v) for k, v in point['fields'].items()
+              if v is not None and (FIELDS is None or k in FIELDS)][:255]
+    if not fields:
+        return None
+    tags = [short(k) + short(v) for k, v in (point.get('tags') or {}).items()][:255]
+    name = short(NAME)
+    measurement = short(point['measurement'])
+    return b''.join([head.pack(TIME, name[0], measurement[0], len(tags), len(fields)),
+                     name[1:], measurement[1:]] + tags + fields)
+
+def decode(msg):
+    # A sample message as a dict of instrument, measurement, tags, time
+    # (ns) and fields
+    t, nname, nmeasurement, ntags, nfields = head.unpack_from(msg)
+    pos = head.size
+    def text(n):
+        nonlocal pos
+        pos += n
+        return bytes(msg[pos - n:pos]).decode('utf-8', 'replace')
+    def string():
+        nonlocal pos
+        pos += 1
+        return text(msg[pos - 1])
+    name = text(nname)
+    measurement = text(nmeasurement)
+    tags = {}
+    for i in range(ntags):
+        k = string()
+        tags[k] = string()
+    fields = {}
+    for i in range(nfields):
+        k = string()
+        kind = msg[pos:pos + 1]
+        pos += 1
+        if kind == b'd':
+            fields[k] = struct.unpack_from('<d', msg, pos)[0]
+            pos += 8
+        elif kind == b'q':
+            fields[k] = struct.unpack_from('<q', msg, pos)[0]
+            pos += 8
+        elif kind == b'?':
+            fields[k] = msg[pos] != 0
+            pos += 1
+        else:
+            n = struct.unpack_from('<H', msg, pos)[0]
+            pos += 2
+            fields[k] = text(n)
+    return {'instrument': name, 'measurement': measurement, 'tags': tags, 'time': t, 'fields': fields}
+
+# The publishing side, one per process, served by a thread accepting
+# subscribers and reading their filters. Samples are sent from the
+# acquisition threads themselves, on non-blocking sockets.
+class LiveBus:
+    def __init__(self, PATH):
+        self.path = PATH
+        if os.path.exists(PATH):
+            # Left by an earlier run
+            os.unlink(PATH)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(PATH)
+        self.sock.listen(16)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        # socket -> (instruments, fields), frozensets or None for all
+        self.subscribers = {}
+        # (name, measurement, tags) -> (type, point, time) of the last sample
+        self.latest = {}
+        self.sent = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve, name="livebus", daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self.sock:
+                    conn, _ = self.sock.accept()
+                    conn.setblocking(False)
+                    self.selector.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                try:
+                    msg = conn.recv(MAXMESSAGE)
+                except OSError:
+                    msg = b''
+                if not msg:
+                    self.unsubscribe(conn)
+                    continue
+                try:
+                    f = json.loads(msg)
+                    instruments = frozenset(f['instruments']) if f.get('instruments') else None
+                    fields = frozenset(f['fields']) if f.get('fields') else None
+                except (ValueError, TypeError, AttributeError) as e:
+                    logging.warning("Live bus: bad subscription: %s" % e)
+                    self.unsubscribe(conn)
+                    continue
+                self.subscribe(conn, instruments, fields)
+
+    def subscribe(self, conn, instruments, fields):
+        with self.lock:
+            self.subscribers[conn] = (instruments, fields)
+            for (name, measurement, tags), (type, point, t) in self.latest.items():
+                if instruments is None or name in instruments or type in instruments:
+                    self.send(conn, encode(name, point, t, fields))
+
+    def unsubscribe(self, conn):
+        with self.lock:
+            self.subscribers.pop(conn, None)
+        self.selector.unregister(conn)
+        conn.close()
+
+    def send(self, conn, msg):
+        if msg is None:
+            return
+        try:
+            conn.send(msg)
+            self.sent += 1
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError:
+            # Gone, unsubscribed once the serving thread sees it
+            pass
+
+    def publish(self, NAME, TYPE, points):
+        with self.lock:
+            for p in points:
+                t = lp_time(p.get('time'))
+                tags = p.get('tags')
+                self.latest[(NAME, p['measurement'], tuple(sorted(tags.items())) if tags else ())] = (TYPE, p, t)
+                # Encoded once per distinct field filter
+                msgs = {}
+                for conn, (instruments, fields) in self.subscribers.items():
+                    if instruments is not None and NAME not in instruments and TYPE not in instruments:
+                        continue
+                    if fields not in msgs:
+                        msgs[fields] = encode(NAME, p, t, fields)
+                    self.send(conn, msgs[fields])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "samples_sent": self.sent,
+                "samples_dropped": self.dropped
+            }
+
+# Publishing bus, None while the live bus is disabled
+bus = None
+
+def start(PATH):
+    global bus
+    bus = LiveBus(PATH)
+
+# Writer stage of one instrument, publishing its points before passing them
+# on to WRITER
+class LiveStage:
+    def __init__(self, WRITER, NAME, TYPE):
+        self.writer = WRITER
+        self.name = NAME
+        self.type = TYPE
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def write_points(self, points):
+        try:
+            bus.publish(self.name, self.type, points)
+        except Exception:
+            logging.exception("%s: live bus publish failed" % self.name)
+        return self.writer.write_points(points)
+
+def stage(NAME, TYPE, WRITER):
+    # WRITER, publishing on the live bus when it is enabled
+    if bus is None:
+        return WRITER
+    return LiveStage(WRITER, NAME, TYPE)
+
+# Subscriber side, yields the samples of the bus at PATH as decode() gives
+# them, of the INSTRUMENTS (names or types) and FIELDS given, or all
+def subscribe(PATH, INSTRUMENTS=None, FIELDS=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as sock:
+        sock.connect(PATH)
+        sock.send(json.dumps({"instruments": list(INSTRUMENTS or []), "fields": list(FIELDS or [])}).encode('utf-8'))
+        while True:
+            msg = sock.recv(MAXMESSAGE)
+            if not msg:
+                return
+            yield decode(msg)
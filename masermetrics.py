@@ -0,0 +1,179 @@
+import http.server
+import threading
+import time
+
+# Minimal Prometheus/OpenMetrics style metrics registry for the acquisition
+# hot paths, served as text exposition format on /metrics by serve().
+# Metrics are created once at module level, and their label children are
+# looked up, and created, with labels(). All updates take a lock, as the
+# instrument loops run in threads of one process.
+
+def escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def label_text(names, values, extra=''):
+    parts = ['%s="%s"' % (n, escape(v)) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{%s}' % ','.join(parts) if parts else ''
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def expose(self):
+        out = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for values, child in sorted(self.children.items()):
+            out += child.expose(self.name, self.labelnames, values)
+        return out
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def expose(self, name, names, values):
+        return ["%s_total%s %r" % (name, label_text(names, values), self.value)]
+
+class Counter(Metric):
+    kind = 'counter'
+    child = CounterChild
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, v):
+        self.value = v
+
+    def set_function(self, f):
+        # The value is read from f() when exposed
+        self.function = f
+
+    def expose(self, name, names, values):
+        v = self.function() if self.function else self.value
+        return ["%s%s %r" % (name, label_text(names, values), float(v))]
+
+class Gauge(Metric):
+    kind = 'gauge'
+    child = GaugeChild
+
+class HistogramChild:
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, v):
+        i = 0
+        while i < len(self.buckets) and v > self.buckets[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += v
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def expose(self, name, names, values):
+        out = []
+        total = 0
+        for le, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            out.append("%s_bucket%s %i" % (name, label_text(names, values, 'le="%s"' % ('+Inf' if le == float('inf') else repr(le))), total))
+        out.append("%s_sum%s %r" % (name, label_text(names, values), self.sum))
+        out.append("%s_count%s %i" % (name, label_text(names, values), total))
+        return out
+
+class HistogramTimer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.monotonic() - self.started)
+
+class Histogram(Metric):
+    kind = 'histogram'
+    child = HistogramChild
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def expose(self):
+        out = []
+        for m in self.metrics:
+            out += m.expose()
+        return '\n'.join(out) + '\n# EOF\n'
+
+REGISTRY = Registry()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(ADDRESS):
+    # ADDRESS is PORT or HOST:PORT, by default only served locally
+    host, _, port = str(ADDRESS).rpartition(':')
+    server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# Metrics of the acquisition loops, labelled with the instrument name
+serial_seconds = Histogram('masermon_serial_transaction_seconds', "Serial transaction latency", ['instrument'])
+sweep_seconds = Histogram('masermon_sweep_seconds', "Time to read one complete sample", ['instrument'])
+samples = Counter('masermon_samples', "Samples acquired", ['instrument'])
+retries = Counter('masermon_retries', "Serial transactions retried", ['instrument'])
+timeouts = Counter('masermon_timeouts', "Serial replies not received in time", ['instrument'])
+errors = Counter('masermon_errors', "Malformed or noisy replies", ['instrument'])
+resyncs = Counter('masermon_resyncs', "Instrument link resynchronisations", ['instrument'])
+restarts = Counter('masermon_restarts', "Acquisition loop restarts", ['instrument'])
+overruns = Counter('masermon_overruns', "Sample ticks missed by overrunning", ['instrument'])
+alarms = Counter('masermon_alarms', "Alarms raised", ['alarm'])
+# Metrics of the InfluxDB writer
+db_write_seconds = Histogram('masermon_db_write_seconds', "InfluxDB write request latency")
+db_errors = Counter('masermon_db_errors', "InfluxDB write failures")
+db_rejected = Counter('masermon_db_rejected', "Lines rejected by InfluxDB and dropped")
+db_reconnects = Counter('masermon_db_reconnects', "InfluxDB client connections made")
+db_queue = Gauge('masermon_db_queue_depth', "Points queued for InfluxDB")
+db_dropped = Gauge('masermon_db_dropped', "Points dropped because the queue was full")
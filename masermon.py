@@ -1,489 +1,342 @@
 #!/usr/bin/env python3
 
-import serial
+import atexit
 import time
+import os
+import signal
 import sys
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBServerError
-import datetime
-import json
 import traceback
-import click
-import binascii
-import re
+import importlib
 import logging
-# For Environ+ module
-from bme280 import BME280
-try:
-    from smbus2 import SMBus
-except ImportError:
-    from smbus import SMBus
-# For VE Direct module
-import argparse, os
-from vedirect import Vedirect
-
-efosb_channels = [
-    { "chan": 0,    "name": "InputA_U",       "signed": -128,   "scale": 0.230,   "offset": 0    },
-    { "chan": 1,    "name": "InputA_I",       "signed": -128,   "scale": 0.096,   "offset": 0    },
-    { "chan": 2,    "name": "InputB_U",       "signed": -128,   "scale": 0.230,   "offset": 0    },
-    { "chan": 3,    "name": "InputB_I",       "signed": -128,   "scale": 0.096,   "offset": 0    },
-    { "chan": 4,    "name": "Temp",           "signed": -128,   "scale": 0.960,   "offset": -1.1 },
-    { "chan": 5,    "name": "Hpress_set",     "signed": -128,   "scale": 0.096,   "offset": 0    },
-    { "chan": 6,    "name": "Hpress_read",    "signed": -128,   "scale": 0.096,   "offset": 0    },
-    { "chan": 7,    "name": "Palladium_heat", "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 8,    "name": "LO_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 9,    "name": "UO_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 10,   "name": "Dalle_heat",     "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 11,   "name": "LI_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 12,   "name": "UI_heat",        "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 13,   "name": "Cavity_heat",    "signed": -128,   "scale": 0.192,   "offset": 0    },
-    { "chan": 14,   "name": "Temp_cavity",    "signed": -128,   "scale": 0.010,   "offset": 0    },
-    { "chan": 15,   "name": "Temp_ambient",   "signed": -128,   "scale": 0.096,   "offset": 26   },
-    { "chan": 16,   "name": "Cavity_var",     "signed": -128,   "scale": 0.096,   "offset": 0    },
-    { "chan": 17,   "name": "C_field",        "signed": -128,   "scale": 1.920e-6,"offset": 0    },
-    { "chan": 18,   "name": "int_N2_HT_U",    "signed": -128,   "scale": 0.048e+3,"offset": 0    },
-    { "chan": 19,   "name": "int_N2_HT_I",    "signed": -128,   "scale": 19.00e-6,"offset": 0    },
-    { "chan": 20,   "name": "int_N1_HT_U",    "signed": -128,   "scale": 0.048e+3,"offset": 0    },
-    { "chan": 21,   "name": "int_N1_HT_I",    "signed": -128,   "scale": 19.00e-6,"offset": 0    },
-    { "chan": 22,   "name": "ext_HT_U",       "signed": -128,   "scale": 0.048e+3,"offset": 0    },
-    { "chan": 23,   "name": "ext_HT_I",       "signed": -128,   "scale": 19.00e-6,"offset": 0    },
-    { "chan": 24,   "name": "RF_U",           "signed": -128,   "scale": 0.298,   "offset": 0    },
-    { "chan": 25,   "name": "RF_I",           "signed": -128,   "scale": 0.010,   "offset": 0    },
-    { "chan": 26,   "name": "p24V",           "signed": -128,   "scale": 0.240,   "offset": 0    },
-    { "chan": 27,   "name": "p15V1",          "signed": -128,   "scale": 0.148,   "offset": 0    },
-    { "chan": 28,   "name": "n15V1",          "signed": -128,   "scale": 0.148,   "offset": 0    },
-    { "chan": 29,   "name": "p5V",            "signed": -128,   "scale": 0.148,   "offset": 0    },
-    { "chan": 30,   "name": "p15V2",          "signed": -128,   "scale": 0.148,   "offset": 0    },
-    { "chan": 31,   "name": "n15V2",          "signed": -128,   "scale": 0.148,   "offset": 0    },
-    { "chan": 32,   "name": "OCXO",           "signed": 0,      "scale": 0.078,   "offset": 0    },
-    { "chan": 33,   "name": "Ampl5.7k",       "signed": 0,      "scale": 0.078,   "offset": 0    },
-    { "chan": 34,   "name": "Lock",           "signed": 0,      "scale": 1.000,   "offset": 0    },
-]
-
-def is_number(s):
-    if s is None:
-        return False
-    if s.isnumeric():
-        return True
-    r = re.fullmatch('[+-]?([0-9]+)?[.]?[0-9]+([eE]([0-9]+))?',s)
-    if r:
-        return True
-    return False
-
-#with open('EFOS14.json') as f:
-#    s = f.read()
-#    channels = json.loads(s)
-
-def efosb_poll_chan(ser, chan):
-    cmd = "D%02d" % chan
-    for i in range(0, 5):
-        buf = b''
+import threading
+import click
+from maserwriter import InfluxWriter, MemoryQueue, CsvWriter
+from maserarchive import ColumnarWriter
+import maserarchive
+from maserspool import Spool
+from maserstats import StatsStage, AggregateStage
+import masermetrics
+import maseralarm
+import masercapture
+import maserlive
+import maserdev
+
+# Instrument drivers. Each instrument type is a module imported when an
+# instrument of that type is run, so a process only loads the libraries,
+# such as numpy or smbus2, of its own instruments, and a missing library
+# only stops the instruments needing it. A driver module has a table
+# driver = {
+#     'process': (acquisition loop, settings it takes after the writer),
+#     'replay':  (capture replay, settings it takes after the records),
+#     'probe':   (port probe, baud rate or None for the instrument
+#                 setting, timeout), optional
+#     'schema':  (columns of the points in the columnar archive, as
+#                 (tags, [(field, type)]), settings it takes), optional
+# }
+# Drivers of other packages are found through the "masermon.drivers"
+# entry point group, named by instrument type and loading to the module.
+builtin_drivers = {
+    'efosb':    'maserefosb',
+    'vch1006':  'maservch1006',
+    'hp5071a':  'maserhp5071a',
+    'dpm7885':  'maserdpm7885',
+    'bme280':   'maserbme280',
+    'ticcts':   'maserticcts',
+    'vedirect': 'maservedirect',
+}
+
+drivers = {}
+
+def driver_entry_points():
+    # Drivers of other packages, by type. Looked up only for types not
+    # built in, as entry_points(group=) needs Python 3.10, importlib.metadata
+    # 3.8, and older ones may have the importlib_metadata backport.
+    try:
         try:
-            for c in cmd:
-                ser.write(c.encode())
-                buf += ser.read()
-            s = ser.read(size=4)
-            buf += b'[' + s + b']'
-            if s.endswith((b'\r', b'\n')):
-                if len(s) == 4:
-                    r = int(s, 16)
-                    return (r, False)
-                else:
-                    print("Timeout")
-            else:
-                print("ERROR: malformed response", s)
-        except:
-            print("%s Channel %s Line Noise: %s" % (datetime.datetime.utcnow().isoformat(), chan, s))
-            print("Trace:")
-            print(buf)
+            from importlib.metadata import entry_points
+        except ImportError:
+            from importlib_metadata import entry_points
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group='masermon.drivers')
+        else:
+            eps = eps.get('masermon.drivers', [])
+        return {ep.name.lower(): ep for ep in eps}
+    except Exception as e:
+        logging.warning("No instrument driver plugins: %s" % e)
+        return {}
+
+def driver_known(TYPE):
+    type = TYPE.lower()
+    return type in builtin_drivers or type in driver_entry_points()
+
+def driver(TYPE):
+    # The driver table of instrument TYPE, imported on first use
+    type = TYPE.lower()
+    if type not in drivers:
+        if type in builtin_drivers:
+            module = importlib.import_module(builtin_drivers[type])
+        else:
+            eps = driver_entry_points()
+            if type not in eps:
+                raise KeyError("Unknown instrument type %s" % TYPE)
+            module = eps[type].load()
+        drivers[type] = module.driver
+    return drivers[type]
+
+def instrument_schema(TYPE, SETTINGS):
+    # The columnar archive columns of a TYPE instrument, None when its
+    # driver does not give them
+    if 'schema' not in driver(TYPE):
+        return None
+    schema, argnames = driver(TYPE)['schema']
+    try:
+        return schema(*[SETTINGS.get(a) for a in argnames])
+    except Exception as e:
+        logging.error("%s: no columnar schema: %s" % (TYPE, e))
+        return None
+
+def instrument_probe(TYPE, BAUDRATE):
+    # Function telling whether a device path is a TYPE instrument
+    import serial
+    probe, baudrate, timeout = driver(TYPE)['probe']
+    def check(path):
+        with serial.Serial(path, baudrate or BAUDRATE, timeout=timeout) as ser:
+            ser.reset_input_buffer()
+            return probe(ser)
+    return check
+
+# Replay of captured instrument logs (see masercapture) through the same
+# decoders as the acquisition loops, as fast as the log can be read. Each
+# replay generator takes the measurement, the records of a capture and the
+# instrument settings, and yields the points the loop would have written,
+# timestamped from the capture.
+def replay_process(WRITER, PATH, SETTINGS, BATCH=5000):
+    # Replay one capture into WRITER, returns the number of points
+    capture = masercapture.Capture(PATH)
+    maserid = SETTINGS.get('maserid') or capture.meta['maserid']
+    type = capture.meta['type']
+    replay, argnames = driver(type)['replay']
+    # Settings not given are those recorded with the capture
+    settings = dict(capture.meta, **{k: v for k, v in SETTINGS.items() if v is not None})
+    args = [settings.get(a) for a in argnames]
+    if isinstance(WRITER, ColumnarWriter):
+        WRITER = WRITER.instrument(type, maserid, instrument_schema(type, settings))
+    n = 0
+    points = []
+    for p in replay(maserid, capture.records(), *args):
+        points.append(p)
+        if len(points) >= BATCH:
+            WRITER.write_points(points)
+            n += len(points)
+            points = []
+    if points:
+        WRITER.write_points(points)
+        n += len(points)
+    return n
+
+def instrument_supervise(NAME, WRITER, SETTINGS, RESTARTDELAY):
+    # Run one acquisition loop forever, restarting it with exponential
+    # backoff if it fails. Other instruments keep running meanwhile. The
+    # device is looked up (see maserdev) at every start, and when it has
+    # gone, e.g. unplugged, or the loop failed on serial I/O, as when a USB
+    # adapter glitches and comes back under the same path, the loop is
+    # restarted as soon as the device is back, with a backoff from
+    # REATTACHDELAY instead.
+    type = SETTINGS['type'].lower()
+    try:
+        process, argnames = driver(type)['process']
+    except ImportError as e:
+        # Not to be cured by restarting
+        logging.error("%s: driver not available: %s" % (NAME, e))
+        return
+    spec = SETTINGS.get('device') if 'device' in argnames else None
+    writer = maserarchive.stage(type, SETTINGS.get('maserid'), instrument_schema(type, SETTINGS), WRITER)
+    writer = maseralarm.stage(NAME, type, maserlive.stage(NAME, type, writer))
+    delay = RESTARTDELAY
+    reattach = REATTACHDELAY
+    reattaching = False
+    while True:
+        settings = SETTINGS
+        if spec:
+            probe = instrument_probe(type, SETTINGS.get('baudrate')) if 'probe' in driver(type) else None
+            device = maserdev.wait_device(str(spec), probe, NAME)
+            settings = dict(SETTINGS, device=device)
+        args = [settings.get(a) for a in argnames]
+        started = time.monotonic()
+        ioerror = False
+        try:
+            process(writer, *args)
+            logging.error("%s: acquisition loop returned" % NAME)
+        except OSError as e:
+            # Also serial.SerialException
+            logging.error("%s: device I/O failed: %s" % (NAME, e))
+            ioerror = True
+        except Exception:
+            logging.error("%s: acquisition loop failed" % NAME)
             traceback.print_exc()
-            time.sleep(0.01)
-    return (-1, True)
-
-def efosb_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE):
-    with serial.Serial(SERIALDEVICE, BAUDRATE, timeout=2) as ser:
-        client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-        client.create_database(DATABASE)
-        client.switch_database(DATABASE)
-        fields = {}
-        s = ''
-        print("Syncing ...")
-        while len(s) < 10:
-            ser.write('F'.encode())
-            s = ser.read(size=10)
-            if len(s) < 10:
-                print(s)
-        print("Synthesizer f:", s.decode('ascii').strip())
-        while True:
-            timestamp = datetime.datetime.utcnow().isoformat()
-            for channel in efosb_channels:
-                val, err = efosb_poll_chan(ser, channel['chan'])
-                if not err:
-                    fields[channel['name']] = (val + channel['signed']) * channel['scale'] + channel['offset']
-            json_body = [
-                {
-                    "measurement": MASERID,
-                    "tags": {
-                        "masetype": "EFOS-B",
-                        "maser": MASERID
-                     },
-                    "time": timestamp,
-                    "fields": fields
-                }
-            ]
-            client.write_points(json_body)
-            time.sleep(LOGRATE)
-
-def vch1006_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE):
-    with serial.Serial(SERIALDEVICE, BAUDRATE, timeout=2) as ser:
-       print("Test connection")
-       ser.write(b'\x01')
-       ser.write(b'\x41')
-       ser.write(b'\x00')
-       ser.write(b'\x00')
-       ser.write(b'\x00')
-       buf = ser.read(189)
-       s = binascii.hexlify(bytearray(buf))
-       print(s)
-
-def scpi_write(SER, STR):
-    SER.write(str.encode(STR+"\r\n"))
-    s = SER.readline()
-
-def scpi_read_line(SER):
-    s = SER.readline()
-    return s.decode("utf-8").rstrip()
-
-def scpi_read_string(SER):
-    s = scpi_read_line(SER)
-    return re.sub(r'"', '', s)
-
-def scpi_read_int(SER):
-    s = scpi_read_line(SER)
-    return int(s)
-
-def scpi_read_intvec(SER):
-    s = scpi_read_line(SER)
-    return [int(x) for x in s.split(',')]
-
-def scpi_read_float(SER):
-    s = scpi_read_line(SER)
-    return float(s)
-
-def scpi_read_floatvec(SER):
-    s = scpi_read_line(SER)
-    return [float(x) for x in s.split(',')]
-       
-def hp5071a_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE):
-    with serial.Serial(SERIALDEVICE, BAUDRATE, bytesize=8, parity='N', stopbits=1, xonxoff=1, timeout=2) as ser:
-        #client = InfluxDBClient(host='localhost', port=8086)
-        #client = InfluxDBClient(host='labpi.rubidium.se', port=8086, ssl=True, ssl_verify=True)
-        client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-        client.create_database(DATABASE)
-        client.switch_database(DATABASE)
-        # Start up and get Identity
-        scpi_write(ser, "")
-        scpi_write(ser, "*IDN?")
-        s = scpi_read_line(ser)
-        # Extract serial number from *IDN? string
-        snr = int(re.split(r'[\,]+', s)[3])
-        while True:
-            timestamp = datetime.datetime.utcnow().isoformat()
-            scpi_write(ser, "PTIM:MJD?")
-            mjd = scpi_read_int(ser)
-            scpi_write(ser, "PTIM?")
-            ssplit = scpi_read_intvec(ser)
-            hour = ssplit[0]
-            min = ssplit[1]
-            sec = ssplit[2]
-            scpi_write(ser, "DIAG:CBTSerial?")
-            CBTID = scpi_read_string(ser)
-            scpi_write(ser, "DIAG:STAT?")
-            CONT = scpi_read_string(ser)
-            scpi_write(ser, "DIAG:CURR:BEAM?")
-            CURR_BEAM = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:CURR:CField?")
-            CURR_CFIELD = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:CURR:PUMP?")
-            CURR_PUMP = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:GAIN?")
-            GAIN = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:RFAMplitude?")
-            RF_AMP = scpi_read_floatvec(ser)
-            scpi_write(ser, "DIAG:TEMP?")
-            TEMP = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:VOLT:COVen?")
-            COVEN = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:VOLT:EMUL?")
-            EMUL = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:VOLT:HWIonizer?")
-            HWI = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:VOLT:MSPec?")
-            MSP = scpi_read_float(ser)
-            scpi_write(ser, "DIAG:VOLT:PLLoop?")
-            PLL = scpi_read_floatvec(ser)
-            PLL9_2 = PLL[0]
-            PLL640 = PLL[1]
-            PLL87  = PLL[2]
-            PLL9   = PLL[3]
-            scpi_write(ser, "DIAG:VOLT:SUPPly?")
-            SUPP = scpi_read_floatvec(ser)
-            VP5V = SUPP[0]
-            VP12V = SUPP[1]
-            VN12V = SUPP[2]
-            scpi_write(ser, "DIAG:STAT:SUPPly?")
-            SUPP = scpi_read_string(ser)
-            json_body = [
-                {
-                "measurement": MASERID,
-                "tags": {
-                    "masertype": "HP5071A",
-                    "maser": snr,
-                    "tube": CBTID
-                },
-                "time": timestamp,
-                "fields": {
-                    "Supply": SUPP,
-                    "+5V": VP5V,
-                    "+12V": VP12V,
-                    "-12V": VN12V,
-                    "Temp": TEMP,
-                    "MJD": mjd,
-                    "Cont OpStatus": CONT,
-                    "Beam Current": CURR_BEAM,
-                    "C-field Current": CURR_CFIELD,
-                    "Ionpump Current": CURR_PUMP,
-                    "Gain": GAIN,
-                    "RF Amplitude 1": RF_AMP[0],
-                    "RF Amplitude 2": RF_AMP[1],
-                    "Cesium Oven Voltage": COVEN,
-                    "Electron Multiplier Voltage": EMUL,
-                    "Hot Wire Ionizer Voltage": HWI,
-                    "Mass Spectrometer Voltage": MSP,
-                    "DRO Tuning Voltage": PLL9_2,
-                    "SAW Tuning Voltage": PLL640,
-                    "87 MHz Tuning Voltage": PLL87,
-                    "uC clock Tuning Voltage": PLL9
-                    }
-                }
-            ]
-            client.write_points(json_body)
-            time.sleep(LOGRATE)
-
-def dpm7885_write(SER, S):
-    SER.write(str.encode(S+"\r\n"))
-    s = SER.readline()
-    return s.decode("utf-8").rstrip()
-
-def dpm7885_sync(SER):
-    s = SER.readline()
-    while s != b'':
-        s = SER.readline()
-
-def dpm7885_init(SER):
-    dpm7885_write(SER, "")
-    dpm7885_write(SER, "$MS")
-    dpm7885_sync(SER)
-    dpm7885_write(SER, "$SU3")
-            
-def dpm7885_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE):
-    with serial.Serial(SERIALDEVICE, BAUDRATE, bytesize=8, parity='N', stopbits=1, xonxoff=1, timeout=2) as ser:
-        client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-        client.create_database(DATABASE)
-        client.switch_database(DATABASE)
-        # Start up and get Identity
-        dpm7885_init(ser)
-        # Get ID and Serial numbers
-        type = dpm7885_write(ser, "$TT")
-        while type == '':
-            type = dpm7885_write(ser, "$TT")
-        s = dpm7885_write(ser, "$TS")
-        while s == '':
-            s = dpm7885_write(ser, "$TS")
-        s = re.sub(r'\+', '', s)
-        snr = int(re.split(r' ', s)[0])
-        cynr = int(re.split(r' ', s)[1])
-        canr = int(re.split(r' ', s)[2])
-        while True:
-            try:
-                timestamp = datetime.datetime.utcnow().isoformat()
-                s = dpm7885_write(ser, "$MR")
-                assert is_number(s)
-                pressure = 100*float(s)
-                s = dpm7885_write(ser, "$MT")
-                assert is_number(s)
-                temp = float(s)
-                assert temp < 200
-                #print("%f %f" % (pressure, temp))
-                json_body = [
-                    {
-                        "measurement": MASERID,
-                        "tags": {
-                            "masertype": "dpm7885",
-                            "snr": snr,
-                            "cylinernr" : cynr,
-                            "calnr": canr
-                        },
-                        "time": timestamp,
-                        "fields": {
-                            "Pressure": pressure,
-                            "Temp": temp
-                        }
-                    }
-                ]
-                client.write_points(json_body)
-                time.sleep(LOGRATE)
-            except AssertionError as e:
-               logging.error(e)
-               dpm7885_init(ser)
-            except InfluxDBServerError as e:
-                logging.error(e)
-                client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-                client.create_database(DATABASE)
-                client.switch_database(DATABASE)
-                time.sleep(1)
-
-def environplus_process(HOST, PORT, DATABASE, MASERID, LOGRATE):
-        client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-        client.create_database(DATABASE)
-        client.switch_database(DATABASE)
-        bus = SMBus(1)
-        bme280 = BME280(i2c_dev=bus)
-        while True:
-            timestamp = datetime.datetime.utcnow().isoformat()
-            temperature = bme280.get_temperature()
-            pressure = 100.0 * bme280.get_pressure()
-            humidity = bme280.get_humidity()
-            json_body = [
-                {
-                    "measurement": MASERID,
-                    "tags": {
-                        "masertype": "bme280"
-                    },
-                    "time": timestamp,
-                    "fields": {
-                        "Pressure": pressure,
-                        "Temp": temperature,
-                        "Humidity": humidity
-                    }
-                }
-            ]
-            client.write_points(json_body)
-            time.sleep(LOGRATE)
-
-            
-def ticcts_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE):
-    with serial.Serial(SERIALDEVICE, 115200, bytesize=8, parity='N', stopbits=1, xonxoff=1, timeout=2) as ser:
-        client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-        client.create_database(DATABASE)
-        client.switch_database(DATABASE)
-        # Sync by throwing first line
-        s = ser.readline()
-        while True:
-            try:
-                s = ser.readline().decode("utf-8").rstrip()
-                timestamp = datetime.datetime.utcnow().isoformat()
-                t = float(re.split(r' ', s)[0])
-                ch = re.split(r' ', s)[1]
-                if ch == 'chA':
-                    ta = t
-                    json_body = [
-                        {
-                            "measurement": MASERID,
-                            "tags": {
-                                "masertype": "ticc",
-                                "mode": "ts"
-                            },
-                            "time": timestamp,
-                            "fields": {
-                                "TA": ta
-                            }
-                        }
-                    ]
-                    client.write_points(json_body)
-                else:
-                    tb = t
-                    tc = ta - tb
-                    json_body = [
-                        {
-                            "measurement": MASERID,
-                            "tags": {
-                                "masertype": "ticc",
-                                "mode": "ts"
-                            },
-                            "time": timestamp,
-                            "fields": {
-                                "TB": tb,
-                                "TC": tc
-                            }
-                        }
-                    ]
-                    client.write_points(json_body)
-            except AssertionError as e:
-                logging.error(e)
-            except InfluxDBServerError as e:
-                logging.error(e)
-                client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-                client.create_database(DATABASE)
-                client.switch_database(DATABASE)
-                time.sleep(1)
-            
-def vedirect_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE):
-        client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-        client.create_database(DATABASE)
-        client.switch_database(DATABASE)        
-        ve = Vedirect(SERIALDEVICE, 60)
-
-        def vedirect_callback(packet):
-            timestamp = datetime.datetime.utcnow().isoformat()
-            for key, value in packet.items():
-                #print(key)
-                #print(value)
-                if key == 'V':
-                    V = float(value)/1000
-                if key == 'I':
-                    I = float(value)/1000
-                if key == 'VPV':
-                    VPV = float(value)/1000
-                if key == 'PPV':
-                    PPV = float(value)
-                if key == 'IL':
-                    IL = float(value)/1000
-            #print("V   = %+7.3f V" % V)
-            #print("I   = %+7.2f A" % I)
-            #print("VPV = %+7.3f V" % VPV)
-            #print("PPV = %+7.0f W" % PPV)
-            #print("IL  = %+7.2f A" % IL)
-            json_body = [
-                {
-                    "measurement": MASERID,
-                    "tags": {
-                        "masertype": "vedirect"
-                    },
-                    "time": timestamp,
-                    "fields": {
-                        "V": V,
-                        "I": I,
-                        "VPV": VPV,
-                        "PPV": PPV,
-                        "IL": IL
-                    }
-                }
-            ]
-            client.write_points(json_body)
-
-        while True:
-            try:
-                #print(ve.read_data_callback(print_data_callback))
-                vv = ve.read_data_callback(vedirect_callback)
-            except AssertionError as e:
-                logging.error(e)
-            except InfluxDBServerError as e:
-                logging.error(e)
-                client = InfluxDBClient(host=HOST, port=PORT, ssl=True, verify_ssl=True)
-                client.create_database(DATABASE)
-                client.switch_database(DATABASE)
-                time.sleep(1)
+        finally:
+            if spec:
+                # Not to be probed by other instruments meanwhile
+                maserdev.release(device, NAME, REATTACHHOLD)
+        masermetrics.restarts.labels(NAME).inc()
+        if time.monotonic() - started > 10 * RESTARTDELAY:
+            delay = RESTARTDELAY
+            reattach = REATTACHDELAY
+            reattaching = False
+        if spec and (ioerror or not maserdev.present(device)):
+            reattaching = True
+        if reattaching:
+            # Until it runs again, also while the new device node settles
+            print("%s: %s lost, reattaching in %.2f s" % (NAME, device, reattach))
+            time.sleep(reattach)
+            reattach = min(2 * reattach, RESTARTDELAY)
+            continue
+        print("%s: restarting in %.0f s" % (NAME, delay))
+        time.sleep(delay)
+        delay = min(2 * delay, 300)
+
+# First delay before a loop is restarted on a device that came back
+REATTACHDELAY = 0.05
+# Time the device of a failed loop is kept from other instruments
+REATTACHHOLD = 30
+
+def instrument_run(ctx, TYPE, **SETTINGS):
+    # One instrument from the command line, supervised as by run
+    settings = dict(instrument_defaults)
+    settings.update(ctx.obj)
+    settings.update(SETTINGS, type=TYPE)
+    alarm_start(ctx)
+    writer = maser_writer(ctx)
+    writer_shutdown(writer)
+    instrument_supervise("%s %s" % (TYPE, ctx.obj['maserid']), writer, settings, 10)
+
+# Defaults for settings of individual instruments
+instrument_defaults = {
+    'channels': None,
+    'pipeline': 1,
+    'intervals': None,
+    'adaptive': False,
+    'fastest': None,
+    'queries': None,
+    'batch': 8,
+    'decimate': 1,
+    'fields': None,
+    'hexrate': None,
+    'layout': None,
+    'archive': None,
+    'stream': None,
+    'bus': 1,
+    'addresses': None,
+    'mode': 'forced',
+    'oversampling': None,
+    'filter': 0,
+    'standby': 62.5,
+}
+
+def supervisor_process(WRITER, DEFAULTS, CONFIG):
+    threads = []
+    for i, cfg in enumerate(CONFIG.get('instrument', [])):
+        settings = dict(instrument_defaults)
+        settings.update(DEFAULTS)
+        settings.update(cfg)
+        if not driver_known(settings['type']):
+            raise click.UsageError("Unknown instrument type %s" % settings['type'])
+        if not isinstance(settings['decimate'], int) or settings['decimate'] < 1:
+            raise click.UsageError("%s: decimate must be a whole number of at least 1" % settings['type'])
+        name = settings.get('name', "%s%i" % (settings['type'], i))
+        restartdelay = settings.get('restartdelay', 10)
+        t = threading.Thread(target=instrument_supervise, name=name,
+                             args=(name, WRITER, settings, restartdelay), daemon=True)
+        threads.append(t)
+    for t in threads:
+        print("Starting %s" % t.name)
+        t.start()
+    # Report the shared writer state while the instruments run
+    while any(t.is_alive() for t in threads):
+        time.sleep(60)
+        print("Writer: %s" % WRITER.stats())
+
+def maser_writer(ctx):
+    if ctx.obj['spool']:
+        queue = Spool(ctx.obj['spool'], MAXBYTES=ctx.obj['spoolsize'] << 20)
+    else:
+        queue = MemoryQueue(ctx.obj['maxqueue'])
+    writer = InfluxWriter(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'],
+                          BATCHSIZE=ctx.obj['batchsize'], FLUSHINTERVAL=ctx.obj['flushinterval'],
+                          QUEUE=queue)
+    if ctx.obj['aggregate']:
+        writer = AggregateStage(writer, ctx.obj['aggregate'])
+    if ctx.obj['columnar']:
+        # Full rate points, by instrument (see instrument_supervise)
+        maserarchive.start(ctx.obj['columnar'], ctx.obj['columnarformat'], ctx.obj['columnarroll'])
+    if ctx.obj['stats']:
+        writer = StatsStage(writer, ctx.obj['stats'], INTERVAL=ctx.obj['statsrate'])
+    return writer
+
+def writer_shutdown(WRITER, TIMEOUT=30):
+    # Close WRITER at exit, also on SIGTERM as from systemd, so points
+    # still buffered, e.g. in the columnar archive or rollups, are written
+    closed = []
+    def close():
+        if not closed:
+            closed.append(True)
+            # A further SIGTERM, e.g. one to the whole process group, must
+            # not cut the close short
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            writer_close(WRITER, TIMEOUT)
+    def terminate(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+    atexit.register(close)
+    signal.signal(signal.SIGTERM, terminate)
+
+def writer_close(WRITER, TIMEOUT):
+    # The archive first, it should not wait for the network
+    if maserarchive.archive is not None:
+        maserarchive.archive.close(TIMEOUT)
+    WRITER.close(TIMEOUT)
+
+def columnar_writer(ctx, DIR):
+    return ColumnarWriter(DIR, FORMAT=ctx.obj['columnarformat'], ROLL=ctx.obj['columnarroll'])
+
+def alarm_start(ctx):
+    if ctx.obj['alarm']:
+        maseralarm.start(ctx.obj['alarm'], EXEC=ctx.obj['alarmexec'], SOCKET=ctx.obj['alarmsocket'],
+                         HOLDOFF=ctx.obj['alarmholdoff'])
+
+def alarm_rule(s):
+    # FIELD<LIMIT, FIELD>LIMIT or FIELD!=VALUE
+    for op, kind in (('!=', 'expect'), ('<', 'below'), ('>', 'above')):
+        field, sep, value = s.partition(op)
+        if sep:
+            break
+    else:
+        raise click.BadParameter("expected FIELD<LIMIT, FIELD>LIMIT or FIELD!=VALUE", param_hint='--alarm')
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if kind != 'expect':
+        if number is None:
+            raise click.BadParameter("limit %s is not a number" % value, param_hint='--alarm')
+        value = number
+    elif number is not None:
+        # Numeric samples, such as the EFOS-B Lock, are floats
+        value = number
+    return {'field': field.strip(), kind: value}
+
+def stats_rule(s):
+    # FIELD, MEASUREMENT.FIELD, optionally followed by :phase
+    rule = {}
+    if s.endswith(':phase'):
+        rule['phase'] = True
+        s = s[:-len(':phase')]
+    if '.' in s:
+        rule['measurement'], s = s.split('.', 1)
+    rule['field'] = s
+    return rule
 
 @click.group()
 @click.option('--host', default='localhost', help="InfluxDB host (default localhost)")
@@ -492,9 +345,26 @@ def vedirect_process(HOST, PORT, DATABASE, MASERID, SERIALDEVICE):
 @click.option('--maserid', default='maserdata', help="InfluxDB data name for maser data (default maserdata)")
 @click.option('--device', default='/dev/ttyUSB0', help="Serial port device (default /dev/ttyUSB0")
 @click.option('--baudrate', default=9600 , help="Serial port baudrate (default 9600)")
-@click.option('--lograte', default=10, help="Log-rate in seconds (default 10 s)")
+@click.option('--lograte', default=10.0, help="Log-rate in seconds, aligned to UTC (default 10 s)")
+@click.option('--batchsize', default=5000, help="InfluxDB points per write (default 5000)")
+@click.option('--flushinterval', default=1.0, help="InfluxDB max time points are held before write in seconds (default 1 s)")
+@click.option('--maxqueue', default=100000, help="InfluxDB max queued points, oldest dropped beyond (default 100000)")
+@click.option('--spool', default=None, help="Spool directory, points are stored there until written to InfluxDB (default none, kept in memory)")
+@click.option('--spoolsize', default=1024, help="Spool max disk usage in MB (default 1024)")
+@click.option('--stats', multiple=True, help="Field to keep running statistics and Allan deviation of, as [MEASUREMENT.]FIELD[:phase] (repeatable)")
+@click.option('--statsrate', default=60.0, help="Statistics write rate in seconds (default 60 s)")
+@click.option('--metrics', default=None, help="Serve metrics for Prometheus on [HOST:]PORT (default off, HOST default 127.0.0.1)")
+@click.option('--capture', default=None, help="Directory to capture the raw instrument byte streams in, for masermon replay (default off)")
+@click.option('--columnar', default=None, help="Directory to also archive the points in as columnar files (default off)")
+@click.option('--columnarformat', default='parquet', type=click.Choice(['parquet', 'arrow']), help="Columnar file format, Parquet or Arrow IPC (default parquet)")
+@click.option('--columnarroll', default='hour', type=click.Choice(['hour', 'day']), help="Start a new columnar file every hour or day (default hour)")
+@click.option('--live', default=None, help="Unix socket to publish every sample on for local subscribers, see masermon watch (default off)")
+@click.option('--alarm', multiple=True, help="Alarm on a field, as FIELD<LIMIT, FIELD>LIMIT or FIELD!=VALUE (repeatable)")
+@click.option('--alarmexec', default=None, help="Command run on each alarm raised or cleared, with the alarm as JSON on stdin (default none)")
+@click.option('--alarmsocket', default=None, help="Unix datagram socket to send each alarm to as JSON (default none)")
+@click.option('--alarmholdoff', default=60.0, help="Least time between reports of one alarm in seconds (default 60 s)")
 @click.pass_context
-def maser(ctx, host, port, device, baudrate, database, maserid, lograte):
+def maser(ctx, host, port, device, baudrate, database, maserid, lograte, batchsize, flushinterval, maxqueue, spool, spoolsize, stats, statsrate, metrics, capture, columnar, columnarformat, columnarroll, live, alarm, alarmexec, alarmsocket, alarmholdoff):
     ctx.ensure_object(dict)
     ctx.obj['host'] = host
     ctx.obj['port'] = port
@@ -503,56 +373,225 @@ def maser(ctx, host, port, device, baudrate, database, maserid, lograte):
     ctx.obj['device'] = device
     ctx.obj['baudrate'] = baudrate
     ctx.obj['lograte'] = lograte
+    ctx.obj['batchsize'] = batchsize
+    ctx.obj['flushinterval'] = flushinterval
+    ctx.obj['maxqueue'] = maxqueue
+    ctx.obj['spool'] = spool
+    ctx.obj['spoolsize'] = spoolsize
+    ctx.obj['stats'] = [stats_rule(s) for s in stats]
+    ctx.obj['statsrate'] = statsrate
+    ctx.obj['aggregate'] = []
+    ctx.obj['columnar'] = columnar
+    ctx.obj['columnarformat'] = columnarformat
+    ctx.obj['columnarroll'] = columnarroll
+    ctx.obj['alarm'] = [alarm_rule(s) for s in alarm]
+    ctx.obj['alarmexec'] = alarmexec
+    ctx.obj['alarmsocket'] = alarmsocket
+    ctx.obj['alarmholdoff'] = alarmholdoff
+    if metrics:
+        masermetrics.serve(metrics)
+    if capture:
+        masercapture.start(capture)
+    if live:
+        maserlive.start(live)
 
 @maser.command()
+@click.option('--channels', default=None, type=click.Path(exists=True), help="Channel map JSON file, such as EFOS14.json (default built-in)")
+@click.option('--pipeline', default=1, help="Channel commands sent ahead of replies (default 1)")
+@click.option('--interval', 'intervals', multiple=True, help="Poll channel NAME every SECONDS, as NAME=SECONDS, repeatable (default --lograte)")
+@click.option('--adaptive', is_flag=True, help="Poll channels faster while they move, slower again when stable")
+@click.option('--fastest', default=None, type=float, help="Shortest adaptive poll interval in seconds (default the shortest --interval)")
 @click.pass_context
-def efosb(ctx):
+def efosb(ctx, channels, pipeline, intervals, adaptive, fastest):
     "EFOS-B active maser protocol"
-    print("EFOS-B protocol for %s using device % at rate %i" % (ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
-    efosb_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate'], ctx.obj['lograte'])
+    print("EFOS-B protocol for %s using device %s at rate %i" % (ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
+    try:
+        intervals = {n: float(s) for n, s in (i.rsplit('=', 1) for i in intervals)}
+    except ValueError:
+        raise click.BadParameter("expected NAME=SECONDS", param_hint='--interval')
+    instrument_run(ctx, 'efosb', channels=channels, pipeline=pipeline, intervals=intervals or None,
+                   adaptive=adaptive, fastest=fastest)
 
 @maser.command()
+@click.option('--layout', default=None, type=click.Path(exists=True), help="Status block layout JSON file naming the fields (default raw words)")
+@click.option('--archive', default=None, type=click.Path(file_okay=False), help="Directory to archive the raw status blocks in")
+@click.option('--redecode', multiple=True, type=click.Path(exists=True), help="Decode and write an archive file instead of reading the maser, may be repeated")
 @click.pass_context
-def vch1006(ctx):
+def vch1006(ctx, layout, archive, redecode):
     "VCH1006 passive maser protocol"
-    print("VCH1006 protocol for %s using device % at rate %i" % (ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
-    vch1006_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate'], ctx.obj['lograte'])
+    if redecode:
+        from maservch1006 import vch1006_redecode
+        writer = maser_writer(ctx)
+        schema = instrument_schema('vch1006', {'layout': layout})
+        vch1006_redecode(maserarchive.stage('vch1006', ctx.obj['maserid'], schema, writer), ctx.obj['maserid'], redecode, layout)
+        writer_close(writer, 60)
+        return
+    print("VCH1006 protocol for %s using device %s at rate %i" % (ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
+    instrument_run(ctx, 'vch1006', layout=layout, archive=archive)
     
 @maser.command()
+@click.option('--queries', default=None, type=click.Path(exists=True), help="Query set JSON file, such as HP5071A.json (default built-in)")
+@click.option('--batch', default=8, help="Queries per compound SCPI message (default 8)")
 @click.pass_context
-def HP5071A(ctx):
+def HP5071A(ctx, queries, batch):
     "HP5071A cesium protocol"
-    print("HP5071A protocol for %s %s using device % at rate %i" % (ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
-    hp5071a_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate'], ctx.obj['lograte'])
+    print("HP5071A protocol for %s %s using device %s at rate %i" % (ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
+    instrument_run(ctx, 'hp5071a', queries=queries, batch=batch)
 
 @maser.command()
+@click.option('--stream', default=None, help="Command starting the continuous output of the unit, to read it instead of polling every --lograte (default polling)")
 @click.pass_context
-def DPM7885(ctx):
+def DPM7885(ctx, stream):
     "DPM7885 pressure sensor"
     print("DPM7885 pressure sensor for %s %s using device %s at rate %i" % (ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate']))
-    dpm7885_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'], ctx.obj['baudrate'], ctx.obj['lograte'])
+    instrument_run(ctx, 'dpm7885', stream=stream)
 
 @maser.command()
+@click.option('--bus', default=1, help="I2C bus number (default 1)")
+@click.option('--address', 'addresses', multiple=True, type=lambda a: int(a, 0), metavar='ADDRESS', help="Sensor I2C address, repeat for several sensors on the bus (default 0x76)")
+@click.option('--mode', default='forced', type=click.Choice(['forced', 'normal']), help="Trigger each sample, or let the sensor measure continuously (default forced)")
+@click.option('--oversampling', default='1,1,1', help="Temperature, pressure and humidity oversampling, 0 to skip (default 1,1,1)")
+@click.option('--filter', 'iirfilter', default=0, type=click.Choice(['0', '2', '4', '8', '16']), help="IIR filter coefficient (default 0, off)")
+@click.option('--standby', default='62.5', type=click.Choice(['0.5', '10', '20', '62.5', '125', '250', '500', '1000']), help="Normal mode standby time in ms (default 62.5)")
 @click.pass_context
-def bme280(ctx):
+def bme280(ctx, bus, addresses, mode, oversampling, iirfilter, standby):
     "Environ+ BME280 sensor"
-    print("Environ+ BME280 sensor for %s %s at rate %i" %( ctx.obj['database'], ctx.obj['maserid'], ctx.obj['lograte']))
-    environplus_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['lograte'])
+    print("Environ+ BME280 sensor for %s %s at rate %g s" %( ctx.obj['database'], ctx.obj['maserid'], ctx.obj['lograte']))
+    instrument_run(ctx, 'bme280', bus=bus, addresses=list(addresses) or None, mode=mode,
+                   oversampling=[int(o) for o in oversampling.split(',')], filter=int(iirfilter), standby=float(standby))
 
 @maser.command()
+@click.option('--decimate', default=1, type=click.IntRange(min=1), help="Average this many chA/chB pairs per stored sample (default 1)")
 @click.pass_context
-def ticcts(ctx):
+def ticcts(ctx, decimate):
     "TADR TICC Time Stamp mode"
     print("TADR TICC time-stamp for %s %s using device %s" %( ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device']))
-    ticcts_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'])
+    instrument_run(ctx, 'ticcts', decimate=decimate)
 
 @maser.command()
+@click.option('--fields', default='V,I,VPV,PPV,IL', help="Comma separated fields to store (default V,I,VPV,PPV,IL)")
+@click.option('--hexrate', default=None, type=float, help="Poll the fields with HEX commands every HEXRATE seconds (default text frames only)")
 @click.pass_context
-def vedirect(ctx):
+def vedirect(ctx, fields, hexrate):
     "VE Direct MPPT mode"
     print("VE Direct MPPT for %s %s using device %s" %( ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device']))
-    vedirect_process(ctx.obj['host'], ctx.obj['port'], ctx.obj['database'], ctx.obj['maserid'], ctx.obj['device'])
-    
+    instrument_run(ctx, 'vedirect', fields=fields.split(','), hexrate=hexrate)
+
+@maser.command()
+@click.option('--config', required=True, type=click.Path(exists=True), help="Site configuration file (TOML)")
+@click.pass_context
+def run(ctx, config):
+    "All instruments of a site in one process"
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(config, 'rb') as f:
+        cfg = tomllib.load(f)
+    # [influxdb] settings override the command line ones
+    db = cfg.get('influxdb', {})
+    ctx.obj['host'] = db.get('host', ctx.obj['host'])
+    ctx.obj['port'] = db.get('port', ctx.obj['port'])
+    ctx.obj['database'] = db.get('database', ctx.obj['database'])
+    ctx.obj['batchsize'] = db.get('batchsize', ctx.obj['batchsize'])
+    ctx.obj['flushinterval'] = db.get('flushinterval', ctx.obj['flushinterval'])
+    ctx.obj['maxqueue'] = db.get('maxqueue', ctx.obj['maxqueue'])
+    ctx.obj['spool'] = db.get('spool', ctx.obj['spool'])
+    ctx.obj['spoolsize'] = db.get('spoolsize', ctx.obj['spoolsize'])
+    ctx.obj['stats'] = ctx.obj['stats'] + cfg.get('stats', [])
+    ctx.obj['statsrate'] = cfg.get('statsrate', ctx.obj['statsrate'])
+    ctx.obj['aggregate'] = cfg.get('aggregate', [])
+    # [columnar] local archive
+    columnar = cfg.get('columnar', {})
+    ctx.obj['columnar'] = columnar.get('dir', ctx.obj['columnar'])
+    ctx.obj['columnarformat'] = columnar.get('format', ctx.obj['columnarformat'])
+    ctx.obj['columnarroll'] = columnar.get('roll', ctx.obj['columnarroll'])
+    if 'metrics' in cfg:
+        masermetrics.serve(cfg['metrics'])
+    if 'capture' in cfg:
+        masercapture.start(cfg['capture'])
+    if 'live' in cfg:
+        maserlive.start(cfg['live'])
+    # [[alarm]] rules, [alarms] hooks
+    alarms = cfg.get('alarms', {})
+    ctx.obj['alarm'] = ctx.obj['alarm'] + cfg.get('alarm', [])
+    ctx.obj['alarmexec'] = alarms.get('exec', ctx.obj['alarmexec'])
+    ctx.obj['alarmsocket'] = alarms.get('socket', ctx.obj['alarmsocket'])
+    ctx.obj['alarmholdoff'] = alarms.get('holdoff', ctx.obj['alarmholdoff'])
+    try:
+        alarm_start(ctx)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    print("Site %s running %i instruments for %s %s" % (config, len(cfg.get('instrument', [])), ctx.obj['host'], ctx.obj['database']))
+    writer = maser_writer(ctx)
+    writer_shutdown(writer)
+    supervisor_process(writer, ctx.obj, cfg)
+
+@maser.command()
+@click.option('--probe', 'probe_types', multiple=True, help="Probe the ports for this instrument type (repeatable)")
+@click.pass_context
+def devices(ctx, probe_types):
+    "List serial ports and the device specs matching them"
+    from serial.tools import list_ports
+    for t in probe_types:
+        if not driver_known(t) or 'probe' not in driver(t):
+            raise click.UsageError("No probe for instrument type %s" % t)
+    for port in list_ports.comports():
+        found = []
+        for t in probe_types:
+            try:
+                if instrument_probe(t, ctx.obj['baudrate'])(port.device):
+                    found.append(t)
+            except Exception:
+                pass
+        print("%-16s %-28s %-14s %s %s" % (port.device, maserdev.describe(port),
+              "usb@%s" % port.location.split(':')[0] if port.location else '',
+              port.description, ' '.join(found)))
+
+@maser.command()
+@click.argument('socket', type=click.Path(exists=True, dir_okay=False))
+@click.option('--instrument', 'instruments', multiple=True, help="Instrument name or type to show (repeatable, default all)")
+@click.option('--field', 'fields', multiple=True, help="Field to show (repeatable, default all)")
+@click.pass_context
+def watch(ctx, socket, instruments, fields):
+    "Show the samples published on a live bus socket as they come"
+    for s in maserlive.subscribe(socket, instruments, fields):
+        print("%s %s %s %s" % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(s['time'] // 1000000000)) + ".%03iZ" % (s['time'] // 1000000 % 1000),
+              s['instrument'], s['measurement'], ' '.join("%s=%s" % (k, v) for k, v in s['fields'].items())), flush=True)
+
+@maser.command()
+@click.argument('captures', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--measurement', default=None, help="Measurement to write to (default the maserid of the capture)")
+@click.option('--csv', 'csvdir', default=None, type=click.Path(file_okay=False), help="Write to one CSV file per capture in this directory instead of InfluxDB")
+@click.option('--columnar', 'columnardir', default=None, type=click.Path(file_okay=False), help="Write to columnar files in this directory instead of InfluxDB, see --columnarformat")
+@click.option('--channels', default=None, type=click.Path(exists=True), help="EFOS-B channel map JSON file (default built-in)")
+@click.option('--layout', default=None, type=click.Path(exists=True), help="VCH1006 status block layout JSON file (default built-in)")
+@click.option('--queries', default=None, type=click.Path(exists=True), help="HP5071A query set JSON file (default built-in)")
+@click.option('--decimate', default=1, type=click.IntRange(min=1), help="TICC chA/chB pairs averaged per sample (default 1)")
+@click.option('--fields', default='V,I,VPV,PPV,IL', help="VE.Direct fields (default V,I,VPV,PPV,IL)")
+@click.pass_context
+def replay(ctx, captures, measurement, csvdir, columnardir, channels, layout, queries, decimate, fields):
+    "Decode captured instrument logs again"
+    # The BME280 sensor settings are those recorded with the capture
+    settings = dict(instrument_defaults, maserid=measurement, channels=channels, layout=layout,
+                    queries=queries, decimate=decimate, fields=fields.split(','),
+                    mode=None, filter=None, standby=None)
+    if csvdir:
+        os.makedirs(csvdir, exist_ok=True)
+    elif columnardir:
+        writer = columnar_writer(ctx, columnardir)
+    else:
+        writer = maser_writer(ctx)
+    for path in captures:
+        if csvdir:
+            writer = CsvWriter(os.path.join(csvdir, os.path.splitext(os.path.basename(path))[0] + '.csv'))
+        started = time.monotonic()
+        n = replay_process(writer, path, settings)
+        print("%s: %i points in %.1f s" % (path, n, time.monotonic() - started))
+        if csvdir:
+            writer.close()
+    if not csvdir:
+        writer.close(600)
+
 if __name__ == '__main__':
     maser(obj={})
-
@@ -0,0 +1,40 @@
+import logging
+import time
+import masermetrics
+
+# Drift-free sampling schedule. Ticks fall on absolute deadlines that are
+# whole multiples of PERIOD in UTC, e.g. every 10 s at :00, :10, ... A tick
+# is slept for on the monotonic clock, so the period does not grow with the
+# time spent polling and writing, while the wall clock is only used to
+# align the deadlines, and follows NTP adjustments from tick to tick.
+#
+# When the work of a tick overruns into the following deadline(s), those
+# ticks are skipped and counted in overruns.
+class Ticker:
+    def __init__(self, PERIOD, NAME=''):
+        self.period = int(PERIOD * 1000000000)
+        self.name = NAME
+        self.overruns = 0
+        self.next = (time.time_ns() // self.period + 1) * self.period
+
+    def wait(self):
+        # Sleep until the next tick and return its UTC time in ns
+        offset = time.time_ns() - time.monotonic_ns()
+        deadline = self.next - offset
+        now = time.monotonic_ns()
+        if now > deadline:
+            missed = (now - deadline) // self.period + 1
+            self.overruns += missed
+            masermetrics.overruns.labels(self.name).inc(missed)
+            logging.warning("%s overrun by %.3f s, skipping %i ticks" % (self.name, (now - deadline) / 1e9, missed))
+            self.next += missed * self.period
+            deadline = self.next - offset
+        time.sleep((deadline - now) / 1e9)
+        tick = self.next
+        self.next += self.period
+        return tick
+
+# Timestamp of a measurement taken over the interval started..now, both in
+# ns from time.time_ns(), as the midpoint of the interval
+def midpoint_ns(started):
+    return (started + time.time_ns()) // 2
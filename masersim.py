@@ -1,25 +1,342 @@
+#!/usr/bin/env python3
+
+# Instrument simulators for testing masermon without the hardware. Each
+# simulator speaks the instrument protocol on a serial device, or on a
+# pseudo-terminal it creates, paced to the baud rate, with configurable
+# reply latency, noise (corrupted replies) and dropouts (missing replies).
+#
+#   python3 masersim.py --instrument hp5071a
+#   python3 masersim.py /dev/ttyUSB0 9600
+
+import binascii
+import os
+import pty
+import random
+import select
+import struct
 import sys
-import serial
-
-SERIALDEVICE = "/dev/ttyUSB0"
-BAUDRATE = 9600
-
-if len(sys.argv) > 1:
-    SERIALDEVICE = sys.argv[1]
-
-if len(sys.argv) > 2:
-    BAUDRATE = int(sys.argv[2])
-
-cmd = ""
-
-with serial.Serial(SERIALDEVICE, BAUDRATE, timeout=None) as ser:
-    while True:
-        c = ser.read(size=1)
-        print("C=", c)
-        if c == 'D':
-            cmd = ""
-        ser.write(c)
-        cmd += c
-        print(cmd)
-        if len(cmd) == 3:
-            ser.write(("%02x\r\n" % 42).encode())
+import threading
+import time
+import tty
+import click
+
+class Simulator:
+    name = ''
+
+    def __init__(self, DEVICE=None, BAUDRATE=9600, LATENCY=0.0, NOISE=0.0, DROPOUT=0.0, SEED=None):
+        if DEVICE is None:
+            self.fd, slave = pty.openpty()
+            tty.setraw(self.fd)
+            tty.setraw(slave)
+            self.slave = slave
+            self.device = os.ttyname(slave)
+        else:
+            import serial
+            self.port = serial.Serial(DEVICE, BAUDRATE, timeout=None)
+            self.fd = self.port.fileno()
+            self.device = DEVICE
+        self.baudrate = BAUDRATE
+        self.latency = LATENCY
+        self.noise = NOISE
+        self.dropout = DROPOUT
+        self.random = random.Random(SEED)
+        self.sent = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+        return self.device
+
+    def pace(self, n):
+        # Time n characters take on the line, 10 bits each
+        time.sleep(n * 10.0 / self.baudrate)
+
+    def write(self, data):
+        self.pace(len(data))
+        os.write(self.fd, data)
+        self.sent += len(data)
+
+    def reply(self, data):
+        # A reply is subject to latency, dropout and noise, echoes are not
+        if self.dropout and self.random.random() < self.dropout:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if self.noise and self.random.random() < self.noise:
+            data = bytearray(data)
+            data[self.random.randrange(len(data))] = self.random.randrange(256)
+            data = bytes(data)
+        self.write(data)
+
+    def read(self):
+        return os.read(self.fd, 4096)
+
+    def lines(self):
+        buf = b''
+        while True:
+            buf += self.read()
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                yield line.rstrip(b'\r')
+
+    def run(self):
+        pass
+
+# EFOS-B, "F" returns the synthesizer frequency, "Dnn" is echoed and
+# answered with the channel's value as two hex digits
+class EfosbSim(Simulator):
+    name = 'efosb'
+
+    def __init__(self, *args, **kwargs):
+        Simulator.__init__(self, *args, **kwargs)
+        self.values = [self.random.randrange(100, 156) for i in range(35)]
+        self.values[34] = 1
+
+    def run(self):
+        cmd = b''
+        while True:
+            for c in self.read():
+                c = bytes([c])
+                if c == b'F' and cmd == b'':
+                    self.reply(b'5751.6800\n')
+                    continue
+                if c == b'D':
+                    cmd = b''
+                self.write(c)
+                cmd += c
+                if len(cmd) == 3 and cmd[1:].isdigit():
+                    chan = int(cmd[1:]) % len(self.values)
+                    v = self.values[chan]
+                    if chan < 32:
+                        v = max(0, min(255, v + self.random.randint(-1, 1)))
+                        self.values[chan] = v
+                    self.reply(b'%02x\r\n' % v)
+                    cmd = b''
+                elif len(cmd) >= 3:
+                    # Not a channel command
+                    cmd = b''
+
+# HP5071A SCPI over RS-232, lines are echoed and compound queries answered
+# with semicolon separated responses
+class Hp5071aSim(Simulator):
+    name = 'hp5071a'
+    responses = {
+        '*IDN?': 'HEWLETT-PACKARD,5071A,0,1234,1.0',
+        'PTIM:MJD?': '60000',
+        'PTIM?': '12,0,0',
+        'DIAG:CBTSERIAL?': '"A1234"',
+        'DIAG:STAT?': '"Normal operation"',
+        'DIAG:STAT:SUPPLY?': '"OK"',
+        'DIAG:VOLT:SUPPLY?': '+5.1,+12.1,-12.0',
+        'DIAG:RFAMPLITUDE?': '+24.5,+24.7',
+        'DIAG:VOLT:PLLOOP?': '+1.2,+3.4,+5.6,+7.8',
+    }
+
+    def value(self, q):
+        q = q.strip().lstrip(':').upper()
+        if q in self.responses:
+            return self.responses[q]
+        return '%+.4e' % (1.0 + self.random.gauss(0, 0.01))
+
+    def run(self):
+        for line in self.lines():
+            self.write(line + b'\r\n')
+            if line.strip() == b'':
+                continue
+            queries = line.decode('ascii', errors='replace').split(';')
+            self.reply((';'.join(self.value(q) for q in queries) + '\r\n').encode())
+
+# DPM7885 pressure sensor, one response line per command line
+class Dpm7885Sim(Simulator):
+    name = 'dpm7885'
+
+    def __init__(self, *args, STREAM=None, RATE=10.0, **kwargs):
+        Simulator.__init__(self, *args, **kwargs)
+        self.stream = STREAM.encode().upper() if STREAM else None
+        self.rate = RATE
+        # Started continuous outputs, the last one runs
+        self.streams = 0
+
+    def output(self, stream):
+        # Continuous output, RATE lines of pressure and temperature per
+        # second, until another command
+        n = 0
+        t0 = time.monotonic()
+        while self.streams == stream:
+            n += 1
+            time.sleep(max(0.0, t0 + n / self.rate - time.monotonic()))
+            self.reply(b'%.3f %.2f hPa\r\n' % (1013.25 + self.random.gauss(0, 0.05), 21.5 + self.random.gauss(0, 0.02)))
+
+    def run(self):
+        for line in self.lines():
+            cmd = line.strip().upper()
+            # Any command stops continuous output
+            self.streams += 1
+            if self.stream and cmd == self.stream:
+                threading.Thread(target=self.output, args=(self.streams,), daemon=True).start()
+                continue
+            if cmd == b'$MR':
+                s = '%.3f' % (1013.25 + self.random.gauss(0, 0.05))
+            elif cmd == b'$MT':
+                s = '%.2f' % (21.5 + self.random.gauss(0, 0.02))
+            elif cmd == b'$TT':
+                s = 'DPM7885'
+            elif cmd == b'$TS':
+                s = '+12345 +678 +9'
+            else:
+                s = 'OK'
+            self.reply(s.encode() + b'\r\n')
+
+# TICC in time-stamp mode, chA and chB events RATE times per second
+class TiccSim(Simulator):
+    name = 'ticc'
+
+    def __init__(self, *args, RATE=1.0, **kwargs):
+        Simulator.__init__(self, *args, **kwargs)
+        self.rate = RATE
+
+    def run(self):
+        t0 = time.monotonic()
+        n = 0
+        phase = 0.0
+        while True:
+            n += 1
+            time.sleep(max(0.0, t0 + n / self.rate - time.monotonic()))
+            t = n / self.rate + 0.1
+            phase += self.random.gauss(0, 1e-11)
+            self.reply(b'%.12f chA\r\n%.12f chB\r\n' % (t, t + 1e-7 + phase))
+
+# Victron VE.Direct text protocol, one block per second with checksum,
+# and HEX Get commands for a few registers. As on the chargers, the text
+# output pauses for a while after a HEX command.
+class VedirectSim(Simulator):
+    name = 'vedirect'
+    registers = {
+        0xED8D: (lambda r: 1280 + r.randint(-2, 2), '<H'),
+        0xED8F: (lambda r: 15 + r.randint(-1, 1), '<h'),
+        0xEDBB: (lambda r: 1800 + r.randint(-10, 10), '<H'),
+        0xEDBC: (lambda r: 2000 + r.randint(-200, 200), '<I'),
+        0xEDAD: (lambda r: 4, '<H'),
+        0xEDD5: (lambda r: 1280 + r.randint(-2, 2), '<H'),
+    }
+
+    def block(self):
+        fields = [
+            ('PID', '0xA053'),
+            ('V', '%i' % (12800 + self.random.randint(-20, 20))),
+            ('I', '%i' % (1500 + self.random.randint(-50, 50))),
+            ('VPV', '%i' % (18000 + self.random.randint(-100, 100))),
+            ('PPV', '%i' % (20 + self.random.randint(-2, 2))),
+            ('CS', '3'),
+            ('ERR', '0'),
+            ('LOAD', 'ON'),
+            ('IL', '%i' % (400 + self.random.randint(-10, 10))),
+        ]
+        data = b''.join(b'\r\n%s\t%s' % (k.encode(), v.encode()) for k, v in fields)
+        data += b'\r\nChecksum\t'
+        return data + bytes([(256 - sum(data) % 256) % 256])
+
+    def hex(self, line):
+        try:
+            command = int(line[1:2], 16)
+            payload = binascii.unhexlify(line[2:])
+        except ValueError:
+            return
+        if (command + sum(payload)) & 0xff != 0x55:
+            return
+        if command == 0x1:
+            out = b'\x05\x01'
+            command = 0x5
+        elif command == 0x7:
+            register, flags = struct.unpack_from('<HB', payload)
+            if register not in self.registers:
+                out = struct.pack('<HB', register, 0x01)
+            else:
+                value, fmt = self.registers[register]
+                out = struct.pack('<HB', register, 0) + struct.pack(fmt, value(self.random))
+        else:
+            return
+        out += bytes([(0x55 - command - sum(out)) & 0xff])
+        self.reply(b':%X%s\n' % (command, binascii.hexlify(out).upper()))
+
+    def run(self):
+        buf = b''
+        next_block = time.monotonic() + 1.0
+        while True:
+            ready = select.select([self.fd], [], [], max(0.0, next_block - time.monotonic()))[0]
+            if ready:
+                buf += self.read()
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    line = line.strip()
+                    if line.startswith(b':'):
+                        self.hex(line)
+                        next_block = max(next_block, time.monotonic() + 2.0)
+            if time.monotonic() >= next_block:
+                self.reply(self.block())
+                next_block += 1.0
+
+# VCH1006, the status block request 01 41 00 00 00 is answered with a 189
+# byte block, here the address and command, 16-bit words and a sum8 check
+# byte, as a stand-in for the undocumented real contents
+class Vch1006Sim(Simulator):
+    name = 'vch1006'
+
+    def __init__(self, *args, **kwargs):
+        Simulator.__init__(self, *args, **kwargs)
+        self.words = [self.random.randrange(1000, 60000) for i in range(93)]
+
+    def run(self):
+        buf = b''
+        while True:
+            buf += self.read()
+            while len(buf) >= 5:
+                if buf[:5] != b'\x01\x41\x00\x00\x00':
+                    buf = buf[1:]
+                    continue
+                buf = buf[5:]
+                self.words = [max(0, min(65535, w + self.random.randint(-3, 3))) for w in self.words]
+                block = b'\x01\x41' + struct.pack('<93H', *self.words)
+                self.reply(block + bytes([sum(block) & 0xff]))
+
+simulators = {
+    'efosb': EfosbSim,
+    'vch1006': Vch1006Sim,
+    'hp5071a': Hp5071aSim,
+    'dpm7885': Dpm7885Sim,
+    'ticcts': TiccSim,
+    'vedirect': VedirectSim,
+}
+
+# Default line speed of each instrument
+baudrates = {
+    'efosb': 9600,
+    'vch1006': 9600,
+    'hp5071a': 9600,
+    'dpm7885': 9600,
+    'ticcts': 115200,
+    'vedirect': 19200,
+}
+
+@click.command()
+@click.argument('device', required=False)
+@click.argument('baudrate', required=False, type=int)
+@click.option('--instrument', default='efosb', type=click.Choice(sorted(simulators)), help="Instrument to simulate (default efosb)")
+@click.option('--latency', default=0.0, help="Reply latency in seconds (default 0)")
+@click.option('--noise', default=0.0, help="Fraction of replies with a corrupted byte (default 0)")
+@click.option('--dropout', default=0.0, help="Fraction of replies not sent (default 0)")
+@click.option('--rate', default=1.0, help="TICC events, or DPM7885 continuous output lines, per second (default 1)")
+@click.option('--stream', default=None, help="DPM7885 command starting continuous output (default none)")
+def main(device, baudrate, instrument, latency, noise, dropout, rate, stream):
+    "Simulate an instrument on DEVICE, or on a new pseudo-terminal"
+    kwargs = {'RATE': rate} if instrument == 'ticcts' else {}
+    if instrument == 'dpm7885':
+        kwargs = {'RATE': rate, 'STREAM': stream}
+    sim = simulators[instrument](device, baudrate or baudrates[instrument], latency, noise, dropout, **kwargs)
+    print("Simulating %s on %s at %i baud" % (instrument, sim.device, sim.baudrate))
+    sys.stdout.flush()
+    sim.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+
+# Durable on-disk queue between the acquisition loops and the InfluxDB
+# upload, with the same interface as maserwriter.MemoryQueue. Every sample
+# lands on local disk first and is uploaded in order, in bulk, whenever the
+# server is reachable, so a database outage leaves no gap in the record.
+#
+# The spool directory holds append-only segment files, %016x.seg, of
+# newline terminated line protocol lines, and a cursor file with the segment
+# and byte offset of the first line not yet accepted by the server.
+# Segments are compacted away as soon as they are fully uploaded. Beyond
+# MAXBYTES the oldest segment is dropped, which is logged.
+#
+#  MAXBYTES       disk usage bound
+#  SEGMENTBYTES   size at which a new segment is started
+#  FSYNCINTERVAL  max time appended lines stay unsynced, limits SD card wear
+class Spool:
+    def __init__(self, DIR, MAXBYTES=1 << 30, SEGMENTBYTES=4 << 20, FSYNCINTERVAL=1.0):
+        os.makedirs(DIR, exist_ok=True)
+        self.dir = DIR
+        self.maxbytes = MAXBYTES
+        self.segmentbytes = SEGMENTBYTES
+        self.fsyncinterval = FSYNCINTERVAL
+        self.dropped = 0
+        self.segments = sorted(int(n[:-4], 16) for n in os.listdir(DIR) if n.endswith('.seg'))
+        self.cursor = self.read_cursor()
+        # Remove segments left behind by an interrupted compaction
+        while self.segments and self.segments[0] < self.cursor[0]:
+            os.unlink(self.segment_path(self.segments.pop(0)))
+        if self.segments and self.segments[0] > self.cursor[0]:
+            self.cursor = (self.segments[0], 0)
+        self.bytes = sum(os.path.getsize(self.segment_path(s)) for s in self.segments)
+        self.pending = sum(self.count_lines(s, self.cursor[1] if s == self.cursor[0] else 0)
+                           for s in self.segments)
+        self.first_pending = time.monotonic() if self.pending else None
+        if self.pending:
+            logging.warning("Spool %s: %i lines from earlier runs to upload" % (DIR, self.pending))
+        # Always append to a fresh segment, an earlier one may end in a
+        # partially written line
+        self.wfile = None
+        self.roll()
+
+    def segment_path(self, seg):
+        return os.path.join(self.dir, "%016x.seg" % seg)
+
+    def read_cursor(self):
+        try:
+            with open(os.path.join(self.dir, 'cursor')) as f:
+                seg, off = f.read().split()
+                return (int(seg, 16), int(off))
+        except (OSError, ValueError):
+            return (self.segments[0] if self.segments else 0, 0)
+
+    def write_cursor(self):
+        path = os.path.join(self.dir, 'cursor')
+        with open(path + '.tmp', 'w') as f:
+            f.write("%016x %i\n" % self.cursor)
+        os.replace(path + '.tmp', path)
+
+    def count_lines(self, seg, off):
+        n = 0
+        with open(self.segment_path(seg), 'rb') as f:
+            f.seek(off)
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                n += chunk.count(b'\n')
+        return n
+
+    def roll(self):
+        if self.wfile is not None:
+            self.sync()
+            self.wfile.close()
+        seg = self.segments[-1] + 1 if self.segments else self.cursor[0]
+        self.segments.append(seg)
+        self.wfile = open(self.segment_path(seg), 'ab')
+        self.wsize = 0
+        self.last_sync = time.monotonic()
+        if len(self.segments) == 1:
+            self.cursor = (seg, 0)
+            self.write_cursor()
+
+    def sync(self):
+        self.wfile.flush()
+        os.fsync(self.wfile.fileno())
+        self.last_sync = time.monotonic()
+
+    def __len__(self):
+        return self.pending
+
+    def append(self, lines):
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.wfile.write(data)
+        self.wfile.flush()
+        self.wsize += len(data)
+        self.bytes += len(data)
+        if self.pending == 0:
+            self.first_pending = time.monotonic()
+        self.pending += len(lines)
+        if time.monotonic() - self.last_sync >= self.fsyncinterval:
+            self.sync()
+        if self.wsize >= self.segmentbytes:
+            self.roll()
+        while self.bytes > self.maxbytes and len(self.segments) > 1:
+            self.drop_oldest()
+
+    def drop_oldest(self):
+        seg = self.segments.pop(0)
+        path = self.segment_path(seg)
+        lost = self.count_lines(seg, self.cursor[1] if seg == self.cursor[0] else 0)
+        logging.error("Spool %s full, dropping %i lines" % (self.dir, lost))
+        self.dropped += lost
+        self.pending = max(0, self.pending - lost)
+        self.cursor = (self.segments[0], 0)
+        self.write_cursor()
+        self.bytes -= os.path.getsize(path)
+        os.unlink(path)
+
+    def oldest(self):
+        return self.first_pending if self.pending else None
+
+    def peek(self, n):
+        # Read up to n lines from the cursor, token is where they end
+        lines = []
+        seg, off = self.cursor
+        current = self.segments[-1]
+        while len(lines) < n and seg in self.segments:
+            with open(self.segment_path(seg), 'rb') as f:
+                f.seek(off)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Truncated by a crash, or still being written
+                        if seg == current:
+                            break
+                        continue
+                    off += len(line)
+                    lines.append(line[:-1].decode('utf-8', errors='replace'))
+                    if len(lines) == n:
+                        break
+            if len(lines) < n and seg != current:
+                seg = self.segments[self.segments.index(seg) + 1]
+                off = 0
+            else:
+                break
+        if not lines:
+            # Nothing readable, resynchronise the pending count
+            self.pending = 0
+        return lines, (seg, off, len(lines))
+
+    def commit(self, token):
+        seg, off, n = token
+        if (seg, off) <= self.cursor:
+            # The batch went out with a dropped segment
+            return
+        self.cursor = (seg, off)
+        self.write_cursor()
+        self.pending = max(0, self.pending - n)
+        # Compaction, fully uploaded segments are removed
+        while self.segments[0] < seg:
+            old = self.segments.pop(0)
+            path = self.segment_path(old)
+            self.bytes -= os.path.getsize(path)
+            os.unlink(path)
+
+    def close(self):
+        if self.wfile is not None:
+            self.sync()
+            self.wfile.close()
+            self.wfile = None
@@ -0,0 +1,327 @@
+import collections
+import math
+import threading
+import time
+from maserwriter import lp_time
+
+# Streaming overlapping Allan deviation at octave taus m = 1, 2, 4, ...
+# samples. The second differences x[i+2m] - 2x[i+m] + x[i] of the phase are
+# accumulated per tau from a ring of the last 2m+1 phase samples. Up to
+# OVERLAP samples every phase sample is used, which is the fully overlapping
+# estimator. Beyond that the phase is decimated, only every m/OVERLAP-th
+# sample enters the ring, so memory stays at most 2*OVERLAP+1 samples per
+# octave, O(log N) in total, at a reduced but still OVERLAP-fold overlap.
+#
+# Phase (time difference) data is added with add_phase(), other data, such
+# as fractional frequency or any slow housekeeping value, with add_value(),
+# which integrates it to phase in units of samples.
+class AllanDev:
+    def __init__(self, OVERLAP=64):
+        self.overlap = OVERLAP
+        self.n = 0
+        self.x = 0.0
+        # Per octave: [m, step, ring, sum of squares, count]
+        self.levels = []
+
+    def add_phase(self, x):
+        if self.n == 1 << len(self.levels):
+            m = 1 << len(self.levels)
+            step = max(1, m // self.overlap)
+            ring = collections.deque(maxlen=2 * (m // step) + 1)
+            self.levels.append([m // step, step, ring, 0.0, 0])
+        for level in self.levels:
+            if self.n % level[1]:
+                continue
+            ring = level[2]
+            ring.append(x)
+            if len(ring) == ring.maxlen:
+                d = ring[-1] - 2 * ring[level[0]] + ring[0]
+                level[3] += d * d
+                level[4] += 1
+        self.n += 1
+
+    def add_value(self, y):
+        self.x += y
+        self.add_phase(self.x)
+
+    def adev(self, TAU0=1.0, PHASE=True):
+        # List of (tau, adev, number of second differences). Phase data is
+        # in seconds, values integrated in units of samples.
+        res = []
+        for k, (m, step, ring, sq, count) in enumerate(self.levels):
+            if count == 0:
+                continue
+            tau = (1 << k) * TAU0
+            scale = tau if PHASE else (1 << k)
+            res.append((tau, math.sqrt(sq / (2.0 * count)) / scale, count))
+        return res
+
+# Running mean, variance (Welford), min and max
+class RunningStats:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, v):
+        self.n += 1
+        d = v - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (v - self.mean)
+        self.min = min(self.min, v)
+        self.max = max(self.max, v)
+
+    def var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+# Statistics of one field of one measurement. The sample interval tau0 is
+# taken from the timestamps unless given.
+class FieldStats:
+    def __init__(self, PHASE=False, TAU0=None, OVERLAP=64):
+        self.phase = PHASE
+        self.tau0 = TAU0
+        self.stats = RunningStats()
+        self.adev = AllanDev(OVERLAP)
+        self.first = None
+        self.last = None
+
+    def add(self, v, t):
+        if self.first is None:
+            self.first = t
+        self.last = t
+        self.stats.add(v)
+        if self.phase:
+            self.adev.add_phase(v)
+        else:
+            self.adev.add_value(v)
+
+    def fields(self):
+        tau0 = self.tau0
+        if tau0 is None:
+            tau0 = (self.last - self.first) / 1e9 / max(1, self.stats.n - 1)
+        f = {
+            "n": self.stats.n,
+            "mean": self.stats.mean,
+            "std": math.sqrt(self.stats.var()),
+            "min": self.stats.min,
+            "max": self.stats.max,
+            "tau0": tau0,
+        }
+        if tau0 > 0:
+            # Not with samples sharing a timestamp
+            for tau, adev, count in self.adev.adev(tau0, self.phase):
+                f["adev_%g" % tau] = adev
+        return f
+
+# Statistics stage between the acquisition loops and the writer. Points are
+# passed on unchanged, and the fields named in RULES are fed to streaming
+# statistics, per series, which are written every INTERVAL seconds as
+# points of their own MEASUREMENT, with the tags of the series and the
+# source measurement and field. A rule is
+# a dict with field, and optionally measurement (default any), phase (the
+# field is time difference data in seconds, default False) and tau0.
+class StatsStage:
+    def __init__(self, WRITER, RULES, MEASUREMENT='maserstats', INTERVAL=60, OVERLAP=64):
+        self.writer = WRITER
+        self.rules = collections.defaultdict(list)
+        for rule in RULES:
+            self.rules[rule['field']].append(rule)
+        self.measurement = MEASUREMENT
+        self.interval = INTERVAL
+        self.overlap = OVERLAP
+        self.tracked = {}
+        self.lock = threading.Lock()
+        self.next_report = time.monotonic() + INTERVAL
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def write_points(self, points):
+        self.writer.write_points(points)
+        with self.lock:
+            for p in points:
+                for field, value in p['fields'].items():
+                    if field not in self.rules or not isinstance(value, (int, float)):
+                        continue
+                    for rule in self.rules[field]:
+                        if rule.get('measurement', p['measurement']) != p['measurement']:
+                            continue
+                        tags = p.get('tags') or {}
+                        key = (p['measurement'], field, tuple(sorted((k, str(v)) for k, v in tags.items())))
+                        if key not in self.tracked:
+                            self.tracked[key] = FieldStats(rule.get('phase', False), rule.get('tau0'), self.overlap)
+                        self.tracked[key].add(float(value), lp_time(p.get('time')))
+            if time.monotonic() < self.next_report:
+                return True
+            self.next_report = time.monotonic() + self.interval
+            report = self.report()
+        if report:
+            self.writer.write_points(report)
+        return True
+
+    def report(self):
+        now = time.time_ns()
+        return [
+            {
+                "measurement": self.measurement,
+                "tags": dict(tags, source=measurement, field=field),
+                "time": now,
+                "fields": s.fields()
+            }
+            for (measurement, field, tags), s in self.tracked.items() if s.stats.n > 1
+        ]
+
+def tier_label(period):
+    if period % 3600 == 0:
+        return "%ih" % (period // 3600)
+    if period % 60 == 0:
+        return "%im" % (period // 60)
+    return "%gs" % period
+
+# Min/mean/max of the numeric fields of one series over periods aligned to
+# UTC. add() returns the finished (start ns, {field: [n, sum, min, max]})
+# when a sample falls into the following period, flush() the unfinished
+# one, or None.
+class Rollup:
+    def __init__(self, PERIOD):
+        self.period = int(PERIOD * 1000000000)
+        self.start = None
+        self.acc = {}
+
+    def add(self, t, fields):
+        done = None
+        start = t - t % self.period
+        if start != self.start:
+            if self.acc:
+                done = (self.start, self.acc)
+            self.start = start
+            self.acc = {}
+        for field, v in fields.items():
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                continue
+            a = self.acc.get(field)
+            if a is None:
+                self.acc[field] = [1, v, v, v]
+            else:
+                a[0] += 1
+                a[1] += v
+                a[2] = min(a[2], v)
+                a[3] = max(a[3], v)
+        return done
+
+    def flush(self):
+        done = (self.start, self.acc) if self.acc else None
+        self.start = None
+        self.acc = {}
+        return done
+
+def rollup_point(measurement, tags, period, done):
+    start, acc = done
+    f = {}
+    for field, (n, s, lo, hi) in acc.items():
+        f[field + "_min"] = lo
+        f[field + "_mean"] = s / n
+        f[field + "_max"] = hi
+    return {
+        "measurement": "%s_%s" % (measurement, tier_label(period)),
+        "tags": tags,
+        "time": start,
+        "fields": f
+    }
+
+# Aggregation stage between the acquisition loops and the writer, to cut
+# the write volume of slow instruments. RULES holds one dict per instrument
+# measurement with:
+#  measurement  the measurement (--maserid) it applies to
+#  tiers        rollup periods in s, written as <measurement>_1m, _1h, ...
+#               with <field>_min, _mean and _max, default [60, 3600]
+#  retention    how long full-rate points are kept, e.g. "7d", they are then
+#               written to the retention policy raw_<retention>, default
+#               the database default policy
+#  deadband     {field: threshold}, the field is only written when it has
+#               moved more than threshold since last written, 0 means
+#               change-only, "*" applies to all other fields
+#  heartbeat    fields held back by deadband are still written at least
+#               this often (s), default 600
+# Measurements without a rule pass unchanged. close() writes the rollups of
+# the periods still open, from the samples so far.
+class AggregateStage:
+    def __init__(self, WRITER, RULES):
+        self.writer = WRITER
+        self.rules = {}
+        for rule in RULES:
+            rule = dict(rule)
+            rule.setdefault('tiers', [60, 3600])
+            rule.setdefault('deadband', {})
+            rule['heartbeat_ns'] = int(rule.get('heartbeat', 600) * 1000000000)
+            if rule.get('retention'):
+                rule['rp'] = "raw_%s" % rule['retention']
+                WRITER.add_retention_policy(rule['rp'], rule['retention'])
+            self.rules[rule['measurement']] = rule
+        # (measurement, tags) -> (rollups, {field: (value, time) last
+        # written}, tags)
+        self.series = {}
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def deadband(self, rule, sent, fields, t):
+        out = {}
+        for field, v in fields.items():
+            threshold = rule['deadband'].get(field, rule['deadband'].get('*'))
+            last = sent.get(field)
+            if threshold is not None and last is not None and t - last[1] < rule['heartbeat_ns']:
+                if isinstance(v, (int, float)) and not isinstance(v, bool) and isinstance(last[0], (int, float)):
+                    if abs(v - last[0]) <= threshold:
+                        self.suppressed += 1
+                        continue
+                elif v == last[0]:
+                    self.suppressed += 1
+                    continue
+            sent[field] = (v, t)
+            out[field] = v
+        return out
+
+    def write_points(self, points):
+        out = []
+        with self.lock:
+            for p in points:
+                rule = self.rules.get(p['measurement'])
+                if rule is None:
+                    out.append(p)
+                    continue
+                t = lp_time(p.get('time'))
+                tags = p.get('tags') or {}
+                key = (p['measurement'], tuple(sorted((k, str(v)) for k, v in tags.items())))
+                if key not in self.series:
+                    self.series[key] = ([Rollup(period) for period in rule['tiers']], {}, tags)
+                rollups, sent, _ = self.series[key]
+                fields = self.deadband(rule, sent, p['fields'], t)
+                if fields:
+                    q = dict(p, time=t, fields=fields)
+                    if 'rp' in rule:
+                        q['retention_policy'] = rule['rp']
+                    out.append(q)
+                for period, rollup in zip(rule['tiers'], rollups):
+                    done = rollup.add(t, p['fields'])
+                    if done is not None:
+                        out.append(rollup_point(p['measurement'], tags, period, done))
+        if out:
+            self.writer.write_points(out)
+        return True
+
+    def close(self, TIMEOUT=10):
+        out = []
+        with self.lock:
+            for (measurement, _), (rollups, sent, tags) in self.series.items():
+                for period, rollup in zip(self.rules[measurement]['tiers'], rollups):
+                    done = rollup.flush()
+                    if done is not None:
+                        out.append(rollup_point(measurement, tags, period, done))
+        if out:
+            self.writer.write_points(out)
+        self.writer.close(TIMEOUT)
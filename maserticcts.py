@@ -0,0 +1,154 @@
+import re
+import time
+import numpy
+import serial
+import masermetrics
+import masercapture
+
+# masermon driver for the TAPR TICC in time-stamp mode
+
+# TICC time-stamp mode stream. Lines are "<seconds> chA" or "<seconds> chB".
+# Received data is parsed a chunk at a time, by one regular expression
+# pass into NumPy arrays, without a Python loop per event. Each event is
+# paired with its nearest preceding stamp, if that is of the other channel,
+# not paired already, and at most GAP seconds before it, so an edge missed
+# on one channel costs only the events around it instead of pairing the
+# wrong events. Events left unpaired are counted as dropped. Pairs are
+# averaged DECIMATE at a time. Timestamps follow the TICC timebase,
+# anchored to UTC at the first event and whenever the TICC timebase
+# restarts.
+ticc_event = re.compile(rb'(-?\d+\.\d+)\s+ch([AB])')
+
+class TiccStream:
+    def __init__(self, DECIMATE=1, GAP=0.5):
+        if DECIMATE < 1:
+            raise ValueError("TICC decimate must be at least 1, not %s" % DECIMATE)
+        self.decimate = DECIMATE
+        self.gap = GAP
+        self.buf = None
+        self.anchor = None
+        self.last = None
+        # The last event of the previous chunk, time and chA, if unpaired
+        self.carry = None
+        # Pairs waiting for a full decimation block
+        self.acc = numpy.empty((0, 2))
+        self.dropped = 0
+
+    def parse(self, data):
+        # Times and chA flags of the complete lines
+        if self.buf is None:
+            # Sync by throwing the first, possibly partial, line
+            cut = data.find(b'\n')
+            if cut < 0:
+                return numpy.empty(0), numpy.empty(0, dtype=bool)
+            self.buf = b''
+            data = data[cut + 1:]
+        self.buf += data
+        end = self.buf.rfind(b'\n') + 1
+        events = ticc_event.findall(self.buf, 0, end)
+        self.buf = self.buf[end:]
+        if not events:
+            return numpy.empty(0), numpy.empty(0, dtype=bool)
+        events = numpy.array(events)
+        return events[:, 0].astype(numpy.float64), events[:, 1] == b'A'
+
+    def pair(self, t, a):
+        # (pairs, 2) array of chA, chB times of the events t, a
+        if self.carry is not None:
+            t = numpy.concatenate(([self.carry[0]], t))
+            a = numpy.concatenate(([self.carry[1]], a))
+        n = len(t)
+        dt = t[1:] - t[:-1]
+        # Event i may pair with i - 1, taken alternately along runs of
+        # such events, so no event is paired twice
+        c = numpy.zeros(n, dtype=bool)
+        c[1:] = (a[1:] != a[:-1]) & (dt >= 0) & (dt <= self.gap)
+        idx = numpy.arange(n)
+        starts = c.copy()
+        starts[1:] &= ~c[:-1]
+        run = numpy.maximum.accumulate(numpy.where(starts, idx, 0))
+        take = c & ((idx - run) % 2 == 0)
+        second = numpy.flatnonzero(take)
+        first = second - 1
+        used = numpy.zeros(n, dtype=bool)
+        used[first] = True
+        used[second] = True
+        # The last event may still pair with the next chunk
+        self.carry = None if used[-1] else (t[-1], a[-1])
+        self.dropped += int(n - used.sum()) - (0 if used[-1] else 1)
+        ta = numpy.where(a[first], t[first], t[second])
+        tb = numpy.where(a[first], t[second], t[first])
+        return numpy.stack((ta, tb), axis=1)
+
+    def feed(self, data, now_ns):
+        # Returns arrays of (time ns, ta, tb) for the completed samples
+        t, a = self.parse(data)
+        if len(t) == 0:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0), numpy.empty(0)
+        if self.anchor is None or t[0] < self.last:
+            self.anchor = now_ns - int(t[0] * 1e9)
+        self.last = t[-1]
+        acc = numpy.concatenate((self.acc, self.pair(t, a)))
+        blocks = len(acc) // self.decimate
+        out = acc[:blocks * self.decimate]
+        self.acc = acc[blocks * self.decimate:]
+        if self.decimate > 1:
+            out = out.reshape(blocks, self.decimate, 2).mean(axis=1)
+        ta = out[:, 0]
+        tb = out[:, 1]
+        ts = self.anchor + (numpy.maximum(ta, tb) * 1e9).astype(numpy.int64)
+        return ts, ta, tb
+
+def ticcts_points(MASERID, ts, ta, tb):
+    tags = {
+        "masertype": "ticc",
+        "mode": "ts"
+    }
+    return [
+        {
+            "measurement": MASERID,
+            "tags": tags,
+            "time": int(t),
+            "fields": {
+                "TA": a,
+                "TB": b,
+                "TC": a - b
+            }
+        }
+        for t, a, b in zip(ts, ta.tolist(), tb.tolist())
+    ]
+
+def ticcts_process(WRITER, MASERID, SERIALDEVICE, DECIMATE=1):
+    with masercapture.serial_port('ticcts', MASERID, serial.Serial(SERIALDEVICE, 115200, bytesize=8, parity='N', stopbits=1, xonxoff=1, timeout=0.1)) as ser:
+        name = "TICC %s" % MASERID
+        stream = TiccStream(DECIMATE)
+        dropped = 0
+        while True:
+            data = ser.read(max(1, ser.in_waiting))
+            ts, ta, tb = stream.feed(data, time.time_ns())
+            if stream.dropped != dropped:
+                # Events without partner on the other channel
+                masermetrics.errors.labels(name).inc(stream.dropped - dropped)
+                dropped = stream.dropped
+            if len(ts):
+                masermetrics.samples.labels(name).inc(len(ts))
+                WRITER.write_points(ticcts_points(MASERID, ts, ta, tb))
+
+def ticcts_probe(ser):
+    return ticc_event.search(ser.read(256)) is not None
+
+def ticcts_replay(MASERID, RECORDS, DECIMATE=1):
+    stream = TiccStream(DECIMATE)
+    for kind, wall, mono, data in RECORDS:
+        if kind == masercapture.READ:
+            yield from ticcts_points(MASERID, *stream.feed(bytes(data), wall))
+
+def ticcts_schema():
+    return ["masertype", "mode"], [("TA", 'float'), ("TB", 'float'), ("TC", 'float')]
+
+driver = {
+    'process': (ticcts_process, ('maserid', 'device', 'decimate')),
+    'replay': (ticcts_replay, ('decimate',)),
+    'probe': (ticcts_probe, 115200, 1.5),
+    'schema': (ticcts_schema, ()),
+}
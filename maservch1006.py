@@ -0,0 +1,233 @@
+import binascii
+import functools
+import json
+import logging
+import operator
+import os
+import struct
+import time
+import numpy
+import serial
+from masersched import Ticker, midpoint_ns
+import masermetrics
+import masercapture
+
+# masermon driver for the VCH1006 passive hydrogen maser
+
+# VCH1006 status block. The maser answers the request 01 41 00 00 00 with
+# a block of size bytes. A layout may give a header the block starts with
+# (hex) and a check byte ending it over all preceding bytes, "sum8" (sum
+# modulo 256), "xor8" or "none" (default). Fields are given by byte
+# position pos, struct type and scale and offset as for the EFOS-B. The
+# framing and contents of the block are not documented here, so the
+# built-in layout checks only the size and stores the whole block as raw
+# 16-bit words W<pos> and the odd last byte B188. A layout JSON file of the
+# same form names and scales the fields once they are known.
+vch1006_request = b'\x01\x41\x00\x00\x00'
+
+vch1006_layout = {
+    "size": 189,
+    "byteorder": "<",
+    "checksum": "none",
+    "fields": [
+        { "name": "W%03i" % pos, "pos": pos, "type": "H", "scale": 1, "offset": 0 }
+        for pos in range(0, 188, 2)
+    ] + [
+        { "name": "B188", "pos": 188, "type": "B", "scale": 1, "offset": 0 }
+    ]
+}
+
+# A layout compiled to one struct.Struct, with pad bytes between the
+# fields, to decode a block in one unpack() call, and to the equivalent
+# NumPy dtype to decode an archive of blocks in one go
+class Vch1006Layout:
+    def __init__(self, layout):
+        self.size = layout['size']
+        self.header = bytes.fromhex(layout.get('header', ''))
+        self.checksum = layout.get('checksum', 'none')
+        if self.checksum not in ('sum8', 'xor8', 'none'):
+            raise ValueError("Unknown VCH1006 checksum %s" % self.checksum)
+        fields = sorted(layout['fields'], key=lambda f: f['pos'])
+        byteorder = layout.get('byteorder', '<')
+        fmt = byteorder
+        pos = 0
+        for f in fields:
+            if f['pos'] < pos:
+                raise ValueError("VCH1006 field %s overlaps the previous one" % f['name'])
+            if f['pos'] > pos:
+                fmt += "%ix" % (f['pos'] - pos)
+            fmt += f['type']
+            pos = f['pos'] + struct.calcsize(byteorder + f['type'])
+        if pos > self.size:
+            raise ValueError("VCH1006 fields extend beyond the %i byte block" % self.size)
+        self.struct = struct.Struct(fmt + "%ix" % (self.size - pos))
+        self.names = [f['name'] for f in fields]
+        self.scale = [f.get('scale', 1) for f in fields]
+        self.offset = [f.get('offset', 0) for f in fields]
+        self.dtype = numpy.dtype({
+            'names': self.names,
+            'formats': [byteorder + f['type'] for f in fields],
+            'offsets': [f['pos'] for f in fields],
+            'itemsize': self.size
+        })
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def check(self, frame):
+        # Returns what is wrong with the frame, or None
+        if len(frame) != self.size:
+            return "short block of %i bytes" % len(frame)
+        if frame[:len(self.header)] != self.header:
+            return "bad header %s" % binascii.hexlify(frame[:len(self.header)]).decode()
+        if self.checksum == 'sum8' and sum(frame[:-1]) & 0xff != frame[-1]:
+            return "bad checksum"
+        if self.checksum == 'xor8' and functools.reduce(operator.xor, frame[:-1], 0) != frame[-1]:
+            return "bad checksum"
+        return None
+
+    def decode(self, frame):
+        return {
+            n: float(v * s + o)
+            for n, v, s, o in zip(self.names, self.struct.unpack(frame), self.scale, self.offset)
+        }
+
+    def decode_many(self, frames):
+        # frames is a (blocks, size) uint8 array, returns a boolean array of
+        # the valid blocks and a (blocks, fields) array of values
+        valid = numpy.ones(len(frames), dtype=bool)
+        if self.header:
+            valid &= (frames[:, :len(self.header)] == numpy.frombuffer(self.header, dtype=numpy.uint8)).all(axis=1)
+        if self.checksum == 'sum8':
+            valid &= (frames[:, :-1].sum(axis=1, dtype=numpy.int64) & 0xff) == frames[:, -1]
+        elif self.checksum == 'xor8':
+            valid &= numpy.bitwise_xor.reduce(frames[:, :-1], axis=1) == frames[:, -1]
+        rec = numpy.ascontiguousarray(frames).view(self.dtype).reshape(-1)
+        values = numpy.empty((len(frames), len(self.names)), dtype=numpy.float64)
+        for i, n in enumerate(self.names):
+            values[:, i] = rec[n] * self.scale[i] + self.offset[i]
+        return valid, values
+
+# Raw block archive, one file per UTC day DIR/<maserid>-YYYYMMDD.vch of
+# fixed size records, the int64 time in ns followed by the block as read,
+# for decoding again later with a corrected layout
+class Vch1006Archive:
+    def __init__(self, DIR, MASERID):
+        self.dir = DIR
+        self.maserid = MASERID
+        self.path = None
+        self.file = None
+        os.makedirs(DIR, exist_ok=True)
+
+    def write(self, t, frame):
+        path = os.path.join(self.dir, "%s-%s.vch" % (self.maserid, time.strftime("%Y%m%d", time.gmtime(t / 1e9))))
+        if path != self.path:
+            if self.file:
+                self.file.close()
+            self.file = open(path, 'ab')
+            self.path = path
+        self.file.write(struct.pack('<q', t) + frame)
+        self.file.flush()
+
+    @staticmethod
+    def read(path, size):
+        # Returns the times and a (blocks, size) uint8 array of the blocks
+        rec = numpy.fromfile(path, dtype=numpy.dtype([('time', '<i8'), ('frame', numpy.uint8, (size,))]))
+        return rec['time'], rec['frame']
+
+def vch1006_point(MASERID, timestamp, fields):
+    return {
+        "measurement": MASERID,
+        "tags": {
+            "masertype": "vch1006"
+        },
+        "time": timestamp,
+        "fields": fields
+    }
+
+def vch1006_process(WRITER, MASERID, SERIALDEVICE, BAUDRATE, LOGRATE, LAYOUT=None, ARCHIVE=None):
+    if LAYOUT:
+        layout = Vch1006Layout.load(LAYOUT)
+    else:
+        layout = Vch1006Layout(vch1006_layout)
+    archive = Vch1006Archive(ARCHIVE, MASERID) if ARCHIVE else None
+    with masercapture.serial_port('vch1006', MASERID, serial.Serial(SERIALDEVICE, BAUDRATE, timeout=2)) as ser:
+        name = "VCH1006 %s" % MASERID
+        ticker = Ticker(LOGRATE, name)
+        while True:
+            ticker.wait()
+            started = time.time_ns()
+            with masermetrics.serial_seconds.labels(name).time():
+                ser.write(vch1006_request)
+                frame = ser.read(layout.size)
+            timestamp = midpoint_ns(started)
+            if len(frame) < layout.size:
+                masermetrics.timeouts.labels(name).inc()
+            elif archive:
+                archive.write(timestamp, frame)
+            error = layout.check(frame)
+            if error:
+                logging.warning("%s: block rejected: %s" % (name, error))
+                masermetrics.errors.labels(name).inc()
+                # Drop what is left of the block, the next request starts afresh
+                time.sleep(0.1)
+                ser.reset_input_buffer()
+                masermetrics.resyncs.labels(name).inc()
+                continue
+            WRITER.write_points([vch1006_point(MASERID, timestamp, layout.decode(frame))])
+            masermetrics.samples.labels(name).inc()
+
+# Decode archived blocks again and write them, in batches of BATCH blocks
+def vch1006_redecode(WRITER, MASERID, FILES, LAYOUT=None, BATCH=10000):
+    if LAYOUT:
+        layout = Vch1006Layout.load(LAYOUT)
+    else:
+        layout = Vch1006Layout(vch1006_layout)
+    for path in FILES:
+        times, frames = Vch1006Archive.read(path, layout.size)
+        valid, values = layout.decode_many(frames)
+        if not valid.all():
+            logging.warning("%s: %i of %i blocks rejected by the layout" % (path, len(times) - valid.sum(), len(times)))
+        print("%s: %i blocks, %i invalid" % (path, len(times), len(times) - valid.sum()))
+        times = times[valid]
+        values = values[valid].tolist()
+        for i in range(0, len(times), BATCH):
+            WRITER.write_points([
+                vch1006_point(MASERID, int(t), dict(zip(layout.names, v)))
+                for t, v in zip(times[i:i + BATCH], values[i:i + BATCH])
+            ])
+
+def vch1006_probe(ser):
+    # A block of the built-in size answers the request, and nothing more
+    ser.write(vch1006_request)
+    return len(ser.read(vch1006_layout['size'] + 1)) == vch1006_layout['size']
+
+def vch1006_replay(MASERID, RECORDS, LAYOUT=None):
+    if LAYOUT:
+        layout = Vch1006Layout.load(LAYOUT)
+    else:
+        layout = Vch1006Layout(vch1006_layout)
+    for request, started, ended, frame in masercapture.exchanges(RECORDS):
+        if request != vch1006_request:
+            continue
+        error = layout.check(frame)
+        if error:
+            logging.warning("VCH1006 %s: block rejected: %s" % (MASERID, error))
+            continue
+        yield vch1006_point(MASERID, (started + ended) // 2, layout.decode(frame))
+
+def vch1006_schema(LAYOUT=None):
+    if LAYOUT:
+        layout = Vch1006Layout.load(LAYOUT)
+    else:
+        layout = Vch1006Layout(vch1006_layout)
+    return ["masertype"], [(n, 'float') for n in layout.names]
+
+driver = {
+    'process': (vch1006_process, ('maserid', 'device', 'baudrate', 'lograte', 'layout', 'archive')),
+    'replay': (vch1006_replay, ('layout',)),
+    'probe': (vch1006_probe, None, 0.5),
+    'schema': (vch1006_schema, ('layout',)),
+}
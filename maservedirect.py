@@ -0,0 +1,268 @@
+import binascii
+import struct
+import time
+import serial
+import masermetrics
+import masercapture
+
+# masermon driver for Victron VE.Direct chargers
+
+# VE.Direct text protocol labels, as field name and divisor to V, A, W,
+# kWh and %, or None for labels kept as text
+vedirect_labels = {
+    b'V':     ('V',     1000),
+    b'V2':    ('V2',    1000),
+    b'V3':    ('V3',    1000),
+    b'VS':    ('VS',    1000),
+    b'VM':    ('VM',    1000),
+    b'DM':    ('DM',    10),
+    b'VPV':   ('VPV',   1000),
+    b'PPV':   ('PPV',   1),
+    b'I':     ('I',     1000),
+    b'I2':    ('I2',    1000),
+    b'I3':    ('I3',    1000),
+    b'IL':    ('IL',    1000),
+    b'P':     ('P',     1),
+    b'CE':    ('CE',    1000),
+    b'SOC':   ('SOC',   10),
+    b'TTG':   ('TTG',   1),
+    b'T':     ('T',     1),
+    b'H19':   ('H19',   100),
+    b'H20':   ('H20',   100),
+    b'H21':   ('H21',   1),
+    b'H22':   ('H22',   100),
+    b'H23':   ('H23',   1),
+    b'CS':    ('CS',    1),
+    b'ERR':   ('ERR',   1),
+    b'MPPT':  ('MPPT',  1),
+    b'OR':    ('OR',    None),
+    b'LOAD':  ('LOAD',  None),
+    b'Relay': ('Relay', None),
+    b'PID':   ('PID',   None),
+    b'FW':    ('FW',    None),
+    b'SER#':  ('SER',   None),
+}
+
+# VE.Direct HEX protocol registers, as field name, divisor to V, A and W and
+# struct format of the little-endian value
+vedirect_registers = {
+    0xED8D: ('V',   100, '<H'),
+    0xED8F: ('I',   10,  '<h'),
+    0xEDBB: ('VPV', 100, '<H'),
+    0xEDBC: ('PPV', 100, '<I'),
+    0xEDAD: ('IL',  10,  '<H'),
+    0xEDD5: ('VS',  100, '<H'),
+}
+
+# HEX messages are ':', a command nibble, hex bytes and a check byte
+# making the sum of the command and all bytes 0x55, and a newline
+def vedirect_hex(command, payload=b''):
+    check = (0x55 - command - sum(payload)) & 0xff
+    return b':%X%s\n' % (command, binascii.hexlify(payload + bytes([check])).upper())
+
+def vedirect_hex_get(register):
+    return vedirect_hex(0x7, struct.pack('<HB', register, 0))
+
+def vedirect_hex_decode(message):
+    # message is the text between ':' and the newline, returns the command
+    # and payload, or None when malformed
+    try:
+        command = int(message[:1], 16)
+        payload = binascii.unhexlify(message[1:].strip())
+    except (ValueError, binascii.Error):
+        return None
+    if not payload or (command + sum(payload)) & 0xff != 0x55:
+        return None
+    return command, payload[:-1]
+
+# Decoder of the VE.Direct byte stream. Text frames are a run of
+# "\r\n<label>\t<value>" lines ending with "\r\nChecksum\t<byte>", where
+# all bytes of the frame sum to 0 modulo 256. HEX replies may be
+# interleaved anywhere in the text and are taken out before the checksum.
+# Data is appended to one bytearray and frames are checked and cut through
+# a memoryview of it, so a frame is copied once, when its fields are split.
+# Only the labels of FIELDS are decoded, through a dispatch table built
+# once from vedirect_labels.
+class VedirectStream:
+    def __init__(self, FIELDS=None, MAXBUF=4096):
+        self.dispatch = {
+            label: (name, div) for label, (name, div) in vedirect_labels.items()
+            if FIELDS is None or name in FIELDS
+        }
+        self.registers = {
+            reg: r for reg, r in vedirect_registers.items()
+            if FIELDS is None or r[0] in FIELDS
+        }
+        self.maxbuf = MAXBUF
+        self.buf = bytearray()
+        self.frames = 0
+        self.errors = 0
+        self.synced = False
+
+    def feed(self, data):
+        # Returns lists of the decoded text frames and HEX register values,
+        # each a dict of fields
+        self.buf += data
+        frames = []
+        registers = []
+        while True:
+            end = self.buf.find(b'Checksum\t')
+            hexstart = self.buf.find(b':')
+            if hexstart >= 0 and (end < 0 or hexstart < end):
+                hexend = self.buf.find(b'\n', hexstart)
+                if hexend < 0:
+                    break
+                fields = self.decode_hex(bytes(self.buf[hexstart + 1:hexend]))
+                if fields:
+                    registers.append(fields)
+                del self.buf[hexstart:hexend + 1]
+                continue
+            if end < 0 or len(self.buf) < end + 10:
+                break
+            end += 10
+            with memoryview(self.buf) as mv:
+                valid = sum(mv[:end]) & 0xff == 0
+            if valid:
+                frames.append(self.decode(bytes(self.buf[:end])))
+                self.frames += 1
+            elif self.synced:
+                # The first frame is usually partial
+                self.errors += 1
+            self.synced = True
+            del self.buf[:end]
+        if len(self.buf) > self.maxbuf:
+            self.errors += 1
+            del self.buf[:-self.maxbuf // 2]
+        return frames, registers
+
+    def decode(self, frame):
+        fields = {}
+        for line in frame.split(b'\r\n'):
+            label, _, value = line.partition(b'\t')
+            d = self.dispatch.get(label)
+            if d is None:
+                continue
+            name, div = d
+            if div is None:
+                fields[name] = value.decode('ascii', errors='replace')
+                continue
+            try:
+                fields[name] = int(value) / div
+            except ValueError:
+                # "---" for values not available
+                pass
+        return fields
+
+    def decode_hex(self, message):
+        msg = vedirect_hex_decode(message)
+        if msg is None:
+            self.errors += 1
+            return None
+        command, payload = msg
+        if command != 0x7 or len(payload) < 3:
+            return None
+        register, flags = struct.unpack_from('<HB', payload)
+        r = self.registers.get(register)
+        if r is None or flags:
+            return None
+        name, div, fmt = r
+        try:
+            value = struct.unpack_from(fmt, payload, 3)[0]
+        except struct.error:
+            self.errors += 1
+            return None
+        return {name: value / div}
+
+# Reads the VE.Direct text frames, about once per second, and writes the
+# FIELDS in them. With HEXRATE the registers of the FIELDS are also polled
+# with HEX Get commands every HEXRATE seconds, and the replies of each poll
+# written as one point. Note that the charger pauses its text output while
+# HEX commands are being sent.
+def vedirect_process(WRITER, MASERID, SERIALDEVICE, FIELDS=None, HEXRATE=None):
+    with masercapture.serial_port('vedirect', MASERID, serial.Serial(SERIALDEVICE, 19200, bytesize=8, parity='N', stopbits=1, timeout=0.05)) as ser:
+        name = "VE.Direct %s" % MASERID
+        stream = VedirectStream(FIELDS or ('V', 'I', 'VPV', 'PPV', 'IL'))
+        errors = 0
+        tags = {
+            "masertype": "vedirect"
+        }
+        poll = None
+        polled = {}
+        pending = 0
+        if HEXRATE:
+            poll = time.monotonic()
+        while True:
+            if poll is not None and time.monotonic() >= poll:
+                # Replies missing from the previous poll
+                masermetrics.timeouts.labels(name).inc(pending)
+                polled = {}
+                polled_time = time.time_ns()
+                ser.write(b''.join(vedirect_hex_get(reg) for reg in stream.registers))
+                pending = len(stream.registers)
+                poll += HEXRATE
+                if poll < time.monotonic():
+                    poll = time.monotonic() + HEXRATE
+            data = ser.read(max(1, ser.in_waiting))
+            if not data:
+                continue
+            now = time.time_ns()
+            frames, registers = stream.feed(data)
+            if stream.errors != errors:
+                masermetrics.errors.labels(name).inc(stream.errors - errors)
+                errors = stream.errors
+            points = [
+                {
+                    "measurement": MASERID,
+                    "tags": tags,
+                    "time": now,
+                    "fields": fields
+                }
+                for fields in frames if fields
+            ]
+            for fields in registers:
+                polled.update(fields)
+                pending = max(0, pending - 1)
+            if polled and pending == 0:
+                points.append({"measurement": MASERID, "tags": tags, "time": polled_time, "fields": polled})
+                polled = {}
+            if points:
+                WRITER.write_points(points)
+                masermetrics.samples.labels(name).inc(len(points))
+
+def vedirect_probe(ser):
+    return b'Checksum\t' in ser.read(1024)
+
+def vedirect_replay(MASERID, RECORDS, FIELDS=None):
+    stream = VedirectStream(FIELDS or ('V', 'I', 'VPV', 'PPV', 'IL'))
+    tags = {
+        "masertype": "vedirect"
+    }
+    polled = {}
+    polled_time = None
+    for kind, wall, mono, data in RECORDS:
+        if kind == masercapture.WRITE:
+            # A HEX poll, the replies of the previous one are complete
+            if polled:
+                yield {"measurement": MASERID, "tags": tags, "time": polled_time, "fields": polled}
+            polled = {}
+            polled_time = wall
+        elif kind == masercapture.READ:
+            frames, registers = stream.feed(data)
+            for fields in frames:
+                if fields:
+                    yield {"measurement": MASERID, "tags": tags, "time": wall, "fields": fields}
+            for fields in registers:
+                polled.update(fields)
+    if polled:
+        yield {"measurement": MASERID, "tags": tags, "time": polled_time, "fields": polled}
+
+def vedirect_schema(FIELDS=None):
+    fields = FIELDS or ('V', 'I', 'VPV', 'PPV', 'IL')
+    return ["masertype"], [(name, 'float' if div else 'string') for name, div in vedirect_labels.values() if name in fields]
+
+driver = {
+    'process': (vedirect_process, ('maserid', 'device', 'fields', 'hexrate')),
+    'replay': (vedirect_replay, ('fields',)),
+    'probe': (vedirect_probe, 19200, 1.5),
+    'schema': (vedirect_schema, ('fields',)),
+}
@@ -0,0 +1,359 @@
+import calendar
+import collections
+import csv
+import datetime
+import itertools
+import logging
+import math
+import threading
+import time
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+import masermetrics
+
+# InfluxDB line protocol encoding. Points are the same dicts as handed to
+# InfluxDBClient.write_points(), but they are encoded once, when queued, and
+# always with nanosecond precision.
+
+def lp_escape_key(s):
+    return str(s).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def lp_escape_measurement(s):
+    return str(s).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+# None for values line protocol cannot carry, such as NaN, which are left out
+def lp_field_value(v):
+    if v is None:
+        return None
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, int):
+        return '%di' % v
+    if isinstance(v, float):
+        return repr(v) if math.isfinite(v) else None
+    return '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"')
+
+def lp_time(t):
+    # Time as integer nanoseconds since the epoch. Naive datetimes and ISO
+    # strings are UTC, as produced by datetime.utcnow().
+    if t is None:
+        return time.time_ns()
+    if isinstance(t, int):
+        return t
+    if isinstance(t, str):
+        t = datetime.datetime.fromisoformat(t.replace('Z', '+00:00'))
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc)
+    return calendar.timegm(t.timetuple()) * 1000000000 + t.microsecond * 1000
+
+def line_protocol(point):
+    values = ((k, lp_field_value(v)) for k, v in point['fields'].items())
+    fields = ','.join("%s=%s" % (lp_escape_key(k), v) for k, v in values if v is not None)
+    if fields == '':
+        return None
+    key = lp_escape_measurement(point['measurement'])
+    tags = point.get('tags')
+    if tags:
+        key += ''.join(",%s=%s" % (lp_escape_key(k), lp_escape_key(v))
+                       for k, v in sorted(tags.items()) if v != '' and v is not None)
+    return "%s %s %i" % (key, fields, lp_time(point.get('time')))
+
+# In-memory queue of line protocol lines waiting for upload. The flush
+# thread peeks at a batch and only commits (removes) it once the server has
+# accepted it. Beyond MAXQUEUE lines the oldest are dropped.
+class MemoryQueue:
+    def __init__(self, MAXQUEUE=100000):
+        self.maxqueue = MAXQUEUE
+        self.lines = collections.deque()
+        self.times = collections.deque()
+        # Sequence number of the line at the head of the queue
+        self.head = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def append(self, lines):
+        now = time.monotonic()
+        self.lines.extend(lines)
+        self.times.extend([now] * len(lines))
+        while len(self.lines) > self.maxqueue:
+            self.pop()
+            self.dropped += 1
+
+    def pop(self):
+        self.lines.popleft()
+        self.times.popleft()
+        self.head += 1
+
+    def oldest(self):
+        return self.times[0] if self.times else None
+
+    def peek(self, n):
+        lines = list(itertools.islice(self.lines, n))
+        return lines, self.head + len(lines)
+
+    def commit(self, token):
+        # Lines dropped since the peek have already left the queue
+        while self.lines and self.head < token:
+            self.pop()
+
+    def close(self):
+        pass
+
+# Shared InfluxDB writer. All acquisition loops of one masermon process hand
+# their points to the same writer. Points are encoded to line protocol and
+# queued, and a background thread sends them in batches over the one
+# keep-alive client connection, so the acquisition loops never wait for the
+# network. The queue is either in memory or a Spool on disk.
+#
+# A point with a retention_policy key is written to that retention policy,
+# which must have been registered with add_retention_policy(). Such lines
+# are queued as "@<policy> <line>".
+#
+# A batch the server rejects for good, with a 4xx answer other than those
+# of authentication, rate limiting or a missing database, is split in
+# halves until the bad lines are found. Those are logged and dropped, so
+# one bad line does not hold up every later one.
+#
+#  BATCHSIZE      flush as soon as this many lines are queued
+#  FLUSHINTERVAL  flush lines that have been queued for this long (s)
+#  QUEUE          MemoryQueue or Spool, default MemoryQueue(100000)
+class InfluxWriter:
+    def __init__(self, HOST, PORT, DATABASE, SSL=True, VERIFY_SSL=True,
+                 BATCHSIZE=5000, FLUSHINTERVAL=1.0, QUEUE=None):
+        self.host = HOST
+        self.port = PORT
+        self.database = DATABASE
+        self.ssl = SSL
+        self.verify_ssl = VERIFY_SSL
+        self.batchsize = BATCHSIZE
+        self.flushinterval = FLUSHINTERVAL
+        self.queue = QUEUE if QUEUE is not None else MemoryQueue()
+        self.client = None
+        self.retention_policies = {}
+        self.reconnect = False
+        self.cond = threading.Condition()
+        self.running = True
+        self.points_written = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.points_rejected = 0
+        self.points_refused = 0
+        self.flush_latency = 0.0
+        self.flush_latency_max = 0.0
+        masermetrics.db_queue.labels().set_function(lambda: len(self.queue))
+        masermetrics.db_dropped.labels().set_function(lambda: self.queue.dropped)
+        self.thread = threading.Thread(target=self.flush_loop, name="influxwriter", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        masermetrics.db_reconnects.labels().inc()
+        client = InfluxDBClient(host=self.host, port=self.port, ssl=self.ssl, verify_ssl=self.verify_ssl)
+        client.create_database(self.database)
+        client.switch_database(self.database)
+        for name, duration in self.retention_policies.items():
+            try:
+                client.create_retention_policy(name, duration, 1, self.database)
+            except InfluxDBClientError:
+                client.alter_retention_policy(name, self.database, duration)
+        self.client = client
+
+    def add_retention_policy(self, name, duration):
+        with self.cond:
+            self.retention_policies[name] = duration
+            self.reconnect = True
+
+    def write_points(self, points):
+        lines = []
+        for p in points:
+            l = line_protocol(p)
+            if l is None:
+                continue
+            if p.get('retention_policy'):
+                l = "@%s %s" % (p['retention_policy'], l)
+            lines.append(l)
+        self.write_lines(lines)
+        return True
+
+    def write_lines(self, lines):
+        with self.cond:
+            if not self.running:
+                # Closing, the queue may be closed already
+                if not self.points_refused:
+                    logging.warning("InfluxDB writer closed, points written meanwhile are dropped")
+                self.points_refused += len(lines)
+                return
+            self.queue.append(lines)
+            if len(self.queue) >= self.batchsize:
+                self.cond.notify()
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queue_depth': len(self.queue),
+                'points_written': self.points_written,
+                'points_dropped': self.queue.dropped,
+                'points_rejected': self.points_rejected,
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors,
+                'flush_latency': self.flush_latency,
+                'flush_latency_max': self.flush_latency_max,
+            }
+
+    def post(self, lines):
+        # Consecutive lines of the same retention policy in one request
+        for rp, group in itertools.groupby(lines, lambda l: l.split(' ', 1)[0][1:] if l.startswith('@') else None):
+            if rp is not None:
+                group = [l.split(' ', 1)[1] for l in group]
+            self.client.write_points(list(group), time_precision='n', protocol='line', retention_policy=rp)
+
+    def post_checked(self, lines):
+        # Posts lines, dropping those the server rejects for good, and
+        # returns how many were dropped. Halves accepted before an error
+        # that retries the batch are posted again, which InfluxDB takes as
+        # the same points.
+        try:
+            self.post(lines)
+            return 0
+        except InfluxDBClientError as e:
+            if e.code is None or not 400 <= e.code < 500 or e.code in (401, 403, 404, 429):
+                raise
+            if len(lines) == 1:
+                logging.error("InfluxDB rejected line, dropped: %s: %s" % (e.content, lines[0]))
+                masermetrics.db_rejected.labels().inc()
+                return 1
+        half = len(lines) // 2
+        return self.post_checked(lines[:half]) + self.post_checked(lines[half:])
+
+    def send(self, lines):
+        # Returns the number of lines written once the batch is done with,
+        # or None when it is to be retried
+        try:
+            if self.client is None or self.reconnect:
+                self.reconnect = False
+                self.connect()
+            started = time.monotonic()
+            rejected = self.post_checked(lines)
+            self.flush_latency = time.monotonic() - started
+            masermetrics.db_write_seconds.labels().observe(self.flush_latency)
+            self.flush_latency_max = max(self.flush_latency_max, self.flush_latency)
+            self.points_rejected += rejected
+            return len(lines) - rejected
+        except (InfluxDBServerError, InfluxDBClientError, RequestException) as e:
+            logging.error(e)
+            masermetrics.db_errors.labels().inc()
+            self.client = None
+            return None
+
+    def take_batch(self):
+        # Wait until a batch is due and peek at it, it stays queued
+        with self.cond:
+            while self.running:
+                if len(self.queue) >= self.batchsize:
+                    break
+                oldest = self.queue.oldest()
+                if oldest is not None:
+                    age = time.monotonic() - oldest
+                    if age >= self.flushinterval:
+                        break
+                    self.cond.wait(self.flushinterval - age)
+                else:
+                    self.cond.wait(self.flushinterval)
+            return self.queue.peek(self.batchsize)
+
+    def flush_loop(self):
+        backoff = self.flushinterval
+        while self.running or len(self.queue):
+            lines, token = self.take_batch()
+            if not lines:
+                continue
+            written = self.send(lines)
+            if written is not None:
+                with self.cond:
+                    self.queue.commit(token)
+                self.flushes += 1
+                self.points_written += written
+                backoff = self.flushinterval
+            else:
+                # Leave the batch queued and retry later
+                self.flush_errors += 1
+                if not self.running:
+                    break
+                time.sleep(backoff)
+                backoff = min(2 * backoff, 60)
+
+    def close(self, TIMEOUT=10):
+        # Intake first, acquisition threads may still be writing
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(TIMEOUT)
+        with self.cond:
+            self.queue.close()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+# Writer of points to a CSV file instead of InfluxDB, e.g. for replayed
+# captures. Columns are the time in ns, the measurement, and the tags and
+# fields of the first point, others are left out with a warning.
+class CsvWriter:
+    def __init__(self, PATH):
+        self.file = open(PATH, 'w', newline='')
+        self.writer = None
+        self.columns = None
+        self.written = 0
+        self.warned = set()
+        self.lock = threading.Lock()
+
+    def add_retention_policy(self, name, duration):
+        pass
+
+    def write_points(self, points):
+        with self.lock:
+            for p in points:
+                row = dict(p.get('tags') or {}, **p['fields'])
+                if self.writer is None:
+                    self.columns = ['time', 'measurement'] + list(row)
+                    self.writer = csv.writer(self.file)
+                    self.writer.writerow(self.columns)
+                extra = set(row) - set(self.columns) - self.warned
+                if extra:
+                    logging.warning("CSV columns %s not written" % sorted(extra))
+                    self.warned |= extra
+                row['time'] = lp_time(p.get('time'))
+                row['measurement'] = p['measurement']
+                self.writer.writerow([row.get(c, '') for c in self.columns])
+                self.written += 1
+        return True
+
+    def stats(self):
+        return {"points_written": self.written}
+
+    def close(self, TIMEOUT=10):
+        with self.lock:
+            self.file.close()
+
+# Writes points to several writers, such as InfluxDB and a local archive.
+# Other attributes, such as stats(), are those of the first writer.
+class TeeWriter:
+    def __init__(self, *WRITERS):
+        self.writers = WRITERS
+
+    def __getattr__(self, name):
+        return getattr(self.writers[0], name)
+
+    def write_points(self, points):
+        for w in self.writers:
+            w.write_points(points)
+        return True
+
+    def close(self, TIMEOUT=10):
+        # The others first, local archives should not wait for the network
+        for w in reversed(self.writers):
+            w.close(TIMEOUT)
@@ -0,0 +1,18 @@
+import maseralarm
+from masermon import alarm_rule
+
+def point(fields):
+    return {'measurement': 'maserdata', 'tags': {'maser': 'EFOS14'}, 'fields': fields}
+
+def test_expect_number():
+    rule = alarm_rule("Lock!=1")
+    assert rule == {'field': 'Lock', 'expect': 1.0}
+    engine = maseralarm.AlarmEngine([rule], HOLDOFF=0)
+    rules = engine.rules_of('efosb', 'efosb', 'maserdata')
+    engine.check('efosb', rules, point({'Lock': 1.0}))
+    assert engine.active() == []
+    engine.check('efosb', rules, point({'Lock': 0.0}))
+    assert [a[0] for a in engine.active()] == ['Lock expect']
+
+def test_expect_string():
+    assert alarm_rule("Status!=OK") == {'field': 'Status', 'expect': 'OK'}